@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class DjinConfig(AppConfig):
     name = 'djin'
+
+    def ready(self):
+        # connects the setup of the database connections
+        from . import db  # noqa: F401
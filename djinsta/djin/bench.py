@@ -0,0 +1,348 @@
+"""
+Offline benchmark of the scraping pipeline
+
+Recorded profile and post pages are replayed through a stand-in for the
+browser, and documents go to a stand-in for the search backend, so the
+crawl, parse, store and index stages are measured without network or
+browser noise. Everything written to the database is rolled back.
+
+The write benchmark commits for real, to measure what the database does
+with the post writes of several workers at once. Run it on a scratch
+database, it deletes its account but keeps the tags and locations.
+"""
+import json
+import logging
+import platform
+import statistics
+import subprocess
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from unittest import mock
+
+from django.db import OperationalError, connection, transaction
+from django.test.utils import override_settings
+
+from .elastic import build_account_doc, build_post_doc
+from .browser import DriverPool
+from .insight import SearchBackend, index_post, with_post_relations
+from .instagram import HARVEST_SCRIPT, MEDIA_SCRIPT, SCROLL_SCRIPT, URL_INSTAGRAM, Instagram, PostPage
+from .models import Account, Post
+from .parsers import parse_post
+
+logger = logging.getLogger(__name__)
+
+# links rendered per scroll of a profile
+SCROLL_BATCH = 12
+
+
+###############################################################################
+# Pages
+###############################################################################
+
+def page_with_data(entry_data):
+    return (
+        '<html><head><title>Instagram</title></head><body>'
+        f'<script>window._sharedData = {json.dumps({"entry_data": entry_data})};</script>'
+        '</body></html>')
+
+
+def profile_page(username, posts_count):
+    user = {
+        'id': '1',
+        'username': username,
+        'is_private': False,
+        'biography': 'benchmark profile #bench',
+        'external_url': 'https://example.com',
+        'edge_followed_by': {'count': 12000},
+        'edge_follow': {'count': 300},
+        'edge_owner_to_timeline_media': {
+            'count': posts_count,
+            'edges': [],
+            'page_info': {'has_next_page': False, 'end_cursor': None},
+        },
+    }
+    return page_with_data({'ProfilePage': [{'graphql': {'user': user}}]})
+
+
+def post_page(username, code):
+    """Post with a carousel, tags and one of a few locations"""
+    n = sum(map(ord, code))
+    images = [{'node': {'is_video': False, 'display_resources': [
+        {'src': f'https://cdn.example.com/{code}-{i}-640.jpg', 'config_width': 640},
+        {'src': f'https://cdn.example.com/{code}-{i}-1080.jpg', 'config_width': 1080},
+    ]}} for i in range(1 + n % 3)]
+    node = {
+        'shortcode': code,
+        'owner': {'username': username},
+        'taken_at_timestamp': 1500000000 + n * 3600,
+        'is_video': False,
+        'edge_media_preview_like': {'count': n * 7},
+        'edge_media_to_caption': {'edges': [{'node': {'text': f'Day {n} #bench #tag{n % 20} #sea'}}]},
+        'location': {'id': str(n % 10), 'name': f'Beach {n % 10}, Sydney'},
+        'edge_sidecar_to_children': {'edges': images},
+    }
+    return page_with_data({'PostPage': [{'graphql': {'shortcode_media': node}}]})
+
+
+class FakeDriver:
+    """Replays pages for the urls the pages load, like a browser would
+
+    The profile hands out its post codes a scroll at a time through the
+    harvest script, the other scripts do nothing.
+    """
+
+    def __init__(self, profile, post, codes):
+        self.profile = profile
+        self.post = post
+        self.codes = codes
+        self.current_url = None
+        self.page_source = None
+        self.loads = 0
+        self._scrolled = 0
+        self._harvested = 0
+
+    def get(self, url):
+        self.current_url = url
+        self.loads += 1
+        if url.startswith(f'{URL_INSTAGRAM}/p/'):
+            self.page_source = self.post(url.rstrip('/').rsplit('/', 1)[1])
+        else:
+            self.page_source = self.profile
+            self._scrolled = self._harvested = 0
+
+    def execute_script(self, script, *args):
+        if script == HARVEST_SCRIPT:
+            end = min((self._scrolled + 1) * SCROLL_BATCH, len(self.codes))
+            batch, self._harvested = self.codes[self._harvested:end], max(self._harvested, end)
+            return batch
+        if script == SCROLL_SCRIPT:
+            self._scrolled += 1
+            return None
+        if script == MEDIA_SCRIPT:
+            return []
+        raise NotImplementedError(script[:40])
+
+    def execute_cdp_cmd(self, cmd, params):
+        return {}
+
+    def find_elements_by_xpath(self, xpath):
+        return []
+
+    def delete_all_cookies(self):
+        pass
+
+    def add_cookie(self, cookie):
+        pass
+
+    def get_cookies(self):
+        return []
+
+    def quit(self):
+        pass
+
+
+class MemoryBackend(SearchBackend):
+    """Builds and serializes the elasticsearch docs, and keeps them in memory"""
+
+    def __init__(self):
+        self.accounts = {}
+        self.posts = {}
+
+    def index_account(self, account):
+        self.accounts[account.pk] = build_account_doc(account, version=1).to_dict(include_meta=True)
+
+    def index_post(self, post):
+        self.posts[post.pk] = build_post_doc(post, version=1).to_dict(include_meta=True)
+
+    def remove_account(self, pk):
+        return self.accounts.pop(pk, None) is not None
+
+    def remove_post(self, pk):
+        return self.posts.pop(pk, None) is not None
+
+
+###############################################################################
+# Measuring
+###############################################################################
+
+class Stages:
+    """Seconds spent per stage, one sample per call"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    @contextmanager
+    def timing(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples[stage].append(time.perf_counter() - start)
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            with self.timing(stage):
+                return func(*args, **kwargs)
+        return timed
+
+    def summary(self):
+        return {stage: percentiles(samples) for stage, samples in self.samples.items()}
+
+
+class QueryCounter:
+    """Database execute wrapper counting the queries"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def percentiles(samples):
+    """Latency percentiles in milliseconds"""
+    ms = sorted(s * 1000 for s in samples)
+    if len(ms) > 1:
+        cuts = statistics.quantiles(ms, n=100, method='inclusive')
+        p50, p90, p99 = cuts[49], cuts[89], cuts[98]
+    else:
+        p50 = p90 = p99 = ms[0]
+    return {
+        'count': len(ms),
+        'mean': round(statistics.fmean(ms), 3),
+        'p50': round(p50, 3),
+        'p90': round(p90, 3),
+        'p99': round(p99, 3),
+        'max': round(ms[-1], 3),
+    }
+
+
+def run(posts_count, profile=None, post=None):
+    """Crawl a synthetic account of posts_count posts and refresh every post
+
+    Recorded pages replace the generated ones when given, the recorded post
+    page is then replayed for every post.
+    """
+    username = f'bench{posts_count}'
+    codes = [f'B{posts_count}x{i:05d}' for i in range(posts_count + 1)]
+    driver = FakeDriver(
+        profile or profile_page(username, posts_count),
+        (lambda code: post) if post else (lambda code: post_page(username, code)),
+        codes)
+    stages = Stages()
+    queries = QueryCounter()
+    per_post = []
+
+    pool = DriverPool(lambda: driver, URL_INSTAGRAM, size=1)
+    patches = [
+        mock.patch('djin.instagram.driver_pool', pool),
+        mock.patch.object(driver, 'get', stages.wrap('load', driver.get)),
+        mock.patch.object(PostPage, 'PARSER', staticmethod(stages.wrap('parse', PostPage.PARSER))),
+        mock.patch.object(Instagram, 'save_post', staticmethod(stages.wrap('store', Instagram.save_post))),
+    ]
+    search = override_settings(RATE_LIMIT=None, SEARCH_BACKEND={'class': 'djin.bench.MemoryBackend'})
+
+    start = time.perf_counter()
+    with search, transaction.atomic():
+        for patch in patches:
+            patch.start()
+        try:
+            account = Account.objects.create(username=username)
+            with Instagram(account) as insta:
+                with stages.timing('crawl'):
+                    # one code more than asked for, so the feed never runs dry
+                    insta.upsert_profile(account, check_posts=posts_count)
+                for post in with_post_relations(account.posts.all()):
+                    counted = queries.count
+                    with connection.execute_wrapper(queries), stages.timing('post'):
+                        insta.upsert_post(post)
+                        with stages.timing('index'):
+                            index_post(post)
+                    per_post.append(queries.count - counted)
+            elapsed = time.perf_counter() - start
+        finally:
+            for patch in reversed(patches):
+                patch.stop()
+            pool.close()
+            transaction.set_rollback(True)
+
+    return {
+        'posts': posts_count,
+        'seconds': round(elapsed, 3),
+        'pages_per_second': round(driver.loads / elapsed, 1),
+        'queries_per_post': round(statistics.fmean(per_post), 2) if per_post else 0,
+        'stages': stages.summary(),
+    }
+
+
+def write_run(posts_count, workers=1, batch=1):
+    """Store posts_count parsed posts from a number of workers, committing as they go
+
+    Every worker writes its share of the posts with batch posts per
+    transaction. Writes refused for the database being locked are counted.
+    """
+    username = f'writes{posts_count}'
+    stages = Stages()
+    locked = []
+
+    def write(posts):
+        try:
+            for i in range(0, len(posts), batch):
+                chunk = posts[i:i + batch]
+                try:
+                    with stages.timing('transaction'), transaction.atomic():
+                        for post, data in chunk:
+                            with stages.timing('save'):
+                                Instagram.save_post(post, data, data['media'])
+                except OperationalError as e:
+                    logger.warning(f'Batch of {len(chunk)} posts not written: {e}')
+                    locked.append(len(chunk))
+        finally:
+            if workers > 1:
+                connection.close()
+
+    with override_settings(SEARCH_BACKEND={'class': 'djin.bench.MemoryBackend'}):
+        account = Account.objects.create(username=username)
+        try:
+            posts = Post.objects.bulk_create(
+                [Post(account=account, code=f'W{posts_count}x{i:05d}') for i in range(posts_count)])
+            # parsed up front, only the writes are timed
+            posts = [(post, parse_post(post_page(username, post.code))) for post in posts]
+            start = time.perf_counter()
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(write, [posts[i::workers] for i in range(workers)]))
+            else:
+                write(posts)
+            elapsed = time.perf_counter() - start
+        finally:
+            account.delete()
+
+    written = posts_count - sum(locked)
+    return {
+        'posts': posts_count,
+        'workers': workers,
+        'batch': batch,
+        'seconds': round(elapsed, 3),
+        'posts_per_second': round(written / elapsed, 1),
+        'locked': sum(locked),
+        'stages': stages.summary(),
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'database': connection.vendor,
+    }
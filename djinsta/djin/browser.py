@@ -0,0 +1,237 @@
+import atexit
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.chrome.options import Options
+
+logger = logging.getLogger(__name__)
+
+
+class BrowserError(Exception):
+    """Browser errors"""
+
+
+class DriverPoolExhausted(BrowserError):
+    """No driver became available in time"""
+
+
+def build_driver():
+    """Start a new chrome browser with the profile from settings"""
+    profile = settings.BROWSER_PROFILE
+    options = Options()
+    options.add_argument('--dns-prefetch-disable')
+    options.add_argument('--no-sandbox')
+    options.add_argument('--lang=en-US')
+    options.add_argument('--disable-setuid-sandbox')
+    if profile['headless']:
+        options.add_argument('--headless')
+        options.add_argument(f'--window-size={profile["window_size"]}')
+    if profile['disable_extensions']:
+        options.add_argument('--disable-extensions')
+    if profile['disable_gpu']:
+        options.add_argument('--disable-gpu')
+    chrome_prefs = {
+        'intl.accept_languages': 'en-US',
+    }
+    options.add_experimental_option('prefs', chrome_prefs)
+    return webdriver.Chrome(settings.BROWSER_CHROME, chrome_options=options)
+
+
+# url patterns of the resource types that can be blocked
+RESOURCE_PATTERNS = {
+    'image': ['*.jpg*', '*.jpeg*', '*.png*', '*.gif*', '*.webp*', '*.ico*'],
+    'media': ['*.mp4*', '*.webm*', '*.m4a*', '*.m3u8*'],
+    'font': ['*.woff*', '*.ttf*', '*.otf*', '*.eot*'],
+}
+
+
+def apply_preset(driver, name, blocked=None):
+    """Block the resource types of the page type preset for the next loads
+
+    The resource types are those of the preset in BROWSER_PRESETS unless
+    `blocked` is given. The preset is remembered on the driver, so
+    switching costs nothing when the same page type is loaded again.
+    """
+    if getattr(driver, 'djin_preset', None) == name:
+        return
+    if not hasattr(driver, 'execute_cdp_cmd'):
+        logger.warning('Browser does not support blocking resources')
+        driver.djin_preset = name
+        return
+    if blocked is None:
+        blocked = settings.BROWSER_PRESETS[name]['block']
+    driver.execute_cdp_cmd('Network.enable', {})
+    driver.execute_cdp_cmd('Network.setBlockedURLs', {
+        'urls': [p for kind in blocked for p in RESOURCE_PATTERNS[kind]],
+    })
+    driver.djin_preset = name
+
+
+class PooledDriver:
+    """A running browser with its bookkeeping"""
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+        self.uses = 0
+        # cookies currently loaded into the browser
+        self.cookies = None
+
+    def __str__(self):
+        return f'PooledDriver {id(self.driver):x} used {self.uses} times'
+
+    def is_expired(self, max_age, max_uses):
+        return (time.monotonic() - self.created_at > max_age) or (self.uses >= max_uses)
+
+    def is_idle(self, max_idle):
+        return time.monotonic() - self.last_used_at > max_idle
+
+    def is_healthy(self):
+        """Can the browser still be controlled"""
+        try:
+            self.driver.current_url
+        except WebDriverException:
+            return False
+        return True
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except WebDriverException:
+            logger.warning(f'Could not quit {self}')
+
+
+class DriverPool:
+    """Process wide pool of warm browsers
+
+    Browsers are checked out for an account, which swaps the cookies in when
+    the browser last served another session, and are returned after use.
+    Browsers are recycled after max_age seconds or max_uses checkouts, and
+    quit when idle for longer than max_idle seconds.
+    """
+
+    def __init__(self, factory, home_url, size=4, max_age=3600, max_uses=50, max_idle=300, timeout=600):
+        self.factory = factory
+        self.home_url = home_url
+        self.size = size
+        self.max_age = max_age
+        self.max_uses = max_uses
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._idle = []
+        self._busy = {}
+        self._closed = False
+        self._lock = threading.Condition()
+
+    def __str__(self):
+        return f'DriverPool {len(self._idle)} idle {len(self._busy)} busy'
+
+    def acquire(self, account):
+        """Check out a browser loaded with the account's cookies"""
+        pooled = self._checkout()
+        try:
+            self._switch_session(pooled, account)
+        except WebDriverException:
+            self.release(pooled.driver, discard=True)
+            raise
+        return pooled.driver
+
+    def release(self, driver, discard=False):
+        """Return a browser to the pool"""
+        with self._lock:
+            pooled = self._busy.pop(id(driver), None)
+            if pooled is None:
+                raise BrowserError('Driver does not belong to this pool')
+            pooled.last_used_at = time.monotonic()
+            if discard or self._closed or pooled.is_expired(self.max_age, self.max_uses):
+                logger.info(f'Recycling {pooled}')
+                self._lock.notify()
+            else:
+                self._idle.append(pooled)
+                self._lock.notify()
+                pooled = None
+        if pooled is not None:
+            pooled.quit()
+
+    def evict_idle(self):
+        """Quit browsers that have not been used for a while"""
+        with self._lock:
+            evicted = [p for p in self._idle if p.is_idle(self.max_idle)]
+            self._idle = [p for p in self._idle if p not in evicted]
+        for pooled in evicted:
+            logger.info(f'Evicting idle {pooled}')
+            pooled.quit()
+        return len(evicted)
+
+    def close(self):
+        """Quit all idle browsers, the busy ones are quit when released"""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for pooled in idle:
+            pooled.quit()
+
+    def _checkout(self):
+        self.evict_idle()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._lock:
+                while self._idle:
+                    # most recently used first, it is the warmest
+                    pooled = self._idle.pop()
+                    if pooled.is_expired(self.max_age, self.max_uses) or not pooled.is_healthy():
+                        logger.info(f'Discarding {pooled}')
+                        pooled.quit()
+                        continue
+                    return self._mark_busy(pooled)
+                if len(self._busy) < self.size:
+                    # reserve the slot before starting the slow browser
+                    placeholder = object()
+                    self._busy[id(placeholder)] = placeholder
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DriverPoolExhausted(f'No browser available in {self}')
+                self._lock.wait(remaining)
+
+        try:
+            pooled = PooledDriver(self.factory())
+        except Exception:
+            with self._lock:
+                del self._busy[id(placeholder)]
+                self._lock.notify()
+            raise
+        logger.info(f'Started {pooled}')
+        with self._lock:
+            del self._busy[id(placeholder)]
+            return self._mark_busy(pooled)
+
+    def _mark_busy(self, pooled):
+        pooled.uses += 1
+        self._busy[id(pooled.driver)] = pooled
+        return pooled
+
+    def _switch_session(self, pooled, account):
+        """Load the account cookies unless the browser already has them"""
+        if pooled.cookies == account.cookies:
+            return
+        pooled.driver.delete_all_cookies()
+        if account.cookies:
+            # cookies can only be set on the domain that is loaded
+            pooled.driver.get(self.home_url)
+            for cookie in json.loads(account.cookies):
+                pooled.driver.add_cookie(cookie)
+        pooled.cookies = account.cookies
+
+
+def create_pool(home_url):
+    """Create the pool from settings, closed when the process exits"""
+    pool = DriverPool(build_driver, home_url, **settings.BROWSER_POOL)
+    atexit.register(pool.close)
+    return pool
@@ -0,0 +1,137 @@
+"""
+Cache for search results and aggregations
+
+Results are kept in a small in-memory LRU in front of the shared django
+cache. Keys carry a generation number that every index write bumps, which
+invalidates all cached results at once in every process.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = 'search:generation'
+
+
+def new_generation():
+    """Generation to restart from when the shared one was lost
+
+    Microseconds since the epoch, so results stored under a generation
+    counted up from an earlier start are not served again.
+    """
+    return time.time_ns() // 1000
+
+
+class LRUCache:
+    """Least recently used cache with a maximum size and a timeout"""
+
+    def __init__(self, maxsize, timeout):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires_at, value = self._data[key]
+            except KeyError:
+                return default
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = time.monotonic() + self.timeout, value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SearchCache:
+    """Two tier cache of search results keyed by query"""
+
+    # seconds the generation of other processes' writes can be stale
+    GENERATION_TTL = 5
+
+    def __init__(self, maxsize=256, timeout=3600, backend='default'):
+        self.local = LRUCache(maxsize, timeout)
+        self.timeout = timeout
+        self.backend = backend
+        self.counts = Counter()
+        self._generation = None
+        self._generation_at = 0
+
+    @property
+    def shared(self):
+        return caches[self.backend]
+
+    def key(self, name, params):
+        digest = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+        return f'search:{self.generation()}:{name}:{digest}'
+
+    def generation(self):
+        """Generation of the index, refreshed from the shared cache now and then"""
+        if self._generation is None or time.monotonic() - self._generation_at > self.GENERATION_TTL:
+            self._generation = self.shared.get_or_set(GENERATION_KEY, new_generation, None)
+            self._generation_at = time.monotonic()
+        return self._generation
+
+    def get_or_set(self, name, params, compute):
+        """Cached result of the query, computed and stored when missing"""
+        key = self.key(name, params)
+        value = self.local.get(key)
+        if value is not None:
+            self.counts['local_hits'] += 1
+            return value
+        value = self.shared.get(key)
+        if value is not None:
+            self.counts['shared_hits'] += 1
+        else:
+            self.counts['misses'] += 1
+            value = compute()
+            self.shared.set(key, value, self.timeout)
+        self.local.set(key, value)
+        return value
+
+    def invalidate(self):
+        """Forget all cached results after an index write"""
+        try:
+            self._generation = self.shared.incr(GENERATION_KEY)
+        except ValueError:
+            # generation evicted or never set
+            self._generation = new_generation()
+            self.shared.set(GENERATION_KEY, self._generation, None)
+        self._generation_at = time.monotonic()
+        self.local.clear()
+        self.counts['invalidations'] += 1
+
+    def stats(self):
+        hits = self.counts['local_hits'] + self.counts['shared_hits']
+        lookups = hits + self.counts['misses']
+        return {
+            **self.counts,
+            'local_size': len(self.local),
+            'generation': self._generation,
+            'hit_rate': hits / lookups if lookups else 0,
+        }
+
+
+search_cache = SearchCache(**settings.SEARCH_CACHE)
@@ -0,0 +1,20 @@
+"""
+Setup of the database connections
+
+Every sqlite connection gets the pragmas of settings.SQLITE_PRAGMAS. In
+WAL mode readers do not block the one writer, so the task runner polling
+for tasks and the workers reading posts no longer hold up the writes.
+"""
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+@receiver(connection_created)
+def tune_sqlite(sender, connection, **kwargs):
+    """Set the pragmas on every new sqlite connection"""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for pragma, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
@@ -0,0 +1,481 @@
+"""
+Elasticsearch backend of the insights
+"""
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import chain
+
+from django.conf import settings
+from django.core.cache import cache
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch.helpers import streaming_bulk
+from elasticsearch_dsl import (
+    connections, Index, DocType, Integer, Keyword, Date, Text, GeoPoint, FacetedSearch, TermsFacet)
+
+from .cache import search_cache
+from .insight import BulkIndexError, SearchBackend
+from .metrics import timed
+
+logger = logging.getLogger(__name__)
+
+ACCOUNT_ALIAS = 'account'
+POST_ALIAS = 'post'
+
+
+class ElasticBackend(SearchBackend):
+    """Accounts and posts in elasticsearch, connected on first request"""
+
+    def __init__(self, hosts=('localhost',), timeout=5):
+        # only configured, the connection is made by the first request
+        connections.configure(default={'hosts': list(hosts), 'timeout': timeout})
+
+    def setup(self):
+        setup_indices()
+
+    def index_account(self, account):
+        return build_account_doc(account).save()
+
+    def index_post(self, post):
+        doc = build_post_doc(post)
+        created = doc.save()
+        remove_moved_posts({doc.meta.index: [post.pk]})
+        return created
+
+    def remove_account(self, pk):
+        response = connections.get_connection().delete(
+            index=ACCOUNT_ALIAS, doc_type=AccountDoc._doc_type.name, id=pk, ignore=404)
+        return response.get('result') == 'deleted'
+
+    def remove_post(self, pk):
+        # the month index of the post is not known, so delete through the alias
+        return bool(PostDoc.search(index=POST_ALIAS).filter('ids', values=[pk]).delete().deleted)
+
+    def get_account(self, pk):
+        return AccountDoc.get(pk, index=ACCOUNT_ALIAS, ignore=404)
+
+    def get_posts(self, pks):
+        """Post docs by id through the alias, a get would need the month index of every post"""
+        response = PostDoc.search(index=POST_ALIAS).filter('ids', values=pks)[:len(pks)].execute()
+        docs = {int(hit.meta.id): hit for hit in response}
+        return [docs.get(pk) for pk in pks]
+
+    def account_facets(self):
+        response = AccountSearch().execute()
+        return {'facets': {name: list(response.facets[name]) for name in AccountSearch.facets}}
+
+    def post_heatmap(self, precision, bounds=None, account_pk=None):
+        search = PostDoc.search(index=POST_ALIAS)
+        if account_pk:
+            search = search.filter('term', account_id=account_pk)
+        return heatmap(search, precision, bounds)
+
+    def account_heatmap(self, precision, bounds=None):
+        return heatmap(AccountDoc.search(index=ACCOUNT_ALIAS), precision, bounds)
+
+    def indexer(self, **kwargs):
+        return BulkIndexer(**kwargs)
+
+
+###############################################################################
+# Account
+###############################################################################
+
+class AccountDoc(DocType):
+    username = Keyword(required=True)
+    posts_count = Integer()
+    followers_count = Integer()
+    following_count = Integer()
+    bio = Text()
+    website = Keyword(doc_values=False)
+    joined_at = Date()
+
+    # post
+    location = Keyword()
+    geo = GeoPoint()
+    tags = Keyword()
+    count = Integer()
+    posted_at = Date()
+
+    class Meta:
+        # alias of the current account index
+        index = ACCOUNT_ALIAS
+
+    def __str__(self):
+        return f'AccountDoc {self.username}'
+
+
+def build_account_doc(account, version=None):
+    """Account document with the aggregated post data
+
+    Fetches the posts with their locations and tags in two queries, no
+    matter how many posts the account has.
+    """
+    posts = list(account.posts.select_related('location').prefetch_related('tags'))
+    return AccountDoc(
+        meta={'id': account.pk, 'index': account_index(version) if version else ACCOUNT_ALIAS},
+        username=account.username,
+        posts_count=account.posts_count,
+        followers_count=account.followers_count,
+        following_count=account.following_count,
+        bio=account.bio,
+        website=account.website,
+        joined_at=account.created_at,
+
+        # post
+        location=list(chain.from_iterable(p.location.parts() for p in posts if p.location)),
+        geo=[p.location.point() for p in posts if p.location and p.location.point()],
+        tags=[t.word.lower() for p in posts for t in p.tags.all()],
+        count=[p.count for p in posts if p.count],
+        posted_at=[p.created_at for p in posts],
+    )
+
+
+class AccountSearch(FacetedSearch):
+    index = ['account', ]
+    # doc type of result
+    doc_types = [AccountDoc, ]
+    # fields that should be searched
+    fields = ['tags', ]
+
+    facets = {
+        # use bucket aggregations to define facets
+        'tags': TermsFacet(field='tags'),
+        'locations': TermsFacet(field='location'),
+    }
+
+    # sort = []
+
+
+
+###############################################################################
+# Post
+###############################################################################
+
+class PostDoc(DocType):
+    account_id = Integer()
+    code = Keyword(doc_values=False)
+    location = Keyword()
+    geo = GeoPoint()
+    tags = Keyword()
+    description = Text()
+    count = Integer()
+    kind = Keyword()
+    posted_at = Date()
+
+    class Meta:
+        # alias over the monthly post indices, writes go to the index of the month
+        index = POST_ALIAS
+
+    def __str__(self):
+        return f'PostDoc {self.account_id} - {self.posted_at:%-d %b %Y}'
+
+
+def build_post_doc(post, version=None):
+    """Post document, queries nothing when loaded with `with_post_relations`"""
+    return PostDoc(
+        meta={'id': post.pk, 'index': post_index(post.created_at, version)},
+        account_id=post.account_id,
+        code=post.code,
+        location=post.location.name.lower() if post.location else None,
+        geo=post.location.point() if post.location else None,
+        tags=[t.word.lower() for t in post.tags.all()],
+        description=post.description,
+        count=post.count,
+        kind=post.kind,
+        posted_at=post.created_at,
+    )
+
+
+###############################################################################
+# Geo
+###############################################################################
+
+# cells of a heatmap, the finest precisions over the world would be more
+HEATMAP_CELLS = 10000
+
+
+def heatmap(search, precision, bounds=None):
+    """Geohash grid and bounds aggregations of the search in one request
+
+    Bounds limit the map to (top, left, bottom, right), the result has the
+    box around all the documents to fit the map to.
+    """
+    search = search.extra(size=0)
+    if bounds:
+        top, left, bottom, right = bounds
+        search = search.filter('geo_bounding_box', geo={
+            'top_left': {'lat': top, 'lon': left},
+            'bottom_right': {'lat': bottom, 'lon': right},
+        })
+    search.aggs.bucket(
+        'cells', 'geohash_grid', field='geo', precision=precision, size=HEATMAP_CELLS,
+    ).metric('centre', 'geo_centroid', field='geo')
+    search.aggs.metric('bounds', 'geo_bounds', field='geo')
+    response = search.execute()
+    return {
+        'bounds': response.aggregations.bounds.to_dict().get('bounds'),
+        'cells': [{
+            'geohash': cell.key,
+            'count': cell.doc_count,
+            'centre': cell.centre.location.to_dict(),
+        } for cell in response.aggregations.cells.buckets],
+    }
+
+
+###############################################################################
+# Layout
+###############################################################################
+
+# Posts are written to an index per month of posted_at and read through the
+# post alias, the account index sits behind the account alias. The version
+# in the index names lets a reindex fill new indices while the aliases keep
+# serving the old ones.
+
+def account_index(version):
+    return f'{ACCOUNT_ALIAS}-v{version}'
+
+
+def post_index(posted_at, version=None):
+    return f'{POST_ALIAS}-v{version or current_version()}-{posted_at:%Y.%m}'
+
+
+def post_pattern(version):
+    return f'{POST_ALIAS}-v{version}-*'
+
+
+def remove_moved_posts(placed):
+    """Delete the copies of posts in other months than the index they were written to
+
+    The month of a post moves from the time it was found to the time it was
+    posted on its first refresh, the copy left in the old month would be
+    counted twice through the alias. Placed maps an index to its post pks.
+    """
+    moved = [{'bool': {
+        'filter': [{'ids': {'values': pks}}],
+        'must_not': [{'term': {'_index': index}}],
+    }} for index, pks in placed.items()]
+    connections.get_connection().delete_by_query(
+        index=POST_ALIAS, conflicts='proceed',
+        body={'query': {'bool': {'should': moved, 'minimum_should_match': 1}}})
+
+
+# the version is shared over the processes like the generation of the search cache
+VERSION_KEY = 'search:version'
+# seconds the version of other processes can be stale
+VERSION_TTL = 5
+
+_version = {'number': None, 'read_at': 0}
+
+
+def current_version():
+    """Version of the indices the aliases point at
+
+    Read from the shared cache every few seconds, and from the aliases when
+    the cache does not know it.
+    """
+    if _version['number'] is None or time.monotonic() - _version['read_at'] > VERSION_TTL:
+        number = cache.get(VERSION_KEY)
+        if number is None:
+            es = connections.get_connection()
+            try:
+                names = es.indices.get_alias(name=ACCOUNT_ALIAS)
+            except NotFoundError:
+                return None
+            number = max(int(name.rsplit('-v', 1)[1]) for name in names)
+            cache.set(VERSION_KEY, number, None)
+        _version.update(number=number, read_at=time.monotonic())
+    return _version['number']
+
+
+def set_version(number):
+    """Write to the version from now on, in every process within VERSION_TTL"""
+    cache.set(VERSION_KEY, number, None)
+    _version.update(number=number, read_at=time.monotonic())
+
+
+def index_settings(refresh_interval=None):
+    options = settings.ES_INDEX
+    return {
+        'number_of_shards': options['shards'],
+        'number_of_replicas': options['replicas'],
+        'refresh_interval': refresh_interval or settings.ES_REFRESH_INTERVAL,
+    }
+
+
+def put_layout(version, aliased=True, refresh_interval=None):
+    """Create the post template and account index of the version
+
+    When not aliased, the indices are only written, e.g. while a reindex
+    loads them.
+    """
+    es = connections.get_connection()
+    aliases = {POST_ALIAS: {}} if aliased else {}
+    es.indices.put_template(name=post_pattern(version)[:-2], body={
+        'index_patterns': [post_pattern(version)],
+        'settings': index_settings(refresh_interval),
+        'mappings': PostDoc._doc_type.mapping.to_dict(),
+        'aliases': aliases,
+    })
+    account_ix = Index(account_index(version))
+    if not account_ix.exists():
+        account_ix.settings(**index_settings(refresh_interval))
+        account_ix.doc_type(AccountDoc)
+        if aliased:
+            account_ix.aliases(**{ACCOUNT_ALIAS: {}})
+        account_ix.create()
+
+
+def switch_layout(old, new):
+    """Point the aliases at the new version at once and drop the old one"""
+    es = connections.get_connection()
+    actions = [
+        {'add': {'index': post_pattern(new), 'alias': POST_ALIAS}},
+        {'add': {'index': account_index(new), 'alias': ACCOUNT_ALIAS}},
+    ]
+    if old:
+        actions = [
+            {'remove': {'index': post_pattern(old), 'alias': POST_ALIAS}},
+            {'remove': {'index': account_index(old), 'alias': ACCOUNT_ALIAS}},
+        ] + actions
+    es.indices.update_aliases(body={'actions': actions})
+    # new months of the new version join the alias from now on
+    put_layout(new)
+    Index(post_pattern(new)).put_settings(body={'index': {'refresh_interval': settings.ES_REFRESH_INTERVAL}})
+    Index(account_index(new)).put_settings(body={'index': {'refresh_interval': settings.ES_REFRESH_INTERVAL}})
+    set_version(new)
+    if old:
+        # writes of other processes still going to the old version would
+        # create indices without the template or the alias
+        time.sleep(VERSION_TTL)
+        es.indices.delete_template(name=post_pattern(old)[:-2])
+        es.indices.delete(index=f'{post_pattern(old)},{account_index(old)}')
+    logger.info(f'Switched indices from version {old} to {new}')
+
+
+def setup_indices():
+    """Create the first version of the layout when there is none"""
+    if current_version() is None:
+        put_layout(1)
+        set_version(1)
+
+
+
+###############################################################################
+# Bulk
+###############################################################################
+
+class BulkIndexer:
+    """Buffers documents and sends them with the bulk api
+
+    The buffer is flushed when it holds `size` documents or when the oldest
+    document has waited `interval` seconds. Items that fail with a retryable
+    status are sent again, up to `retries` times. Closing raises
+    BulkIndexError when documents could not be indexed.
+    """
+
+    RETRY_STATUSES = {429, 502, 503, 504}
+
+    def __init__(self, size=None, interval=None, retries=None):
+        options = settings.ES_BULK
+        self.size = size or options['size']
+        self.interval = interval or options['interval']
+        self.retries = retries if retries is not None else options['retries']
+        self.buffer = []
+        self.buffered_at = None
+        # index and pk of the posts written to the current version
+        self.placed = set()
+        self.indexed = 0
+        self.failed = 0
+        self.failed_posts = []
+        # the first errors, to report when closing
+        self.errors = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+        if self.failed and exc_type is None:
+            raise BulkIndexError(f'{self}, first errors: {self.errors}', self.failed_posts)
+
+    def __str__(self):
+        return f'BulkIndexer {self.indexed} indexed {self.failed} failed'
+
+    def add(self, doc):
+        """Add document to the buffer"""
+        if not self.buffer:
+            self.buffered_at = time.monotonic()
+        self.buffer.append(doc.to_dict(include_meta=True))
+        if len(self.buffer) >= self.size or time.monotonic() - self.buffered_at >= self.interval:
+            self.flush()
+
+    def add_account(self, account, version=None):
+        self.add(build_account_doc(account, version))
+
+    def add_post(self, post, version=None):
+        doc = build_post_doc(post, version)
+        if version is None:
+            # the indices of a version being loaded hold no other copies
+            self.placed.add((doc.meta.index, post.pk))
+        self.add(doc)
+
+    @timed('bulk_index')
+    def flush(self):
+        """Send the buffered documents"""
+        actions, self.buffer = self.buffer, []
+        sent = bool(actions)
+        moved = defaultdict(list)
+        attempt = 0
+        while actions:
+            retry = []
+            for ok, item, action in self._send(actions):
+                if ok:
+                    self.indexed += 1
+                    if (action['_index'], action['_id']) in self.placed:
+                        moved[action['_index']].append(action['_id'])
+                elif item.get('status') in self.RETRY_STATUSES and attempt < self.retries:
+                    retry.append(action)
+                else:
+                    self.failed += 1
+                    if action['_index'].split('-')[0] == POST_ALIAS:
+                        self.failed_posts.append(action['_id'])
+                    if len(self.errors) < 10:
+                        self.errors.append(item)
+                    logger.error(f'Could not index {action["_index"]}/{action["_id"]}: {item}')
+            if retry:
+                attempt += 1
+                logger.warning(f'Retrying {len(retry)} documents, attempt {attempt}')
+                time.sleep(2 ** attempt)
+            actions = retry
+        self.placed.clear()
+        # a post that could not be written keeps its old copy
+        if moved:
+            remove_moved_posts(moved)
+        if sent:
+            search_cache.invalidate()
+        logger.info(f'Flushed {self}')
+
+    def _send(self, actions):
+        """Yield the result of every action with the action itself"""
+        results = streaming_bulk(
+            connections.get_connection(), actions,
+            chunk_size=self.size, raise_on_error=False, raise_on_exception=False)
+        for action, (ok, result) in zip(actions, results):
+            item = next(iter(result.values()))
+            yield ok, item, action
+
+
+@contextmanager
+def bulk_load(*indices):
+    """Disable index refreshes during a large load"""
+    ixs = [Index(name) for name in indices]
+    for ix in ixs:
+        ix.put_settings(body={'index': {'refresh_interval': '-1'}})
+    try:
+        yield
+    finally:
+        for ix in ixs:
+            ix.put_settings(body={'index': {'refresh_interval': settings.ES_REFRESH_INTERVAL}})
+            ix.refresh()
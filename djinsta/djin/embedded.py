@@ -0,0 +1,226 @@
+"""
+Whoosh backend of the insights
+
+The account and post docs are kept in index files on disk, so a single
+node or the tests run without an elasticsearch server.
+"""
+import logging
+import os
+from itertools import chain
+from types import SimpleNamespace
+
+from whoosh import index, sorting
+from whoosh.fields import DATETIME, ID, KEYWORD, NUMERIC, STORED, TEXT, Schema
+from whoosh.query import Every
+from whoosh.writing import AsyncWriter
+
+from .cache import search_cache
+from .insight import SearchBackend
+from .metrics import timed
+
+logger = logging.getLogger(__name__)
+
+ACCOUNT_SCHEMA = Schema(
+    pk=ID(stored=True, unique=True),
+    username=ID(stored=True),
+    posts_count=NUMERIC(stored=True),
+    followers_count=NUMERIC(stored=True),
+    following_count=NUMERIC(stored=True),
+    bio=TEXT(stored=True),
+    website=STORED,
+    joined_at=DATETIME(stored=True),
+
+    # post
+    location=KEYWORD(stored=True, commas=True, lowercase=True),
+    tags=KEYWORD(stored=True, commas=True, lowercase=True),
+    count=STORED,
+    posted_at=STORED,
+)
+
+POST_SCHEMA = Schema(
+    pk=ID(stored=True, unique=True),
+    account_id=NUMERIC(stored=True),
+    code=ID(stored=True),
+    location=ID(stored=True),
+    tags=KEYWORD(stored=True, commas=True, lowercase=True),
+    description=TEXT(stored=True),
+    count=NUMERIC(stored=True),
+    kind=ID(stored=True),
+    posted_at=DATETIME(stored=True),
+)
+
+# keyword fields stored as comma separated text
+LISTS = ('location', 'tags')
+
+# facet names of the account facets with their fields
+FACETS = {'tags': 'tags', 'locations': 'location'}
+FACET_SIZE = 10
+
+
+def account_fields(account):
+    """Fields of the account doc with the aggregated post data"""
+    posts = list(account.posts.select_related('location').prefetch_related('tags'))
+    return dict(
+        pk=str(account.pk),
+        username=account.username,
+        posts_count=account.posts_count,
+        followers_count=account.followers_count,
+        following_count=account.following_count,
+        bio=account.bio,
+        website=account.website,
+        joined_at=account.created_at,
+
+        # post
+        location=','.join(chain.from_iterable(p.location.parts() for p in posts if p.location)),
+        tags=','.join(t.word.lower() for p in posts for t in p.tags.all()),
+        count=[p.count for p in posts if p.count],
+        posted_at=[p.created_at for p in posts],
+    )
+
+
+def post_fields(post):
+    """Fields of the post doc, queries nothing when loaded with `with_post_relations`"""
+    return dict(
+        pk=str(post.pk),
+        account_id=post.account_id,
+        code=post.code,
+        location=post.location.name.lower() if post.location else None,
+        tags=','.join(t.word.lower() for t in post.tags.all()),
+        description=post.description,
+        count=post.count,
+        kind=post.kind,
+        posted_at=post.created_at,
+    )
+
+
+def clean(fields):
+    """Whoosh does not take None for a field"""
+    return {k: v for k, v in fields.items() if v is not None}
+
+
+def as_doc(fields):
+    if fields is None:
+        return None
+    fields = dict(fields)
+    for name in LISTS:
+        if isinstance(fields.get(name), str):
+            fields[name] = [v for v in fields[name].split(',') if v]
+    return SimpleNamespace(**fields)
+
+
+class WhooshBackend(SearchBackend):
+    """Accounts and posts in whoosh indices in one directory"""
+
+    def __init__(self, path):
+        self.path = path
+        self.accounts = None
+        self.posts = None
+
+    def setup(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.accounts = self.open('account', ACCOUNT_SCHEMA)
+        self.posts = self.open('post', POST_SCHEMA)
+
+    def open(self, name, schema):
+        if index.exists_in(self.path, indexname=name):
+            return index.open_dir(self.path, indexname=name)
+        logger.info(f'Creating whoosh index {name} in {self.path}')
+        return index.create_in(self.path, schema, indexname=name)
+
+    def write(self, ix, update=(), delete=()):
+        """Update and delete docs in one commit, waits for the lock in a thread if taken"""
+        writer = AsyncWriter(ix)
+        for fields in update:
+            writer.update_document(**clean(fields))
+        for pk in delete:
+            writer.delete_by_term('pk', str(pk))
+        writer.commit()
+
+    def index_account(self, account):
+        self.write(self.accounts, update=[account_fields(account)])
+
+    def index_post(self, post):
+        self.write(self.posts, update=[post_fields(post)])
+
+    def remove_account(self, pk):
+        return self.remove(self.accounts, pk)
+
+    def remove_post(self, pk):
+        return self.remove(self.posts, pk)
+
+    def remove(self, ix, pk):
+        with ix.searcher() as searcher:
+            if searcher.document_number(pk=str(pk)) is None:
+                return False
+        self.write(ix, delete=[pk])
+        return True
+
+    def get_account(self, pk):
+        with self.accounts.searcher() as searcher:
+            return as_doc(searcher.document(pk=str(pk)))
+
+    def get_posts(self, pks):
+        with self.posts.searcher() as searcher:
+            return [as_doc(searcher.document(pk=str(pk))) for pk in pks]
+
+    def account_facets(self):
+        facets = {name: sorting.FieldFacet(field, allow_overlap=True) for name, field in FACETS.items()}
+        with self.accounts.searcher() as searcher:
+            results = searcher.search(Every(), limit=None, groupedby=facets, maptype=sorting.Count)
+            facets = {}
+            for name in FACETS:
+                # docs without the field are grouped under None
+                counts = [(term, count) for term, count in results.groups(name).items() if term is not None]
+                counts.sort(key=lambda c: -c[1])
+                facets[name] = [(term, count, False) for term, count in counts[:FACET_SIZE]]
+        return {'facets': facets}
+
+    def indexer(self, **kwargs):
+        return WhooshIndexer(self, **kwargs)
+
+
+class WhooshIndexer:
+    """Buffers docs and writes them in one commit per index"""
+
+    def __init__(self, backend, size=500):
+        self.backend = backend
+        self.size = size
+        self.accounts = []
+        self.posts = []
+        self.indexed = 0
+        self.failed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def __str__(self):
+        return f'WhooshIndexer {self.indexed} indexed {self.failed} failed'
+
+    def add_account(self, account, version=None):
+        self.accounts.append(account_fields(account))
+        self.flush_when_full()
+
+    def add_post(self, post, version=None):
+        self.posts.append(post_fields(post))
+        self.flush_when_full()
+
+    def flush_when_full(self):
+        if len(self.accounts) + len(self.posts) >= self.size:
+            self.flush()
+
+    @timed('bulk_index')
+    def flush(self):
+        """Write the buffered docs"""
+        accounts, self.accounts = self.accounts, []
+        posts, self.posts = self.posts, []
+        if accounts:
+            self.backend.write(self.backend.accounts, update=accounts)
+        if posts:
+            self.backend.write(self.backend.posts, update=posts)
+        if accounts or posts:
+            self.indexed += len(accounts) + len(posts)
+            search_cache.invalidate()
+        logger.info(f'Flushed {self}')
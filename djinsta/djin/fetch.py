@@ -0,0 +1,218 @@
+"""
+Browserless fetching of profile and post pages
+
+Pages are requested over http with the cookies of the browser session, as
+many at once as the concurrency allows, and parsed with the same parsers
+and stored with the same code as the browser pages.
+"""
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from django.conf import settings
+from django.db import connections, transaction
+
+from .instagram import URL_INSTAGRAM, Instagram, InstagramError
+from .metrics import PAGES, THROTTLED, timed
+from .models import CrawlCursor, Post
+from .parsers import is_throttled, parse_post, parse_profile
+from .throttle import RateLimiter, ThrottledError
+
+logger = logging.getLogger(__name__)
+
+
+class FetchError(InstagramError):
+    """Page could not be fetched"""
+
+
+def session_cookies(account):
+    """Cookies saved from the browser as a plain name to value dict"""
+    if not account.cookies:
+        return {}
+    return {c['name']: c['value'] for c in json.loads(account.cookies)}
+
+
+class AsyncFetcher:
+    """Fetches and parses pages with a cap on the requests in flight"""
+
+    def __init__(self, account, concurrency=None, base_url=URL_INSTAGRAM):
+        self.account = account
+        self.concurrency = concurrency or settings.FETCH['concurrency']
+        self.base_url = base_url
+        self.session = None
+        self.semaphore = None
+        self.limiter = RateLimiter.for_account(account)
+        # the limiter keeps its buckets in the db, which is sync only
+        self.db_executor = ThreadPoolExecutor(max_workers=1)
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = aiohttp.ClientSession(
+            cookies=session_cookies(self.account),
+            headers={
+                'User-Agent': settings.FETCH['user_agent'],
+                'Accept-Language': 'en-US',
+            },
+            timeout=aiohttp.ClientTimeout(total=settings.FETCH['timeout']),
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.session.close()
+        await self.in_db_thread(connections.close_all)
+        self.db_executor.shutdown()
+
+    async def in_db_thread(self, func):
+        return await asyncio.get_running_loop().run_in_executor(self.db_executor, func)
+
+    async def get(self, path, params=None):
+        """Status and body of the page"""
+        async with self.semaphore:
+            if self.limiter:
+                with timed('rate_wait'):
+                    await self.in_db_thread(self.limiter.wait)
+            with timed('fetch'):
+                async with self.session.get(self.base_url + path, params=params) as response:
+                    status, body = response.status, await response.text()
+            PAGES.inc(page='http')
+            if self.limiter:
+                if status == 429 or is_throttled(body):
+                    THROTTLED.inc()
+                    await self.in_db_thread(self.limiter.throttled)
+                    raise ThrottledError(f'Throttled loading {path}')
+                await self.in_db_thread(self.limiter.clean)
+            return status, body
+
+    async def profile(self, username):
+        status, body = await self.get(f'/{username}/')
+        if status != 200:
+            raise FetchError(f'Profile {username} returned {status}')
+        with timed('parse'):
+            return parse_profile(body)
+
+    async def post(self, code):
+        status, body = await self.get(f'/p/{code}/')
+        if status == 404:
+            return {'deleted': True}
+        if status != 200:
+            raise FetchError(f'Post {code} returned {status}')
+        with timed('parse'):
+            return parse_post(body)
+
+    async def posts(self, codes):
+        """Parsed posts by code, or the exception when the post failed"""
+        results = await asyncio.gather(*(self.post(c) for c in codes), return_exceptions=True)
+        return dict(zip(codes, results))
+
+    async def timeline(self, user_id, after):
+        """Next page of post codes of the profile and the cursor after it"""
+        status, body = await self.get('/graphql/query/', params={
+            'query_hash': settings.FETCH['timeline_query_hash'],
+            'variables': json.dumps({'id': user_id, 'first': 50, 'after': after}),
+        })
+        if status != 200:
+            raise FetchError(f'Timeline of {user_id} returned {status}')
+        timeline = json.loads(body)['data']['user']['edge_owner_to_timeline_media']
+        page_info = timeline['page_info']
+        codes = [e['node']['shortcode'] for e in timeline['edges']]
+        return codes, page_info['end_cursor'] if page_info['has_next_page'] else None
+
+
+class HttpInstagram:
+    """Same upserts as `Instagram` without a browser"""
+
+    def __init__(self, account, concurrency=None, base_url=URL_INSTAGRAM):
+        self.account = account
+        self.loop = asyncio.new_event_loop()
+        self.fetcher = AsyncFetcher(account, concurrency, base_url)
+
+    def __enter__(self):
+        self.run(self.fetcher.__aenter__())
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.run(self.fetcher.__aexit__(exc_type, exc_val, exc_tb))
+        self.loop.close()
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def upsert_profile(self, account, check_posts=1000, backfill=False):
+        """Update profile
+
+        The backfill continues from the saved timeline cursor, so it does not
+        page through the posts it already has.
+        """
+        data = self.run(self.fetcher.profile(account.username))
+        if data['private']:
+            return account.delete()
+        Instagram.save_profile(account, data)
+        if backfill:
+            cursor = CrawlCursor.for_account(account)
+            codes = self.codes(data, after=cursor.end_cursor, cursor=cursor)
+            Instagram.backfill_codes(account, codes, check_posts, cursor=cursor)
+        else:
+            Instagram.save_codes(account, self.codes(data), check_posts)
+
+    def codes(self, data, after=None, cursor=None):
+        """Post codes of the profile, fetching the next page only when needed
+
+        The end_cursor of the cursor is moved past the pages of which every
+        code was handed out. It is left to the caller to save it together
+        with those codes.
+        """
+        if after is None:
+            yield from data['codes']
+            after = data['end_cursor']
+        while after and data['id']:
+            if cursor:
+                cursor.end_cursor = after
+            codes, after = self.run(self.fetcher.timeline(data['id'], after))
+            yield from codes
+
+    def upsert_posts(self, posts):
+        """Update posts concurrently
+
+        Yields each post with whether it changed and its error if any. The
+        pages are fetched first and the tags and locations saved, then the
+        posts are written in one transaction with a savepoint per post, so
+        the write lock is taken once per batch and a failing post only
+        skips itself. Deleted posts are removed after the batch commits.
+        """
+        results = self.run(self.fetcher.posts([p.code for p in posts]))
+        outcomes, changes, deleted = [], [], []
+        for post in posts:
+            data = results[post.code]
+            if isinstance(data, Exception):
+                outcomes.append((post, False, data))
+            elif data['deleted']:
+                deleted.append(post)
+            elif Post.fingerprint_of(data, data['media']) == post.fingerprint:
+                outcomes.append((post, False, None))
+            else:
+                try:
+                    changes.append((post, data, Instagram.save_related(data)))
+                except Exception as e:
+                    logger.exception(f'Failed saving tags and location of {post}')
+                    outcomes.append((post, False, e))
+
+        with timed('save_batch'), transaction.atomic():
+            for post, data, related in changes:
+                try:
+                    with transaction.atomic():
+                        # carousels are complete when the page has its json
+                        outcomes.append((post, Instagram.save_post(post, data, data['media'], related), None))
+                except Exception as e:
+                    logger.exception(f'Failed saving {post}')
+                    outcomes.append((post, False, e))
+
+        for post in deleted:
+            try:
+                post.delete()
+                outcomes.append((post, True, None))
+            except Exception as e:
+                logger.exception(f'Failed deleting {post}')
+                outcomes.append((post, False, e))
+        yield from outcomes
@@ -0,0 +1,65 @@
+"""
+Offline geocoding of locations
+
+Location names are looked up in a local gazetteer in the geonames format,
+e.g. cities15000.txt from download.geonames.org/export/dump/. The
+coordinates are kept on the location, so every name is resolved once.
+"""
+import csv
+import logging
+import os
+from functools import lru_cache
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# columns of the geonames dump
+NAME, ASCII_NAME, ALTERNATE_NAMES, LATITUDE, LONGITUDE, POPULATION = 1, 2, 3, 4, 5, 14
+
+
+@lru_cache(maxsize=2)
+def gazetteer(path):
+    """Coordinates and population of every place by its lowercase names"""
+    places = {}
+    if not os.path.exists(path):
+        logger.warning(f'No gazetteer at {path}, locations are not geocoded')
+        return places
+    with open(path, encoding='utf-8', newline='') as f:
+        for row in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+            place = float(row[LATITUDE]), float(row[LONGITUDE]), int(row[POPULATION] or 0)
+            names = {row[NAME], row[ASCII_NAME], *row[ALTERNATE_NAMES].split(',')}
+            for name in names:
+                name = name.lower().strip()
+                # the most populous place wins a shared name
+                if name and (name not in places or places[name][2] < place[2]):
+                    places[name] = place
+    logger.info(f'Loaded {len(places)} place names from {path}')
+    return places
+
+
+def resolve(name):
+    """Latitude and longitude of the location name, if in the gazetteer
+
+    The whole name is tried first, then its comma separated parts from the
+    most specific, e.g. "Bondi Beach, Sydney" resolves to Sydney.
+    """
+    places = gazetteer(settings.GAZETTEER)
+    parts = [p.lower().strip() for p in name.split(',')]
+    for candidate in [', '.join(parts)] + parts:
+        if candidate in places:
+            lat, lng, _ = places[candidate]
+            return lat, lng
+    return None
+
+
+def geocode(location):
+    """Set the coordinates of the location, names not found are not tried again"""
+    if location.geocoded or not os.path.exists(settings.GAZETTEER):
+        return location
+    point = resolve(location.name)
+    location.lat, location.lng = point or (None, None)
+    location.geocoded = True
+    location.save(update_fields=['lat', 'lng', 'geocoded'])
+    logger.info(f'Geocoded {location.name} to {point}')
+    return location
@@ -1,176 +1,197 @@
+"""
+Search over the accounts and posts
+
+The backend is set in settings.SEARCH_BACKEND and is only created and set
+up on first use, so importing this module does not touch a search server.
+"""
 import logging
-from itertools import chain
+import threading
 
+from django.conf import settings
+from django.core.signals import setting_changed
 from django.db.models.signals import post_delete
 from django.dispatch import receiver
-from elasticsearch_dsl import connections, Index, DocType, Integer, Keyword, Date, Text, FacetedSearch, TermsFacet
+from django.utils.module_loading import import_string
 
+from .cache import search_cache
+from .metrics import timed
 from .models import Account, Post
 
 logger = logging.getLogger(__name__)
-connections.create_connection(hosts=['localhost'], timeout=5)
 
 
 class InsightError(Exception):
     """exception for errors with insights"""
 
 
-###############################################################################
-# Account
-###############################################################################
+class BulkIndexError(InsightError):
+    """documents could not be indexed in bulk"""
 
-class AccountInsightError(InsightError):
-    """an error with account index"""
+    def __init__(self, message, post_pks=()):
+        super().__init__(message)
+        # posts without a current document
+        self.post_pks = list(post_pks)
 
 
-account_ix = Index('account')
-if not account_ix.exists():
-    account_ix.create()
+class SearchBackend:
+    """Interface of a search backend
 
+    Docs returned have the indexed fields as attributes.
+    """
 
-class AccountDoc(DocType):
-    username = Keyword(required=True, store=True)
-    posts_count = Integer(store=True)
-    followers_count = Integer(store=True)
-    following_count = Integer(store=True)
-    bio = Text(store=True)
-    website = Keyword(store=True)
-    joined_at = Date(store=True)
+    def setup(self):
+        """Create the indices when missing"""
 
-    # post
-    location = Keyword(store=True)
-    tags = Keyword(store=True)
-    count = Integer(store=True)
-    posted_at = Date(store=True)
+    def index_account(self, account):
+        raise NotImplementedError
 
-    class Meta:
-        index = 'account'
+    def index_post(self, post):
+        raise NotImplementedError
 
-    def __str__(self):
-        return f'AccountDoc {self.username}'
+    def remove_account(self, pk):
+        """Delete the account doc, returns if it was indexed"""
+        raise NotImplementedError
 
+    def remove_post(self, pk):
+        """Delete the post doc, returns if it was indexed"""
+        raise NotImplementedError
 
-AccountDoc.init()
+    def get_account(self, pk):
+        """Account doc, None when not indexed"""
+        raise NotImplementedError
 
+    def get_posts(self, pks):
+        """Post docs in the order of the pks, None for posts not indexed"""
+        raise NotImplementedError
 
-def index_account(account):
-    """Upsert account document"""
-    posts = account.posts.all()
-    doc = AccountDoc(
-        meta={'id': account.pk},
-        username=account.username,
-        posts_count=account.posts_count,
-        followers_count=account.followers_count,
-        following_count=account.following_count,
-        bio=account.bio,
-        website=account.website,
-        joined_at=account.created_at,
-
-        # post
-        # todo convert locations to geopoints
-        location=list(chain.from_iterable(p.location.parts() for p in posts if p.location)),
-        tags=[t.word.lower() for p in posts for t in p.tags.all()],
-        count=[p.count for p in posts if p.count],
-        posted_at=[p.created_at for p in posts],
-    )
-    logger.info(f'Indexing {doc}')
-    return doc.save()
-
-
-# def save_account_post_agg(account):
-#     """updates aggregated data from posts onto account doc"""
-#     writer = AsyncWriter(account_ix)
-#     writer.update_document(
-#         pk=str(account.pk),
-#     )
-#     writer.commit()
+    def account_facets(self):
+        """Top tags and locations over all accounts as (term, count, selected)"""
+        raise NotImplementedError
 
+    def post_heatmap(self, precision, bounds=None, account_pk=None):
+        raise InsightError(f'{type(self).__name__} has no geo aggregations')
 
-@receiver(post_delete, sender=Account)
-def remove_account(sender, instance, **kwargs):
-    """delete account and all the posts"""
-    account_doc = AccountDoc.get(instance.pk)
-    account_doc.delete()
-    logger.info(f'Deleted {account_doc}')
-    for post in instance:
-        post_doc = PostDoc.get(post.pk)
-        post_doc.delete()
-        logger.info(f'Deleted {post_doc}')
+    def account_heatmap(self, precision, bounds=None):
+        raise InsightError(f'{type(self).__name__} has no geo aggregations')
+
+    def indexer(self, **kwargs):
+        """Context manager buffering docs with `add_account` and `add_post`"""
+        raise NotImplementedError
 
 
-def get_account(account, **kwargs):
-    """Get account doc"""
-    return AccountDoc.get(account.pk, **kwargs)
+_backend = {}
+_backend_lock = threading.Lock()
 
 
-class AccountSearch(FacetedSearch):
-    index = ['account', ]
-    # doc type of result
-    doc_types = [AccountDoc, ]
-    # fields that should be searched
-    fields = ['tags', ]
+def backend():
+    """The configured backend, created and set up on first use"""
+    if 'current' not in _backend:
+        with _backend_lock:
+            if 'current' not in _backend:
+                options = dict(settings.SEARCH_BACKEND)
+                search = import_string(options.pop('class'))(**options)
+                search.setup()
+                logger.info(f'Search backend {type(search).__name__} ready')
+                _backend['current'] = search
+    return _backend['current']
 
-    facets = {
-        # use bucket aggregations to define facets
-        'tags': TermsFacet(field='tags'),
-        'locations': TermsFacet(field='location'),
-    }
 
-    # sort = []
+@receiver(setting_changed)
+def reset_backend(setting, **kwargs):
+    if setting == 'SEARCH_BACKEND':
+        _backend.clear()
+
+
+def with_post_relations(posts):
+    """Load what a post document needs with the posts queryset"""
+    return posts.select_related('location').prefetch_related('tags')
 
 
 ###############################################################################
-# Post
+# Account
 ###############################################################################
 
-post_ix = Index('post')
-if not post_ix.exists():
-    post_ix.create()
+def index_account(account):
+    """Upsert account document"""
+    logger.info(f'Indexing {account}')
+    with timed('index'):
+        created = backend().index_account(account)
+    search_cache.invalidate()
+    return created
 
 
-class PostDoc(DocType):
-    account_id = Integer(store=True)
-    code = Keyword(store=True)
-    location = Keyword(store=True)
-    tags = Keyword(store=True)
-    description = Text(store=True)
-    count = Integer(store=True)
-    kind = Keyword(store=True)
-    posted_at = Date(store=True)
+@receiver(post_delete, sender=Account)
+def remove_account(sender, instance, **kwargs):
+    """delete account, the posts are deleted by their cascade"""
+    if backend().remove_account(instance.pk):
+        search_cache.invalidate()
+        logger.info(f'Deleted doc of {instance}')
 
-    class Meta:
-        index = 'post'
 
-    def __str__(self):
-        return f'PostDoc {self.account_id} - {self.posted_at:%-d %b %Y}'
+def get_account(account):
+    """Get account doc, None when not indexed"""
+    return backend().get_account(account.pk)
 
 
-PostDoc.init()
+def account_facets():
+    """Tags and locations over all accounts, cached till the next index write"""
+    return search_cache.get_or_set('account_facets', {}, backend().account_facets)
 
 
+###############################################################################
+# Post
+###############################################################################
+
 def index_post(post):
-    doc = PostDoc(
-        meta={'id': post.pk},
-        account_id=post.account.pk,
-        code=post.code,
-        location=post.location.name.lower() if post.location else None,
-        tags=[t.word.lower() for t in post.tags.all()],
-        description=post.description,
-        count=post.count,
-        kind=post.kind,
-        posted_at=post.created_at,
-    )
-    logger.info(f'Indexing {doc}')
-    return doc.save()
+    logger.info(f'Indexing {post}')
+    with timed('index'):
+        created = backend().index_post(post)
+    search_cache.invalidate()
+    return created
 
 
 @receiver(post_delete, sender=Post)
 def delete_pst(sender, instance, **kwargs):
-    post_doc = PostDoc.get(instance.pk)
-    post_doc.delete()
-    logger.info(f'Deleted {post_doc}')
+    # posts can be deleted before they were ever indexed
+    if backend().remove_post(instance.pk):
+        search_cache.invalidate()
+        logger.info(f'Deleted doc of post {instance.pk}')
+
+
+def get_post(post):
+    """Get post record, None when not indexed"""
+    return get_posts([post])[0]
+
+
+def get_posts(posts):
+    """Get post records in one request, None for posts not indexed"""
+    if not posts:
+        return []
+    return backend().get_posts([p.pk for p in posts])
+
+
+def bulk_indexer(**kwargs):
+    """Bulk indexer of the backend"""
+    return backend().indexer(**kwargs)
+
+
+###############################################################################
+# Geo
+###############################################################################
+
+def post_heatmap(precision=5, bounds=None, account=None):
+    """Post counts per geohash cell, cached till the next index write
+
+    Bounds limit the map to (top, left, bottom, right).
+    """
+    account_pk = account.pk if account else None
+    params = {'precision': precision, 'bounds': bounds, 'account': account_pk}
+    return search_cache.get_or_set(
+        'post_heatmap', params, lambda: backend().post_heatmap(precision, bounds, account_pk))
 
 
-def get_post(post, **kwargs):
-    """Get post record"""
-    return PostDoc.get(post.pk, **kwargs)
+def account_heatmap(precision=5, bounds=None):
+    """Account counts per geohash cell of the places they posted from"""
+    params = {'precision': precision, 'bounds': bounds}
+    return search_cache.get_or_set(
+        'account_heatmap', params, lambda: backend().account_heatmap(precision, bounds))
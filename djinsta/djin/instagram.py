@@ -1,56 +1,47 @@
 import json
-import re
+import logging
 import time
-from urllib.parse import urlparse
 
 from django.conf import settings
-from django.utils.dateparse import parse_datetime
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException, TimeoutException
+from django.db import transaction
+from selenium.common.exceptions import NoSuchElementException, TimeoutException, WebDriverException
 from selenium.webdriver import ActionChains
-from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.support.wait import WebDriverWait
 
-from .models import Account, Post, Tag, Location, Media
+from .browser import apply_preset, create_pool
+from .geo import geocode
+from .metrics import PAGES, THROTTLED, timed
+from .models import CrawlCursor, Post, Tag, Location, Media
+from .parsers import InstagramError, is_throttled, parse_post, parse_profile
+from .throttle import RateLimiter, ThrottledError
+
+logger = logging.getLogger(__name__)
 
 URL_INSTAGRAM = 'https://www.instagram.com'
 
+driver_pool = create_pool(URL_INSTAGRAM)
 
-class InstagramError(Exception):
-    """Instagram errors"""
+BACKFILL_FIELDS = ['oldest_code', 'end_cursor', 'backfilled', 'updated_at']
 
 
 class Instagram:
 
     def __init__(self, account):
         self.account = account
-
-        options = Options()
-        options.add_argument('--dns-prefetch-disable')
-        options.add_argument('--no-sandbox')
-        options.add_argument('--lang=en-US')
-        options.add_argument('--disable-setuid-sandbox')
-        chrome_prefs = {
-            'intl.accept_languages': 'en-US',
-        }
-        options.add_experimental_option('prefs', chrome_prefs)
-        self.driver = webdriver.Chrome(settings.BROWSER_CHROME, chrome_options=options)
+        # warm browser with the account cookies loaded
+        self.driver = driver_pool.acquire(account)
+        # page loads are paced over all workers
+        self.limiter = RateLimiter.for_account(account)
 
         # set waiting on elements to load
         # self.driver.implicitly_wait(5)
 
-        # load cookies
-        if account.cookies:
-            cookies = json.loads(account.cookies)
-            self.driver.get(URL_INSTAGRAM)
-            for cookie in cookies:
-                self.driver.add_cookie(cookie)
-
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.driver.quit()
+        # a browser that failed might be in any state
+        driver_pool.release(self.driver, discard=isinstance(exc_val, WebDriverException))
 
     def login(self):
         """Log account in on login page"""
@@ -61,73 +52,173 @@ class Instagram:
             self.account.cookies = json.dumps(self.driver.get_cookies())
             self.account.save()
 
-    def upsert_profile(self, account, check_posts=1000):
-        """Update profile"""
-        page = ProfilePage(self.driver, account.username)
-        if page.is_private():
+    def upsert_profile(self, account, check_posts=1000, backfill=False):
+        """Update profile
+
+        Collects new posts, or with backfill older posts where the last
+        backfill stopped.
+        """
+        page = ProfilePage(self.driver, account.username, self.limiter)
+        data = page.snapshot()
+        if data['private']:
             return account.delete()
+        self.save_profile(account, data)
+        if backfill:
+            self.backfill_codes(account, page.posts, check_posts)
+        else:
+            self.save_codes(account, page.posts, check_posts)
 
+    def upsert_post(self, post):
+        """Update information from post, returns if the post changed"""
+        # posts can be deleted
+        page = PostPage(self.driver, post.code, self.limiter)
+        data = page.snapshot()
+        if data['deleted']:
+            return post.delete()
+
+        start = time.monotonic()
+        if data['media'] is not None:
+            media, source = data['media'], 'json'
+        else:
+            # without the page json the carousel has to be read from the dom
+            with timed('dom_media'):
+                media, source = page.media, 'dom'
+        logger.info(f'Read {len(media)} media of {post} from {source} in {time.monotonic() - start:.2f}s')
+        return self.save_post(post, data, media)
+
+    @staticmethod
+    @timed('save_profile')
+    def save_profile(account, data):
+        """Store the parsed profile fields on the account"""
         # upsert counts
-        account.posts_count = page.posts_count
-        account.followers_count = page.followers_count
-        account.following_count = page.following_count
-        account.bio = page.bio
-        account.website = page.website
+        account.posts_count = data['posts_count']
+        account.followers_count = data['followers_count']
+        account.following_count = data['following_count']
+        account.bio = data['bio']
+        account.website = data['website']
         account.save()
 
-        # upsert posts
-        for i, code in enumerate(page.posts):
+    @staticmethod
+    def save_codes(account, codes, check_posts=1000):
+        """Create posts for new codes, newest first, till a known post"""
+        cursor = CrawlCursor.for_account(account)
+        seen = []
+        for i, code in enumerate(codes):
             # only check a limited amount of posts per user
-            if i >= check_posts:
+            if i >= check_posts or code == cursor.newest_code:
                 break
             # upsert post
-            post, created = Post.objects.update_or_create(
-                account=account,
-                code=code,
-            )
+            with timed('save_code'):
+                post, created = Post.objects.update_or_create(
+                    account=account,
+                    code=code,
+                )
             # till existing post found
             if not created:
                 break
+            seen.append(code)
+        if seen:
+            cursor.newest_code = seen[0]
+            # the first crawl also sets where the backfill starts
+            cursor.oldest_code = cursor.oldest_code or seen[-1]
+            cursor.save()
+        logger.info(f'Found {len(seen)} new posts with {cursor}')
+        return len(seen)
+
+    @staticmethod
+    def backfill_codes(account, codes, max_posts=1000, checkpoint=100, cursor=None):
+        """Create posts older than the known posts
+
+        Known codes are skipped without queries and the cursor is saved with
+        every batch of new posts, so a failed run loses at most one batch.
+        A code source paging with a timeline cursor moves the end_cursor of
+        the given cursor, which is saved in the same commit as the batch.
+        """
+        cursor = cursor or CrawlCursor.for_account(account)
+        known = set(account.posts.values_list('code', flat=True))
+        batch = []
+        created = 0
+
+        @timed('save_codes')
+        def save_batch():
+            with transaction.atomic():
+                Post.objects.bulk_create(batch)
+                cursor.oldest_code = batch[-1].code
+                cursor.save(update_fields=BACKFILL_FIELDS)
+
+        for code in codes:
+            if code in known:
+                continue
+            known.add(code)
+            batch.append(Post(account=account, code=code))
+            created += 1
+            if len(batch) >= checkpoint:
+                save_batch()
+                batch = []
+            if created >= max_posts:
+                break
+        else:
+            # ran out of posts, so the first post of the account is reached
+            cursor.backfilled = True
+
+        if batch:
+            save_batch()
+        else:
+            cursor.save(update_fields=BACKFILL_FIELDS)
+        logger.info(f'Backfilled {created} posts with {cursor}')
+        return created
+
+    @staticmethod
+    @timed('save_post')
+    def save_post(post, data, media=None, related=None):
+        """Store the parsed post fields, media is left as is when None
+
+        Nothing is written when the fingerprint of the fields is the same as
+        the last time. The tags and location from `save_related` are saved
+        first when not given. Returns if the post changed.
+        """
+        fingerprint = Post.fingerprint_of(data, media)
+        if fingerprint == post.fingerprint:
+            return False
+        tag_pks, location = related or Instagram.save_related(data)
+
+        with transaction.atomic():
+            # the media seems to move around on the vpn, will have to update it
+            # with every update and remove the duplicate old rows
+            if media is not None:
+                Media.objects.bulk_create([
+                    Media(
+                        post=post, kind=m['kind'], source=m['source'],
+                        size=m.get('size'), poster=m.get('poster'), extension=m.get('extension'))
+                    for m in media
+                ], ignore_conflicts=True)
+                post.media.exclude(source__in=[m['source'] for m in media]).delete()
+
+            post.fingerprint = fingerprint
+            post.count, post.kind = data['popularity']
+            post.created_at = data['created_at']
+            post.description = data['description']
+            if location:
+                post.location = location
+            post.tags.set(tag_pks)
+            post.save()
+        return True
 
-    def upsert_post(self, post):
-        """Update information from post"""
-        # posts can be deleted
-        page = PostPage(self.driver, post.code)
-        if page.is_deleted():
-            return post.delete()
-
-        post.count, post.kind = page.popularity
-        post.created_at = page.created_at
-        post.description = page.description
-        loc_code, loc_name = page.location
-
-        # the media seems to move around on the vpn, will have to update it
-        # with every update and remove the duplicate old rows
-        previous_pks = [m.pk for m in post.media.all()]
-        current_pks = []
-        for media_item in page.media:
-            media, created = Media.objects.get_or_create(
-                post=post, kind=media_item['kind'], source=media_item['source'],
-                defaults={
-                    'size': media_item.get('size'),
-                    'poster': media_item.get('poster'),
-                    'extension': media_item.get('extension')
-                })
-            current_pks.append(media.pk)
-        redundant_pks = set(previous_pks) - set(current_pks)
-        if redundant_pks:
-            Media.objects.filter(pk__in=redundant_pks).delete()
+    @staticmethod
+    def save_related(data):
+        """Tag pks and location of the post, saved apart from the post
 
+        Tags and locations are shared between posts, so they are kept even
+        when the post rolls back, and the gazetteer is read without holding
+        the write lock of the post.
+        """
+        tag_pks = Tag.resolve(data['tags'])
+        loc_code, loc_name = data['location']
+        location = None
         if loc_code:
-            location, created = Location.objects.get_or_create(
-                code=loc_code, name=loc_name)
-            post.location = location
-        tags = []
-        for tag_item in page.tags:
-            tag, created = Tag.objects.get_or_create(word=tag_item)
-            tags.append(tag)
-        post.tags.set(tags)
-        post.save()
+            location, created = Location.objects.get_or_create(code=loc_code, defaults={'name': loc_name})
+            geocode(location)
+        return tag_pks, location
 
 
 ########################################################################################
@@ -136,29 +227,47 @@ class Instagram:
 
 class BasePage:
 
-    def __init__(self, driver, param=''):
-        self.driver = driver
-        self.driver.get(self.URL_PATTERN.format(param))
-
-    def _parse_number(self, number):
-        """
-        Parses the number. Remove the unused comma. Replace the concatenation with relevant zeros. Remove the dot.
+    # parses the page source into a dict of fields
+    PARSER = None
+    # resources blocked while loading, see BROWSER_PRESETS
+    PRESET = None
 
-        :param number: str
+    def __init__(self, driver, param='', limiter=None):
+        self.driver = driver
+        if self.PRESET:
+            apply_preset(self.driver, self.PRESET)
+        if limiter:
+            with timed('rate_wait'):
+                limiter.wait()
+        with timed('page_load'):
+            self.driver.get(self.URL_PATTERN.format(param))
+        PAGES.inc(page=self.PRESET)
+        self._source = None
+        self._snapshot = None
+        if limiter:
+            if self.is_throttled():
+                THROTTLED.inc()
+                limiter.throttled()
+                raise ThrottledError(f'Throttled loading {self.URL_PATTERN.format(param)}')
+            limiter.clean()
+
+    def is_throttled(self):
+        """is instagram refusing to serve the page"""
+        return is_throttled(self.source)
 
-        :return: int
-        """
-        formatted_num = number.replace(',', '')
-        formatted_num = re.sub(r'(k)$', '00' if '.' in formatted_num else '000', formatted_num)
-        formatted_num = re.sub(r'(m)$', '00000' if '.' in formatted_num else '000000', formatted_num)
-        formatted_num = formatted_num.replace('.', '')
-        return int(formatted_num)
+    @property
+    def source(self):
+        """The page source as loaded"""
+        if self._source is None:
+            self._source = self.driver.page_source
+        return self._source
 
-    def _parse_tags(self, sentence):
-        """Parses the sentences for hashtags and returns a list"""
-        if not sentence:
-            return []
-        return [t.lower() for t in re.findall(r'#(\w+)', sentence)]
+    def snapshot(self):
+        """All fields parsed from a single copy of the page source"""
+        if self._snapshot is None:
+            with timed('parse'):
+                self._snapshot = self.PARSER(self.source)
+        return self._snapshot
 
 
 # location feed
@@ -169,108 +278,87 @@ class BasePage:
 # Post page
 ########################################################################################
 
-class PostPageError(InstagramError):
-    """Error on post page"""
+MEDIA_CHEVRON = '//article/div/div//a[contains(concat(" ",normalize-space(@class)," ")," coreSpriteRightChevron ")]'
+
+# every loaded image and video in the media container, in carousel order
+MEDIA_SCRIPT = """
+var container = document.querySelector('article > div');
+if (!container) { return []; }
+var items = [];
+container.querySelectorAll('video, img[srcset]').forEach(function (el) {
+    if (el.tagName === 'VIDEO') {
+        if (el.src) {
+            items.push({kind: 'vid', source: el.src, poster: el.poster, extension: el.type || null});
+        }
+    } else if (el.srcset) {
+        var candidates = el.srcset.split(',');
+        var source = candidates[candidates.length - 1].trim().split(' ')[0];
+        items.push({kind: 'img', source: source, srcset: el.srcset});
+    }
+});
+return items;
+"""
 
 
 class PostPage(BasePage):
 
     URL_PATTERN = URL_INSTAGRAM + '/p/{}'
-
-    def is_deleted(self):
-        """is post deleted"""
-        try:
-            self.driver.find_element_by_xpath('//h2[text()="Sorry, this page isn\'t available."]')
-        except NoSuchElementException:
-            return False
-        return True
-
-
-    @property
-    def created_at(self):
-        return parse_datetime(
-            self.driver.find_element_by_xpath('//time').get_attribute('datetime'))
-
-    @property
-    def username(self):
-        return self.driver.find_element_by_xpath('//article/header/div/div/div/a').text
-
-    @property
-    def popularity(self):
-        # todo fix: 'charityflock, veneration_helensvale, ilove_relaxx, angislon, kuldeep_singh.solanki, hayley_brown6, mardanjahya111 and martadziak like this'
-        sentence = self.driver.find_element_by_xpath('//article/div/section/div').text
-        words = sentence.split(' ')
-        try:
-            count = self._parse_number(words[0])
-        except ValueError:
-            return None, None
-        kind = words[1]
-        return count, kind
+    PARSER = staticmethod(parse_post)
+    PRESET = 'post'
+    # seconds to wait for the next carousel item after a click
+    MEDIA_WAIT = 5
 
     @property
+    @timed('element_lookup')
     def media_container(self):
         return self.driver.find_element_by_xpath('//article/div[1]/div')
 
     @property
+    @timed('element_lookup')
     def media_chevron(self):
-        return self.driver.find_element_by_xpath(
-            '//article/div/div//a[contains(concat(" ",normalize-space(@class)," ")," coreSpriteRightChevron ")]')
+        return self.driver.find_element_by_xpath(MEDIA_CHEVRON)
 
     @property
     def media(self):
-        """return the media sources"""
-        media = []
+        """return the media sources
+
+        Reads every carousel item already in the dom in one script call and
+        only clicks on for items that are not loaded yet, waiting for them
+        to appear instead of pausing. Stops when a click brings no new item.
+        """
+        media = {}
+
+        def new_items(driver):
+            items = [i for i in driver.execute_script(MEDIA_SCRIPT) if i['source'] not in media]
+            return items or None
+
+        # a single image or video can still be loading its sources
+        for item in WebDriverWait(self.driver, 10, poll_frequency=0.1).until(new_items):
+            media[item['source']] = item
         while True:
             try:
-                vid = self.driver.find_element_by_xpath('//article//video')
-                src = vid.get_attribute('src')
-                poster = vid.get_attribute('poster')
-                extension = vid.get_attribute('type')
-                media.append({'kind': Media.VID, 'source': src, 'poster': poster, 'extension': extension})
+                chevron = self.media_chevron
             except NoSuchElementException:
-                # sometimes the srcset is not loaded yet
-                WebDriverWait(self.driver, 10).until(
-                    lambda driver: driver.find_element_by_xpath(
-                        '//article/div[1]/div/div//div[1]/img').get_attribute('srcset')
-                )
-                img = self.driver.find_element_by_xpath('//article/div[1]/div/div//div[1]/img')
-                src = [s.strip() for s in img.get_attribute('srcset').split(',')][-1]
-                src, size = src.split(' ')
-                media.append({'kind': Media.IMG, 'source': src, 'size': int(size[:-1])})
-            # next image
+                break
+            ActionChains(self.driver).move_to_element(self.media_container).click(chevron).perform()
             try:
-                ActionChains(self.driver).move_to_element(
-                    self.media_container).pause(1).click(
-                    self.media_chevron).perform()
-            except NoSuchElementException:
+                # either the next item loads or the chevron goes away on the last item
+                WebDriverWait(self.driver, self.MEDIA_WAIT, poll_frequency=0.1).until(
+                    lambda driver: new_items(driver) or not driver.find_elements_by_xpath(MEDIA_CHEVRON))
+            except TimeoutException:
+                # the chevron stays but nothing loads, clicking on would not end
+                logger.warning(f'No new media after a click, read {len(media)}')
                 break
-        return media
-
-    @property
-    def description(self):
-        """If no description there would be no comment"""
-        try:
-            return self.driver.find_element_by_xpath(
-                f'//article//ul/li//*[contains(text(), "{self.username}")]/following-sibling::span').text
-        except NoSuchElementException:
-            return
-
-    @property
-    def tags(self):
-        """Return parsed tags from description"""
-        return self._parse_tags(self.description)
-
-    @property
-    def location(self):
-        """Return id and location name"""
-        try:
-            loc = self.driver.find_element_by_xpath('//article/header/div[2]/div[2]/a')
-        except NoSuchElementException:
-            return None, None
-        code = re.search(r'locations/(\d+)', loc.get_attribute('href')).groups()[0]
-        name = loc.text
-        return code, name
+            for item in new_items(self.driver) or []:
+                media[item['source']] = item
+        return [self._media_item(i) for i in media.values()]
 
+    def _media_item(self, item):
+        if item['kind'] == Media.VID:
+            return item
+        # largest image of the srcset
+        src, size = item['srcset'].split(',')[-1].strip().split(' ')
+        return {'kind': Media.IMG, 'source': src, 'size': int(size[:-1])}
 
 ########################################################################################
 # Profile page
@@ -280,78 +368,69 @@ class ProfilePageError(InstagramError):
     """Error on profile page"""
 
 
-class ProfilePage(BasePage):
+# codes of the post links not harvested before, remembering at most a cap
+# of codes in the page
+HARVEST_SCRIPT = """
+var cap = arguments[0];
+var seen = window.djinHarvested = window.djinHarvested || {codes: new Set(), order: []};
+var fresh = [];
+document.querySelectorAll('a[href^="/p/"]').forEach(function (a) {
+    var match = a.getAttribute('href').match(/^\\/p\\/([^\\/]+)\\//);
+    if (match && !seen.codes.has(match[1])) {
+        seen.codes.add(match[1]);
+        seen.order.push(match[1]);
+        fresh.push(match[1]);
+    }
+});
+if (seen.order.length > cap) {
+    seen.order.splice(0, seen.order.length - cap).forEach(function (code) { seen.codes.delete(code); });
+}
+return fresh;
+"""
+
+SCROLL_SCRIPT = """
+var container = document.querySelector('article');
+container.scrollTop = container.scrollHeight;
+"""
 
-    URL_PATTERN = URL_INSTAGRAM + '/{}'
-
-    def is_private(self):
-        """some accounts are private"""
-        try:
-            self.driver.find_element_by_xpath('//h2[text()="This Account is Private"]')
-        except NoSuchElementException:
-            return False
-        return True
 
-    @property
-    def posts_count(self):
-        return self._parse_number(
-            self.driver.find_element_by_xpath("//ul/li[1]/span/span").text
-        )
-
-    @property
-    def followers_count(self):
-        return self._parse_number(
-            self.driver.find_element_by_xpath("//ul/li[2]/a/span").text
-        )
-
-    @property
-    def following_count(self):
-        return self._parse_number(
-            self.driver.find_element_by_xpath("//ul/li[3]/a/span").text
-        )
-
-    @property
-    def bio(self):
-        try:
-            return self.driver.find_element_by_xpath("//article/header//div[2]/span").text
-        except NoSuchElementException:
-            pass
-
-    @property
-    def website(self):
-        try:
-            return self.driver.find_element_by_xpath("//article/header//div[2]/a").text
-        except NoSuchElementException:
-            pass
-
-    @property
-    def container(self):
-        return self.driver.find_element_by_xpath('//article')
+class ProfilePage(BasePage):
 
-    @property
-    def links(self):
-        return self.driver.find_elements_by_xpath('//a[starts-with(@href, "/p/")]')
+    URL_PATTERN = URL_INSTAGRAM + '/{}'
+    PARSER = staticmethod(parse_profile)
+    PRESET = 'profile'
+    # seconds to wait for new links after a scroll
+    HARVEST_WAIT = 5
 
     @property
+    @timed('element_lookup')
     def spinner(self):
         return self.driver.find_elements_by_xpath('//article/div[2]')
 
     @property
     def posts(self):
-        """Generator for the links of the posts"""
-        counter = 0
+        """Generator for the links of the posts
+
+        The page collects the codes of new links itself and hands them over
+        in one batch per scroll, so every link costs a single round trip no
+        matter how deep the profile is scrolled.
+        """
+        cap = settings.HARVEST_PAGE_CAP
+        # the page forgets old codes beyond its cap and can hand them over
+        # again, so only codes not yielded yet count as new
+        yielded = set()
+        harvest = lambda driver: [c for c in driver.execute_script(HARVEST_SCRIPT, cap) if c not in yielded]
+        with timed('harvest'):
+            batch = harvest(self.driver)
         while True:
-            if len(self.links) == counter:
-                break
-            for link in self.links[counter:]:
-                counter += 1
-                url = urlparse(link.get_attribute('href'))
-                matches = re.match(r'/p/(.*)/', url.path)
-                yield matches.groups(0)[0]
-            self.driver.execute_script('arguments[0].scrollTop = arguments[0].scrollHeight', self.container)
+            for code in batch:
+                if code not in yielded:
+                    yielded.add(code)
+                    yield code
+            self.driver.execute_script(SCROLL_SCRIPT)
             try:
-                WebDriverWait(self.driver, 5).until(
-                    lambda driver: len(self.links) != counter)
+                with timed('harvest'):
+                    batch = WebDriverWait(self.driver, self.HARVEST_WAIT, poll_frequency=0.2).until(harvest)
             except TimeoutException:
                 # no new elements, so is spinner gone?
                 if not self.is_spinner_gone():
@@ -378,6 +457,7 @@ class LoginPageError(InstagramError):
 class LoginPage(BasePage):
 
     URL_PATTERN = URL_INSTAGRAM
+    PRESET = 'login'
 
     @property
     def login_link(self):
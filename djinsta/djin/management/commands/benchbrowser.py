@@ -0,0 +1,53 @@
+import statistics
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from djin.browser import build_driver, apply_preset
+from djin.instagram import URL_INSTAGRAM
+
+# load time of the document and bytes over the wire of it and its resources
+PERFORMANCE_SCRIPT = """
+var nav = performance.getEntriesByType('navigation')[0];
+var bytes = nav.transferSize;
+performance.getEntriesByType('resource').forEach(function (r) { bytes += r.transferSize; });
+return {seconds: nav.loadEventEnd / 1000, bytes: bytes};
+"""
+
+
+class Command(BaseCommand):
+    help = 'Compare page load time and bytes transferred of the browser presets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', help='profile to load')
+        parser.add_argument('codes', nargs='*', help='posts to load')
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        urls = {'profile': [f'{URL_INSTAGRAM}/{options["username"]}/']}
+        urls['post'] = [f'{URL_INSTAGRAM}/p/{code}/' for code in options['codes']]
+        # every page type without blocking as the baseline
+        presets = {'none': []}
+        presets.update((name, preset['block']) for name, preset in settings.BROWSER_PRESETS.items())
+
+        driver = build_driver()
+        try:
+            self.stdout.write(f'{"page":8} {"preset":8} {"blocked":24} {"median s":>9} {"median kB":>10}')
+            for page, page_urls in urls.items():
+                for preset, blocked in presets.items():
+                    if not page_urls or preset not in ('none', page):
+                        continue
+                    apply_preset(driver, preset, blocked)
+                    results = [self.measure(driver, url) for url in page_urls for _ in range(options['repeat'])]
+                    self.stdout.write(
+                        f'{page:8} {preset:8} {",".join(blocked) or "-":24} '
+                        f'{statistics.median(r["seconds"] for r in results):9.2f} '
+                        f'{statistics.median(r["bytes"] for r in results) / 1024:10.0f}')
+        finally:
+            driver.quit()
+
+    def measure(self, driver, url):
+        # cached resources would not count as transferred
+        driver.execute_cdp_cmd('Network.clearBrowserCache', {})
+        driver.get(url)
+        return driver.execute_script(PERFORMANCE_SCRIPT)
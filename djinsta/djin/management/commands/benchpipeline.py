@@ -0,0 +1,67 @@
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from djin.bench import environment, run
+
+
+class Command(BaseCommand):
+    help = 'Benchmark crawling, parsing, storing and indexing on replayed pages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help='posts per account')
+        parser.add_argument('--profile', help='recorded profile page to replay')
+        parser.add_argument('--post', help='recorded post page to replay for every post')
+        parser.add_argument('--output', help='json file for the results')
+        parser.add_argument('--compare', help='json file of an earlier run to compare with')
+
+    def handle(self, *args, **options):
+        profile, post = (self.read(options[name]) for name in ('profile', 'post'))
+        results = {**environment(), 'runs': {}}
+        for size in options['sizes']:
+            self.stdout.write(f'Running {size} posts')
+            results['runs'][str(size)] = run(size, profile, post)
+            self.report(results['runs'][str(size)])
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                self.compare(json.load(f), results)
+
+        output = options['output'] or os.path.join(
+            settings.BASE_DIR, 'benchmarks', f'pipeline-{results["commit"] or "local"}.json')
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'Saved results to {output}'))
+
+    def read(self, path):
+        if not path:
+            return None
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+
+    def report(self, result):
+        self.stdout.write(
+            f'{result["posts"]} posts in {result["seconds"]}s, {result["pages_per_second"]} pages/s, '
+            f'{result["queries_per_post"]} queries/post')
+        self.stdout.write(f'  {"stage":8} {"count":>7} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} {"max ms":>9}')
+        for stage, p in result['stages'].items():
+            self.stdout.write(
+                f'  {stage:8} {p["count"]:7} {p["p50"]:9.3f} {p["p90"]:9.3f} {p["p99"]:9.3f} {p["max"]:9.3f}')
+
+    def compare(self, before, after):
+        """Change of the median of every stage, and of the throughput"""
+        self.stdout.write(f'Compared with {before.get("commit")}')
+        for size, run_after in after['runs'].items():
+            run_before = before['runs'].get(size)
+            if not run_before:
+                continue
+            changes = [
+                f'{stage} {p["p50"] / run_before["stages"][stage]["p50"] - 1:+.0%}'
+                for stage, p in run_after['stages'].items()
+                if run_before['stages'].get(stage, {}).get('p50')
+            ]
+            speed = run_after['pages_per_second'] / run_before['pages_per_second'] - 1
+            self.stdout.write(f'  {size} posts: pages/s {speed:+.0%}, p50 ' + ', '.join(changes))
@@ -0,0 +1,57 @@
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from djin.bench import environment, write_run
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the post writes of concurrent workers on the configured database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=2000, help='posts written per run')
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 4], help='concurrent writers')
+        parser.add_argument('--batches', type=int, nargs='+', default=[1, 50], help='posts per transaction')
+        parser.add_argument('--output', help='json file for the results')
+        parser.add_argument('--compare', help='json file of an earlier run, e.g. on the other database')
+
+    def handle(self, *args, **options):
+        results = {**environment(), 'runs': {}}
+        for workers in options['workers']:
+            for batch in options['batches']:
+                self.stdout.write(f'Writing {options["posts"]} posts with {workers} workers, {batch} per transaction')
+                result = write_run(options['posts'], workers, batch)
+                results['runs'][f'{workers}x{batch}'] = result
+                self.report(result)
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                self.compare(json.load(f), results)
+
+        output = options['output'] or os.path.join(
+            settings.BASE_DIR, 'benchmarks', f'writes-{results["database"]}-{results["commit"] or "local"}.json')
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'Saved results to {output}'))
+
+    def report(self, result):
+        save = result['stages'].get('save')
+        transaction = result['stages'].get('transaction')
+        self.stdout.write(
+            f'  {result["posts_per_second"]} posts/s in {result["seconds"]}s, {result["locked"]} locked, '
+            f'save p50 {save["p50"] if save else "-"}ms p99 {save["p99"] if save else "-"}ms, '
+            f'transaction p99 {transaction["p99"] if transaction else "-"}ms')
+
+    def compare(self, before, after):
+        """Change of the throughput of every run"""
+        self.stdout.write(f'Compared with {before.get("database")} at {before.get("commit")}')
+        for key, run_after in after['runs'].items():
+            run_before = before['runs'].get(key)
+            if not run_before or not run_before['posts_per_second']:
+                continue
+            speed = run_after['posts_per_second'] / run_before['posts_per_second'] - 1
+            self.stdout.write(
+                f'  {key}: posts/s {run_before["posts_per_second"]} -> {run_after["posts_per_second"]} ({speed:+.0%})')
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from djin.geo import geocode
+from djin.models import Location
+
+
+class Command(BaseCommand):
+    help = 'Geocode the locations saved before they were geocoded on save'
+
+    def handle(self, *args, **options):
+        locations = Location.objects.filter(geocoded=False)
+        for location in locations.iterator():
+            geocode(location)
+        found = Location.objects.filter(lat__isnull=False).count()
+        self.stdout.write(self.style.SUCCESS(f'{found} of {Location.objects.count()} locations geocoded'))
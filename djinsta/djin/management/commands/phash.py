@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from djin.models import Media
+from djin.phash import hash_images
+
+
+class Command(BaseCommand):
+    help = 'Hash the stored images saved before they were hashed on download'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=1000, help='images hashed per query')
+
+    def handle(self, *args, **options):
+        images = Media.objects.filter(
+            kind=Media.IMG, local_path__isnull=False, phash__isnull=True).order_by('pk')
+        hashed, last_pk = 0, 0
+        while True:
+            batch = list(images.filter(pk__gt=last_pk)[:options['batch']])
+            if not batch:
+                break
+            hashed += len(hash_images(batch))
+            last_pk = batch[-1].pk
+        self.stdout.write(self.style.SUCCESS(f'{hashed} images hashed'))
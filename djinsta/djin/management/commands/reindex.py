@@ -0,0 +1,64 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from djin.elastic import (
+    ACCOUNT_ALIAS, POST_ALIAS, ElasticBackend, bulk_load, current_version, put_layout, switch_layout)
+from djin.insight import BulkIndexError, backend, bulk_indexer, with_post_relations
+from djin.models import Account, Post
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Reindex all accounts and posts with the bulk api'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, help='documents per bulk request')
+        parser.add_argument('--chunk', type=int, default=2000, help='rows fetched per query')
+        parser.add_argument(
+            '--zero-downtime', action='store_true',
+            help='load a new version of the indices and switch the aliases to it when done')
+
+    def handle(self, *args, **options):
+        elastic = isinstance(backend(), ElasticBackend)
+        if options['zero_downtime'] and not elastic:
+            raise CommandError('Zero downtime reindexing needs the elasticsearch backend')
+
+        if options['zero_downtime']:
+            old = current_version()
+            new = (old or 0) + 1
+            self.stdout.write(f'Loading version {new} of the indices')
+            # not aliased and not refreshed till the switch
+            put_layout(new, aliased=False, refresh_interval='-1')
+            indexer = self.load(options, version=new)
+            switch_layout(old, new)
+        elif elastic:
+            with bulk_load(POST_ALIAS, ACCOUNT_ALIAS):
+                indexer = self.load(options)
+        else:
+            indexer = self.load(options)
+        self.stdout.write(self.style.SUCCESS(f'Reindexed with {indexer}'))
+
+    def load(self, options, version=None):
+        size = {'size': options['size']} if options['size'] else {}
+        try:
+            with bulk_indexer(**size) as indexer:
+                for post in self.iterate(with_post_relations(Post.objects.all()), options['chunk']):
+                    indexer.add_post(post, version)
+                for account in self.iterate(Account.objects.all(), options['chunk']):
+                    indexer.add_account(account, version)
+        except BulkIndexError as e:
+            # an incomplete version is not switched to
+            raise CommandError(f'Reindex incomplete: {e}')
+        return indexer
+
+    def iterate(self, queryset, chunk):
+        """Walk the table in primary key order without loading it at once"""
+        last_pk = 0
+        while True:
+            rows = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:chunk])
+            if not rows:
+                break
+            yield from rows
+            last_pk = rows[-1].pk
@@ -0,0 +1,190 @@
+"""
+Timings and counters of the crawls
+
+Every process keeps its own histograms and counters, and serves them in
+the prometheus text format. A run of an account also gets a summary of
+where its time went, which is logged when the run ends.
+"""
+import contextvars
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# seconds, from an element lookup to a whole run
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{n}="{v}"' for n, v in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        with self._lock:
+            self._values[key] += amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels[n] for n in self.labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f'{self.name}_total{_labels(self.labels, key)} {value:g}'
+
+
+class Histogram:
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # counts per bucket, then the sum and the count
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        with self._lock:
+            counts = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def count(self, **labels):
+        counts = self._values.get(tuple(labels[n] for n in self.labels))
+        return counts[-1] if counts else 0
+
+    def samples(self):
+        with self._lock:
+            values = {k: list(v) for k, v in self._values.items()}
+        names = self.labels + ('le',)
+        for key, counts in sorted(values.items()):
+            for bound, count in zip(self.buckets, counts):
+                yield f'{self.name}_bucket{_labels(names, key + (f"{bound:g}",))} {count}'
+            yield f'{self.name}_bucket{_labels(names, key + ("+Inf",))} {counts[-1]}'
+            yield f'{self.name}_sum{_labels(self.labels, key)} {counts[-2]:g}'
+            yield f'{self.name}_count{_labels(self.labels, key)} {counts[-1]}'
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the prometheus text format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram('djin_stage_seconds', 'Seconds spent per stage of a crawl', ('stage',))
+RUN_SECONDS = registry.histogram('djin_run_seconds', 'Seconds of a whole run of an account')
+PAGES = registry.counter('djin_pages', 'Pages loaded by page type', ('page',))
+POSTS = registry.counter('djin_posts', 'Posts refreshed by result', ('result',))
+THROTTLED = registry.counter('djin_throttled', 'Pages refused for scraping too fast')
+
+
+###############################################################################
+# Runs
+###############################################################################
+
+class RunSummary:
+    """Time spent per stage during the run of one account"""
+
+    def __init__(self, account):
+        self.account = account
+        self.started_at = time.monotonic()
+        self.stages = defaultdict(lambda: [0, 0.0])
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        elapsed = time.monotonic() - self.started_at
+        stages = ', '.join(
+            f'{stage} {count}x {seconds:.2f}s' for stage, (count, seconds)
+            in sorted(self.stages.items(), key=lambda s: -s[1][1]))
+        return f'RunSummary {self.account} {elapsed:.1f}s: {stages}'
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.stages[stage][0] += 1
+            self.stages[stage][1] += seconds
+
+    def as_dict(self):
+        return {stage: {'count': count, 'seconds': round(seconds, 3)}
+                for stage, (count, seconds) in self.stages.items()}
+
+
+_run = contextvars.ContextVar('djin_run', default=None)
+
+
+@contextmanager
+def run_summary(account):
+    """Collect the stages timed till the end of the run, then log them"""
+    summary = RunSummary(account)
+    token = _run.set(summary)
+    try:
+        yield summary
+    finally:
+        _run.reset(token)
+        RUN_SECONDS.observe(time.monotonic() - summary.started_at)
+        logger.info(f'{summary}')
+
+
+def in_run(func):
+    """Function for worker threads that records into the run of the caller"""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+
+@contextmanager
+def timed(stage):
+    """Time a block or, as decorator, every call of a function"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        STAGE_SECONDS.observe(seconds, stage=stage)
+        summary = _run.get()
+        if summary is not None:
+            summary.record(stage, seconds)
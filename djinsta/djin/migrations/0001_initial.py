@@ -0,0 +1,106 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Account',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=250, unique=True)),
+                ('password', models.CharField(max_length=250, null=True)),
+                ('processing', models.BooleanField(blank=True, default=False)),
+                ('cookies', models.TextField(blank=True, max_length=1000, null=True)),
+                ('bio', models.TextField(blank=True, null=True)),
+                ('website', models.CharField(blank=True, max_length=250, null=True)),
+                ('posts_count', models.IntegerField(blank=True, null=True)),
+                ('followers_count', models.IntegerField(blank=True, null=True)),
+                ('following_count', models.IntegerField(blank=True, null=True)),
+                ('tag', models.CharField(blank=True, max_length=30, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Location',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(max_length=250)),
+                ('name', models.CharField(max_length=250)),
+                ('minor', models.CharField(max_length=250)),
+                ('major', models.CharField(max_length=250)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Tag',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('word', models.CharField(max_length=250)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AccountHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('posts_count', models.IntegerField()),
+                ('followers_count', models.IntegerField()),
+                ('following_count', models.IntegerField()),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='histories', to='djin.account')),
+            ],
+            options={
+                'verbose_name_plural': 'AccountHistories',
+            },
+        ),
+        migrations.CreateModel(
+            name='Post',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(max_length=250)),
+                ('description', models.CharField(blank=True, max_length=1000, null=True)),
+                ('count', models.IntegerField(blank=True, null=True)),
+                ('kind', models.CharField(blank=True, max_length=50, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='posts', to='djin.account')),
+                ('location', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='djin.location')),
+                ('tags', models.ManyToManyField(to='djin.tag')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Media',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=3)),
+                ('source', models.CharField(max_length=250)),
+                ('size', models.IntegerField(blank=True, null=True)),
+                ('poster', models.CharField(blank=True, max_length=250, null=True)),
+                ('extension', models.CharField(blank=True, max_length=50, null=True)),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='media', to='djin.post')),
+            ],
+            options={
+                'ordering': ['size'],
+            },
+        ),
+        migrations.CreateModel(
+            name='PostHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('count', models.IntegerField()),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='histories', to='djin.post')),
+            ],
+            options={
+                'verbose_name_plural': 'PostHistories',
+            },
+        ),
+    ]
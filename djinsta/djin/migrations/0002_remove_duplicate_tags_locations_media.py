@@ -0,0 +1,55 @@
+"""
+Remove the rows the unique constraints of the next migration would refuse
+
+Tags and locations were created per post, so the posts are moved to the
+first row of every word and code before the others are deleted. Of
+repeated media the last row written is kept.
+"""
+from django.db import migrations
+from django.db.models import Count, Max, Min
+
+
+def duplicates(model, fields, keep=Min):
+    """Pk kept and pks to delete for every group of rows with equal fields"""
+    groups = (model.objects.values(*fields)
+              .annotate(keep=keep('pk'), rows=Count('pk')).filter(rows__gt=1))
+    for group in groups:
+        pks = set(model.objects.filter(**{f: group[f] for f in fields}).values_list('pk', flat=True))
+        yield group['keep'], pks - {group['keep']}
+
+
+def merge_tags(apps, schema_editor):
+    Tag = apps.get_model('djin', 'Tag')
+    Through = apps.get_model('djin', 'Post').tags.through
+    for keep, others in duplicates(Tag, ['word']):
+        tagged = set(Through.objects.filter(tag_id=keep).values_list('post_id', flat=True))
+        moved = set(Through.objects.filter(tag_id__in=others).values_list('post_id', flat=True)) - tagged
+        Through.objects.bulk_create([Through(post_id=pk, tag_id=keep) for pk in moved])
+        Tag.objects.filter(pk__in=others).delete()
+
+
+def merge_locations(apps, schema_editor):
+    Location = apps.get_model('djin', 'Location')
+    Post = apps.get_model('djin', 'Post')
+    for keep, others in duplicates(Location, ['code']):
+        Post.objects.filter(location_id__in=others).update(location_id=keep)
+        Location.objects.filter(pk__in=others).delete()
+
+
+def remove_repeated_media(apps, schema_editor):
+    Media = apps.get_model('djin', 'Media')
+    for keep, others in duplicates(Media, ['post', 'kind', 'source'], keep=Max):
+        Media.objects.filter(pk__in=others).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djin', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_tags, migrations.RunPython.noop),
+        migrations.RunPython(merge_locations, migrations.RunPython.noop),
+        migrations.RunPython(remove_repeated_media, migrations.RunPython.noop),
+    ]
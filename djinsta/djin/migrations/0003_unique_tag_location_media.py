@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djin', '0002_remove_duplicate_tags_locations_media'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='location',
+            name='code',
+            field=models.CharField(max_length=250, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='tag',
+            name='word',
+            field=models.CharField(max_length=250, unique=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='media',
+            unique_together={('post', 'kind', 'source')},
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djin', '0003_unique_tag_location_media'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CrawlCursor',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('newest_code', models.CharField(blank=True, max_length=250, null=True)),
+                ('oldest_code', models.CharField(blank=True, max_length=250, null=True)),
+                ('end_cursor', models.CharField(blank=True, max_length=250, null=True)),
+                ('backfilled', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='cursor', to='djin.account')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djin', '0004_crawlcursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='fingerprint',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+"""
+Keep one history per account or post and day
+
+Nothing kept the histories to a row per day before, the last row of
+every day is kept before the unique constraints of the next migration
+are added.
+"""
+from django.db import migrations
+from django.db.models import Count, Max
+
+
+def remove_repeated(apps, schema_editor):
+    for name, owner in (('AccountHistory', 'account'), ('PostHistory', 'post')):
+        model = apps.get_model('djin', name)
+        days = (model.objects.values(owner, 'date')
+                .annotate(keep=Max('pk'), rows=Count('pk')).filter(rows__gt=1))
+        for day in days:
+            model.objects.filter(**{owner: day[owner], 'date': day['date']}).exclude(pk=day['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djin', '0005_post_fingerprint'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_repeated, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djin', '0006_remove_repeated_histories'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='accounthistory',
+            unique_together={('account', 'date')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='posthistory',
+            unique_together={('post', 'date')},
+        ),
+        migrations.CreateModel(
+            name='AccountRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('week', 'Week'), ('month', 'Month')], max_length=5)),
+                ('start', models.DateField()),
+                ('followers_first', models.IntegerField()),
+                ('followers_last', models.IntegerField()),
+                ('likes_first', models.IntegerField()),
+                ('likes_last', models.IntegerField()),
+                ('posts_last', models.IntegerField()),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='djin.account')),
+            ],
+            options={
+                'unique_together': {('account', 'period', 'start')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djin', '0007_accountrollup_unique_histories'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='next_run_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='account',
+            name='refresh_interval',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
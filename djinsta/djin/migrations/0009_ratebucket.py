@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djin', '0008_account_schedule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=250, unique=True)),
+                ('tokens', models.FloatField(default=0)),
+                ('factor', models.FloatField(default=1)),
+                ('refilled_at', models.FloatField(default=0)),
+                ('blocked_until', models.FloatField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djin', '0009_ratebucket'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='location',
+            name='geocoded',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='lat',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='lng',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
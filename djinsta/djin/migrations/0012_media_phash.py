@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djin', '0011_media_local_copy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='phash',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
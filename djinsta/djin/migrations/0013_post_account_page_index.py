@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djin', '0012_media_phash'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['account', '-created_at', '-id'], name='djin_post_account_a444b9_idx'),
+        ),
+    ]
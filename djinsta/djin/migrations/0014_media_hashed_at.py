@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 16:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djin', '0013_post_account_page_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='hashed_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
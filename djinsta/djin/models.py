@@ -1,6 +1,14 @@
+import hashlib
+import json
 import logging
-
-from django.db import models
+import os
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 
 
@@ -11,6 +19,9 @@ class Account(models.Model):
     username = models.CharField(max_length=250, unique=True)
     password = models.CharField(max_length=250, null=True)
     processing = models.BooleanField(default=False, blank=True)
+    # scheduled when due, the interval follows the activity of the account
+    next_run_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    refresh_interval = models.IntegerField(null=True, blank=True)
     cookies = models.TextField(max_length=1000, null=True, blank=True)
 
     bio = models.TextField(null=True, blank=True)
@@ -29,15 +40,91 @@ class Account(models.Model):
         return f'{self.username} with {self.followers_count} followers'
 
 
+class CrawlCursor(models.Model):
+    """Where crawling the posts of an account got to
+
+    Incremental runs stop at the newest known post, backfill runs resume
+    after the oldest known post until the first post of the account.
+    """
+    account = models.OneToOneField(Account, on_delete=models.CASCADE, related_name='cursor')
+    newest_code = models.CharField(max_length=250, null=True, blank=True)
+    oldest_code = models.CharField(max_length=250, null=True, blank=True)
+    # timeline cursor of the http backend to resume the backfill from
+    end_cursor = models.CharField(max_length=250, null=True, blank=True)
+    backfilled = models.BooleanField(default=False)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'CrawlCursor {self.account.username} {self.newest_code}..{self.oldest_code}'
+
+    @classmethod
+    def for_account(cls, account):
+        cursor, created = cls.objects.get_or_create(account=account)
+        return cursor
+
+
+class RateBucket(models.Model):
+    """Token bucket shared by every worker
+
+    The factor scales the configured rate, it drops when instagram
+    throttles and recovers while responses are clean.
+    """
+    key = models.CharField(max_length=250, unique=True)
+    tokens = models.FloatField(default=0)
+    factor = models.FloatField(default=1)
+    refilled_at = models.FloatField(default=0)
+    blocked_until = models.FloatField(default=0)
+
+    def __str__(self):
+        return f'RateBucket {self.key} {self.tokens:.1f} tokens at {self.factor:.2f}'
+
+
 class Tag(models.Model):
-    word = models.CharField(max_length=250)
+    word = models.CharField(max_length=250, unique=True)
+
+    # word to primary key of the tags committed to the db
+    pks = {}
+
+    @classmethod
+    def resolve(cls, words):
+        """Primary keys of the words, creating the missing tags in bulk
+
+        The pks are cached once the transaction commits, so tags of a
+        transaction that rolls back are never handed out again.
+        """
+        words = set(words)
+        missing = words - cls.pks.keys()
+        found = {}
+        if missing:
+            # conflicts are tags created concurrently by another worker
+            cls.objects.bulk_create([cls(word=w) for w in missing], ignore_conflicts=True)
+            found = dict(cls.objects.filter(word__in=missing).values_list('word', 'pk'))
+            transaction.on_commit(lambda: cls.pks.update(found))
+        return [cls.pks.get(w) or found[w] for w in words]
+
+
+@receiver(post_delete, sender=Tag)
+def forget_tags(sender, **kwargs):
+    """deleted tags are looked up again"""
+    Tag.pks.clear()
 
 
 class Location(models.Model):
-    code = models.CharField(max_length=250)
+    code = models.CharField(max_length=250, unique=True)
     name = models.CharField(max_length=250)
     minor = models.CharField(max_length=250)
     major = models.CharField(max_length=250)
+    # resolved from the gazetteer, geocoded is set even when not found
+    lat = models.FloatField(null=True, blank=True)
+    lng = models.FloatField(null=True, blank=True)
+    geocoded = models.BooleanField(default=False)
+
+    def point(self):
+        """Coordinates as an elasticsearch geo point"""
+        if self.lat is None:
+            return None
+        return {'lat': self.lat, 'lon': self.lng}
 
     def parts(self):
         try:
@@ -64,13 +151,31 @@ class Post(models.Model):
     description = models.CharField(max_length=1000, null=True, blank=True)
     count = models.IntegerField(null=True, blank=True)
     kind = models.CharField(max_length=50, null=True, blank=True)
+    # hash of the scraped fields when last stored
+    fingerprint = models.CharField(max_length=40, null=True, blank=True)
 
     updated_at = models.DateTimeField(auto_now=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # the pages of posts of an account, newest first
+        indexes = [models.Index(fields=['account', '-created_at', '-id'])]
+
     def __str__(self):
         return f'Post {self.account.username} - {self.created_at:%-d %b %Y}'
 
+    @staticmethod
+    def fingerprint_of(data, media=None):
+        """Hash of the scraped fields of a post page"""
+        content = {
+            'popularity': data['popularity'],
+            'description': data['description'],
+            'location': data['location'],
+            'tags': sorted(data['tags']),
+            'media': [m['source'] for m in media] if media is not None else None,
+        }
+        return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
 
 class Media(models.Model):
     IMG = 'img'
@@ -84,8 +189,24 @@ class Media(models.Model):
     poster = models.CharField(max_length=250, null=True, blank=True)
     extension = models.CharField(max_length=50, null=True, blank=True)
 
+    # local copy in the content addressed store under MEDIA_ROOT
+    local_path = models.CharField(max_length=250, null=True, blank=True)
+    byte_size = models.BigIntegerField(null=True, blank=True)
+    sha256 = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    # difference hash of the image, see djin.phash
+    phash = models.BigIntegerField(null=True, blank=True)
+    hashed_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
     class Meta:
         ordering = ['size']
+        unique_together = ('post', 'kind', 'source')
+
+    @property
+    def url(self):
+        """The local copy when there is one, the cdn links expire"""
+        if self.local_path:
+            return settings.MEDIA_URL + self.local_path.replace(os.sep, '/')
+        return self.source
 
 
 class AccountHistory(models.Model):
@@ -98,6 +219,7 @@ class AccountHistory(models.Model):
 
     class Meta:
         verbose_name_plural = 'AccountHistories'
+        unique_together = ('account', 'date')
 
     def __str__(self):
         return f'AccountHistory {self.account.username} {self.date}'
@@ -106,7 +228,7 @@ class AccountHistory(models.Model):
     def upsert(cls, account):
         ahistory, created = AccountHistory.objects.update_or_create(
             account=account,
-            date=timezone.now(),
+            date=timezone.localdate(),
             defaults={
                 'posts_count': account.posts_count,
                 'followers_count': account.followers_count,
@@ -126,6 +248,7 @@ class PostHistory(models.Model):
 
     class Meta:
         verbose_name_plural = 'PostHistories'
+        unique_together = ('post', 'date')
 
     def __str__(self):
         return f'PostHistory {self.post.code} {self.date}'
@@ -134,13 +257,101 @@ class PostHistory(models.Model):
     def upsert(cls, post):
         phistory, created = PostHistory.objects.update_or_create(
             post=post,
-            date=timezone.now(),
+            date=timezone.localdate(),
             defaults={
-                'posts_count': post.posts_count,
-                'followers_count': post.followers_count,
-                'following_count': post.following_count,
+                'count': post.count,
             }
         )
         if created:
             logger.info(f'Created {phistory}')
         return phistory
+
+    @classmethod
+    def snapshot(cls, account):
+        """Record todays count of every post of the account at once
+
+        Returns the total likes over the posts, the views of videos are
+        not counted.
+        """
+        today = timezone.localdate()
+        counts = list(account.posts.filter(count__isnull=False).values_list('pk', 'count', 'kind'))
+        histories = [cls(post_id=pk, date=today, count=count) for pk, count, kind in counts]
+        cls.objects.bulk_create(
+            histories, batch_size=500,
+            update_conflicts=True, unique_fields=['post', 'date'], update_fields=['count'])
+        logger.info(f'Recorded {len(histories)} post histories for {account.username}')
+        return sum(count for pk, count, kind in counts if kind == 'likes')
+
+
+class AccountRollup(models.Model):
+    """Account history per week or month
+
+    Holds the values of the first and the last snapshot of the period, so
+    it is updated in place with every daily snapshot.
+    """
+    WEEK = 'week'
+    MONTH = 'month'
+    PERIODS = ((WEEK, 'Week'), (MONTH, 'Month'))
+
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='rollups')
+    period = models.CharField(max_length=5, choices=PERIODS)
+    start = models.DateField()
+
+    followers_first = models.IntegerField()
+    followers_last = models.IntegerField()
+    likes_first = models.IntegerField()
+    likes_last = models.IntegerField()
+    posts_last = models.IntegerField()
+
+    class Meta:
+        unique_together = ('account', 'period', 'start')
+
+    def __str__(self):
+        return f'AccountRollup {self.account.username} {self.period} {self.start}'
+
+    @staticmethod
+    def period_start(period, date):
+        if period == AccountRollup.WEEK:
+            return date - timedelta(days=date.weekday())
+        return date.replace(day=1)
+
+    @classmethod
+    def record(cls, account, likes, date=None):
+        """Fold todays snapshot into the rollups of its week and month"""
+        date = date or timezone.localdate()
+        followers = account.followers_count or 0
+        posts = account.posts_count or 0
+        for period, _ in cls.PERIODS:
+            rollup, created = cls.objects.get_or_create(
+                account=account, period=period, start=cls.period_start(period, date),
+                defaults={
+                    'followers_first': followers, 'followers_last': followers,
+                    'likes_first': likes, 'likes_last': likes,
+                    'posts_last': posts,
+                })
+            if not created:
+                rollup.followers_last = followers
+                rollup.likes_last = likes
+                rollup.posts_last = posts
+                rollup.save(update_fields=['followers_last', 'likes_last', 'posts_last'])
+
+    @classmethod
+    def growth(cls, accounts, period=WEEK, since=None):
+        """Follower and like growth per period for many accounts in one query
+
+        Returns a list of (start, followers, likes) per account pk, where the
+        growth is measured from the end of the previous period when known.
+        """
+        rollups = cls.objects.filter(account__in=accounts, period=period)
+        if since:
+            rollups = rollups.filter(start__gte=cls.period_start(period, since))
+        rows = rollups.order_by('account_id', 'start').values_list(
+            'account_id', 'start', 'followers_first', 'followers_last', 'likes_first', 'likes_last')
+
+        series = defaultdict(list)
+        previous = {}
+        for account_pk, start, followers_first, followers_last, likes_first, likes_last in rows:
+            followers_base, likes_base = previous.get(account_pk, (followers_first, likes_first))
+            series[account_pk].append((start, followers_last - followers_base, likes_last - likes_base))
+            previous[account_pk] = followers_last, likes_last
+        return dict(series)
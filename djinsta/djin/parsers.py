@@ -0,0 +1,242 @@
+"""
+Parsers for snapshots of instagram pages
+
+Every field is parsed locally from the page source, preferably from the
+json the page embeds in `window._sharedData`, otherwise from the html.
+"""
+import json
+import re
+from datetime import datetime, timezone
+
+from django.utils.dateparse import parse_datetime
+from lxml import html
+
+from .models import Media
+
+RE_SHARED_DATA = re.compile(r'window\._sharedData\s*=\s*(\{.*?\});</script>', re.DOTALL)
+
+
+class InstagramError(Exception):
+    """Instagram errors"""
+
+
+class PostPageError(InstagramError):
+    """Error on post page"""
+
+
+def parse_number(number):
+    """
+    Parses the number. Remove the unused comma. Replace the concatenation with relevant zeros. Remove the dot.
+
+    :param number: str
+
+    :return: int
+    """
+    formatted_num = number.replace(',', '')
+    formatted_num = re.sub(r'(k)$', '00' if '.' in formatted_num else '000', formatted_num)
+    formatted_num = re.sub(r'(m)$', '00000' if '.' in formatted_num else '000000', formatted_num)
+    formatted_num = formatted_num.replace('.', '')
+    return int(formatted_num)
+
+
+def parse_tags(sentence):
+    """Parses the sentences for hashtags and returns a list"""
+    if not sentence:
+        return []
+    return [t.lower() for t in re.findall(r'#(\w+)', sentence)]
+
+
+# pages instagram serves instead of the requested one when scraping too fast
+THROTTLE_MARKERS = (
+    'Please wait a few minutes before you try again',
+    '"LoginAndSignupPage"',
+)
+
+
+def is_throttled(source):
+    """Is the page a rate limit or login wall"""
+    return any(marker in source for marker in THROTTLE_MARKERS)
+
+
+def shared_data(source):
+    """The json embedded in the page, if any"""
+    match = RE_SHARED_DATA.search(source)
+    if not match:
+        return None
+    try:
+        return json.loads(match.group(1))
+    except ValueError:
+        return None
+
+
+def _page_entry(source, page):
+    """The graphql entry of the page type in the embedded json"""
+    data = shared_data(source)
+    try:
+        return data['entry_data'][page][0]['graphql']
+    except (TypeError, KeyError, IndexError):
+        return None
+
+
+def _first(tree, xpath):
+    found = tree.xpath(xpath)
+    return found[0] if found else None
+
+
+def _text(tree, xpath):
+    element = _first(tree, xpath)
+    return element.text_content().strip() if element is not None else None
+
+
+########################################################################################
+# Post
+########################################################################################
+
+def parse_post(source):
+    """Fields of a post page, raises PostPageError without the fields a post needs"""
+    entry = _page_entry(source, 'PostPage')
+    if entry and entry.get('shortcode_media'):
+        try:
+            return _post_from_json(entry['shortcode_media'])
+        except KeyError as e:
+            raise PostPageError(f'Post json has no {e}')
+    return _post_from_html(html.fromstring(source))
+
+
+def media_from_json(node):
+    """Media items of a post node, including every carousel item"""
+    children = node.get('edge_sidecar_to_children', {}).get('edges')
+    nodes = [c['node'] for c in children] if children else [node]
+    media = []
+    for item in nodes:
+        if item.get('is_video'):
+            media.append({
+                'kind': Media.VID, 'source': item['video_url'],
+                'poster': item.get('display_url'), 'extension': 'video/mp4'})
+        else:
+            largest = max(item['display_resources'], key=lambda r: r['config_width'])
+            media.append({'kind': Media.IMG, 'source': largest['src'], 'size': largest['config_width']})
+    return media
+
+
+def _post_from_json(node):
+    if node.get('is_video'):
+        popularity = node.get('video_view_count'), 'views'
+    else:
+        popularity = node.get('edge_media_preview_like', {}).get('count'), 'likes'
+    captions = node.get('edge_media_to_caption', {}).get('edges')
+    description = captions[0]['node']['text'] if captions else None
+    location = node.get('location') or {}
+    return {
+        'deleted': False,
+        'username': node['owner']['username'],
+        'created_at': datetime.fromtimestamp(node['taken_at_timestamp'], tz=timezone.utc),
+        'popularity': popularity,
+        'description': description,
+        'tags': parse_tags(description),
+        'location': (location.get('id'), location.get('name')),
+        'media': media_from_json(node),
+    }
+
+
+def _post_from_html(tree):
+    if _first(tree, '//h2[text()="Sorry, this page isn\'t available."]') is not None:
+        return {'deleted': True}
+
+    created_at = _first(tree, '//time/@datetime')
+    try:
+        created_at = parse_datetime(created_at) if created_at else None
+    except ValueError:
+        created_at = None
+    if created_at is None:
+        raise PostPageError('Post page has no time it was posted')
+    username = _text(tree, '//article/header/div/div/div/a')
+
+    popularity = None, None
+    sentence = _text(tree, '//article/div/section/div')
+    if sentence:
+        words = sentence.split(' ')
+        try:
+            popularity = parse_number(words[0]), words[1]
+        except (ValueError, IndexError):
+            pass
+
+    description = None
+    if username:
+        description = _text(
+            tree, f'//article//ul/li//*[contains(text(), "{username}")]/following-sibling::span')
+
+    location = None, None
+    loc = _first(tree, '//article/header/div[2]/div[2]/a')
+    if loc is not None:
+        match = re.search(r'locations/(\d+)', loc.get('href', ''))
+        if match:
+            location = match.group(1), loc.text_content().strip()
+
+    return {
+        'deleted': False,
+        'username': username,
+        'created_at': created_at,
+        'popularity': popularity,
+        'description': description,
+        'tags': parse_tags(description),
+        'location': location,
+        # carousels only show the first item in the html
+        'media': None,
+    }
+
+
+########################################################################################
+# Profile
+########################################################################################
+
+def parse_profile(source):
+    """Fields of a profile page"""
+    entry = _page_entry(source, 'ProfilePage')
+    if entry and entry.get('user'):
+        return _profile_from_json(entry['user'])
+    return _profile_from_html(html.fromstring(source))
+
+
+def _profile_from_json(user):
+    timeline = user.get('edge_owner_to_timeline_media', {})
+    page_info = timeline.get('page_info', {})
+    return {
+        # private accounts show their posts when followed
+        'private': user.get('is_private', False) and not user.get('followed_by_viewer', False),
+        'id': user.get('id'),
+        'posts_count': timeline.get('count'),
+        'followers_count': user.get('edge_followed_by', {}).get('count'),
+        'following_count': user.get('edge_follow', {}).get('count'),
+        'bio': user.get('biography') or None,
+        'website': user.get('external_url') or None,
+        'codes': [e['node']['shortcode'] for e in timeline.get('edges', [])],
+        'end_cursor': page_info.get('end_cursor') if page_info.get('has_next_page') else None,
+    }
+
+
+def _profile_from_html(tree):
+    if _first(tree, '//h2[text()="This Account is Private"]') is not None:
+        return {'private': True}
+
+    def count(xpath):
+        text = _text(tree, xpath)
+        return parse_number(text) if text else None
+
+    codes = []
+    for href in tree.xpath('//a[starts-with(@href, "/p/")]/@href'):
+        match = re.match(r'/p/(.*?)/', href)
+        if match:
+            codes.append(match.group(1))
+
+    return {
+        'private': False,
+        'id': None,
+        'posts_count': count('//ul/li[1]/span/span'),
+        'followers_count': count('//ul/li[2]/a/span'),
+        'following_count': count('//ul/li[3]/a/span'),
+        'bio': _text(tree, '//article/header//div[2]/span'),
+        'website': _text(tree, '//article/header//div[2]/a'),
+        'codes': codes,
+        'end_cursor': None,
+    }
@@ -0,0 +1,253 @@
+"""
+Near duplicate images across accounts
+
+Every stored image gets a 64 bit difference hash, which changes little
+when an image is reposted resized, recompressed or lightly edited. The
+hashes are kept in a multi-index hash table: a hash is split in chunks and
+two hashes within the radius share at least one chunk up to a few flipped
+bits, so a query looks up a handful of chunk values instead of scanning.
+Images within the radius of each other are joined into clusters as they
+are added, so listing the clusters does not compare any hashes.
+"""
+import logging
+import os
+import threading
+from array import array
+from collections import defaultdict
+from datetime import timedelta
+from itertools import combinations
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .metrics import timed
+from .models import Media
+
+logger = logging.getLogger(__name__)
+
+BITS = 64
+# the hash is kept in a signed bigint column
+SIGN = 1 << (BITS - 1)
+MASK = (1 << BITS) - 1
+
+
+def signed(h):
+    return h - (1 << BITS) if h & SIGN else h
+
+
+def unsigned(h):
+    return h & MASK
+
+
+def distance(a, b):
+    """Hamming distance of two hashes"""
+    return bin((a ^ b) & MASK).count('1')
+
+
+def image_hash(path):
+    """Difference hash of the image, one bit per pair of neighbouring pixels"""
+    # only the workers that hash images need pillow
+    from PIL import Image
+
+    with Image.open(path) as image:
+        pixels = list(image.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+    h = 0
+    for row in range(8):
+        for col in range(8):
+            h = h << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return h
+
+
+class HashIndex:
+    """Multi-index hashing of 64 bit hashes with the clusters within a radius
+
+    Equal hashes share a slot, the hashes are kept in one array and every
+    chunk table maps a chunk value to the slots having it.
+    """
+
+    def __init__(self, radius=6, chunks=4):
+        self.radius = radius
+        self.chunks = chunks
+        self.width = BITS // chunks
+        # a match within the radius is within this many bits on one chunk at least
+        flips = radius // chunks
+        self.flips = [sum(1 << b for b in bits)
+                      for n in range(flips + 1) for bits in combinations(range(self.width), n)]
+        self.tables = [defaultdict(lambda: array('I')) for _ in range(chunks)]
+        self.hashes = array('Q')
+        self.slots = {}
+        self.keys = []
+        # union find over the slots, with the members of clusters of several slots
+        self.parent = array('I')
+        self.groups = {}
+
+    def __len__(self):
+        return sum(len(keys) for keys in self.keys)
+
+    def split(self, h):
+        mask = (1 << self.width) - 1
+        return [(h >> (i * self.width)) & mask for i in range(self.chunks)]
+
+    def candidates(self, h):
+        found = set()
+        for table, value in zip(self.tables, self.split(h)):
+            for flip in self.flips:
+                slots = table.get(value ^ flip)
+                if slots:
+                    found.update(slots)
+        return found
+
+    def search(self, h, radius=None):
+        """Keys with a hash within the radius, as (key, distance) nearest first"""
+        radius = self.radius if radius is None else min(radius, self.radius)
+        h = unsigned(h)
+        matches = []
+        for slot in self.candidates(h):
+            d = distance(h, self.hashes[slot])
+            if d <= radius:
+                matches.extend((key, d) for key in self.keys[slot])
+        matches.sort(key=lambda m: m[1])
+        return matches
+
+    def add(self, key, h):
+        """Add the key, joining it to the clusters within the radius
+
+        A key is added once per hash, hashes of the same key are not
+        expected to change.
+        """
+        h = unsigned(h)
+        slot = self.slots.get(h)
+        if slot is not None:
+            # adding a key again with its hash changes nothing
+            if key not in self.keys[slot]:
+                self.keys[slot].append(key)
+            return
+        near = [s for s in self.candidates(h) if distance(h, self.hashes[s]) <= self.radius]
+        slot = self.slots[h] = len(self.hashes)
+        self.hashes.append(h)
+        self.keys.append([key])
+        self.parent.append(slot)
+        for table, value in zip(self.tables, self.split(h)):
+            table[value].append(slot)
+        for other in near:
+            self.union(slot, other)
+
+    def find(self, slot):
+        root = slot
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[slot] != root:
+            self.parent[slot], slot = root, self.parent[slot]
+        return root
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        members_a = self.groups.pop(a, [a])
+        members_b = self.groups.pop(b, [b])
+        if len(members_a) < len(members_b):
+            a, b, members_a, members_b = b, a, members_b, members_a
+        self.parent[b] = a
+        members_a.extend(members_b)
+        self.groups[a] = members_a
+
+    def clusters(self, min_size=2):
+        """Keys of every cluster with at least min_size keys, largest first"""
+        found = [[k for s in members for k in self.keys[s]] for members in self.groups.values()]
+        # equal hashes alone in their cluster
+        found.extend(self.keys[s] for s in self.slots.values()
+                     if len(self.keys[s]) > 1 and self.find(s) not in self.groups)
+        found = [keys for keys in found if len(keys) >= min_size]
+        found.sort(key=len, reverse=True)
+        return found
+
+
+###############################################################################
+# Index of the stored images
+###############################################################################
+
+_index = {}
+_index_lock = threading.Lock()
+
+# images hashed this long before the last read may have committed after it
+HASHED_MARGIN = timedelta(minutes=1)
+
+
+def index():
+    """Index of the hashed images, loaded on first use and caught up on every use
+
+    The images other processes hashed since the last use are added.
+    Deleted media stay in the index till the process restarts, callers
+    look the keys up in the database.
+    """
+    with _index_lock:
+        read_at = timezone.now()
+        if 'current' not in _index:
+            with timed('phash_load'):
+                hashes = HashIndex(**settings.PHASH)
+                images = Media.objects.filter(phash__isnull=False).order_by('pk')
+                for pk, h in images.values_list('pk', 'phash').iterator():
+                    hashes.add(pk, h)
+            logger.info(f'Loaded {len(hashes)} image hashes')
+            _index['current'] = hashes
+        else:
+            images = Media.objects.filter(hashed_at__gte=_index['read_at'] - HASHED_MARGIN)
+            for pk, h in images.values_list('pk', 'phash'):
+                _index['current'].add(pk, h)
+        _index['read_at'] = read_at
+    return _index['current']
+
+
+@receiver(setting_changed)
+def reset_index(setting, **kwargs):
+    if setting == 'PHASH':
+        _index.clear()
+
+
+def hash_images(media, root=None):
+    """Hash the stored images of the media that have no hash yet, returns the hashed
+
+    Files hashed before for other media are not opened again, and the
+    loaded index is updated, so new posts are found as they come in.
+    """
+    root = root or settings.MEDIA_ROOT
+    images = [m for m in media if m.kind == Media.IMG and m.local_path and m.phash is None]
+    known = dict(Media.objects.filter(
+        sha256__in={m.sha256 for m in images}, phash__isnull=False).values_list('sha256', 'phash'))
+    hashed = []
+    for m in images:
+        if m.sha256 not in known:
+            try:
+                with timed('phash'):
+                    known[m.sha256] = signed(image_hash(os.path.join(root, m.local_path)))
+            except OSError as e:
+                logger.error(f'Could not hash {m.local_path}: {e}')
+                continue
+        m.phash = known[m.sha256]
+        hashed.append(m)
+    # stamped as they are written, other processes add them by the stamp
+    hashed_at = timezone.now()
+    for m in hashed:
+        m.hashed_at = hashed_at
+    Media.objects.bulk_update(hashed, ['phash', 'hashed_at'])
+    if 'current' in _index:
+        with _index_lock:
+            for m in hashed:
+                _index['current'].add(m.pk, m.phash)
+    logger.info(f'Hashed {len(hashed)} of {len(images)} images')
+    return hashed
+
+
+def duplicates(media, radius=None):
+    """Media with an image near the image of the media, as (pk, distance)"""
+    if media.phash is None:
+        return []
+    return [(pk, d) for pk, d in index().search(media.phash, radius) if pk != media.pk]
+
+
+def clusters(min_size=2):
+    """Media pks of the clusters of near duplicate images, largest first"""
+    return index().clusters(min_size)
@@ -0,0 +1,110 @@
+"""
+Scheduling of account crawls
+
+Every scheduled account has a due time. The accounts that are due the
+longest go first, with a cap on how many are crawled at once, and after a
+crawl the account is due again after an interval that follows how active
+the account is.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Account
+
+logger = logging.getLogger(__name__)
+
+
+def schedule(account, when=None):
+    """Make the account due"""
+    account.next_run_at = when or timezone.now()
+    account.save(update_fields=['next_run_at'])
+    logger.info(f'Scheduled {account} at {account.next_run_at}')
+
+
+def unschedule(account):
+    """Stop crawling the account, a running crawl stops at its next task"""
+    account.next_run_at = None
+    account.processing = False
+    account.save(update_fields=['next_run_at', 'processing'])
+    logger.info(f'Unscheduled {account}')
+
+
+def reschedule(account):
+    """Make the account due again after its refresh interval"""
+    account.refresh_interval = refresh_interval(account)
+    account.next_run_at = timezone.now() + timedelta(seconds=account.refresh_interval)
+    account.save(update_fields=['refresh_interval', 'next_run_at'])
+    logger.info(f'Rescheduled {account} at {account.next_run_at}')
+
+
+def refresh_interval(account):
+    """Seconds till the next crawl, shorter for more active accounts
+
+    Activity is the posts added per day plus the percentage of followers
+    gained or lost per day over the recent account history.
+    """
+    options = settings.SCHEDULER
+    since = timezone.localdate() - timedelta(days=options['activity_days'])
+    histories = list(account.histories.filter(date__gte=since).order_by('date'))
+    if len(histories) < 2:
+        return options['min_interval']
+
+    first, last = histories[0], histories[-1]
+    days = max((last.date - first.date).days, 1)
+    posts_per_day = (last.posts_count - first.posts_count) / days
+    followers_per_day = abs(last.followers_count - first.followers_count) / max(first.followers_count, 1) / days
+    activity = max(posts_per_day, 0) + followers_per_day * 100
+
+    interval = options['max_interval'] / (1 + activity)
+    return int(max(options['min_interval'], min(options['max_interval'], interval)))
+
+
+def due_accounts():
+    """Scheduled accounts that are due, longest waiting first"""
+    return Account.objects.filter(
+        next_run_at__lte=timezone.now(), processing=False).order_by('next_run_at')
+
+
+def claim(limit):
+    """Mark up to limit due accounts as processing, returns their pks
+
+    Counting the accounts in flight and claiming is one transaction, so
+    dispatchers running at once wait for each other instead of going over
+    the limit. Sqlite takes the write lock as the transaction begins, see
+    DATABASES, other databases lock the rows of the accounts counted.
+    """
+    with transaction.atomic():
+        counted = Account.objects.select_for_update().filter(Q(next_run_at__isnull=False) | Q(processing=True))
+        available = limit - sum(processing for processing in counted.values_list('processing', flat=True))
+        claimed = list(due_accounts().values_list('pk', flat=True)[:max(available, 0)])
+        Account.objects.filter(pk__in=claimed).update(processing=True)
+    return claimed
+
+
+def seconds_till_next():
+    """Seconds till the next scheduled account is due, if any"""
+    next_run_at = Account.objects.filter(
+        next_run_at__isnull=False, processing=False).order_by('next_run_at').values_list(
+        'next_run_at', flat=True).first()
+    if next_run_at is None:
+        return None
+    return max((next_run_at - timezone.now()).total_seconds(), 0)
+
+
+def queue_stats():
+    """Depth of the queue and how late the accounts in it are"""
+    now = timezone.now()
+    due = list(due_accounts().values_list('next_run_at', flat=True))
+    return {
+        'scheduled': Account.objects.filter(next_run_at__isnull=False).count(),
+        'in_flight': Account.objects.filter(processing=True).count(),
+        'max_in_flight': settings.SCHEDULER['max_in_flight'],
+        'depth': len(due),
+        'max_lag': (now - due[0]).total_seconds() if due else 0,
+        'mean_lag': sum((now - d).total_seconds() for d in due) / len(due) if due else 0,
+    }
@@ -0,0 +1,157 @@
+"""
+Local copies of the post media
+
+CDN links expire, so media files are downloaded, a bounded number at once,
+and stored under the sha256 of their content. The same file posted twice
+is stored once, media that have a local copy are not fetched again and a
+download that broke off continues from the bytes it already has.
+"""
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import os
+from urllib.parse import urlparse
+
+import aiohttp
+from django.conf import settings
+
+from .metrics import timed
+from .models import Media
+
+logger = logging.getLogger(__name__)
+
+STORED_FIELDS = ['local_path', 'byte_size', 'sha256']
+
+
+class StorageError(Exception):
+    """Media file could not be stored"""
+
+
+def content_path(sha256, extension):
+    """Path of the file in the store, fanned out over two directory levels"""
+    return os.path.join(sha256[:2], sha256[2:4], f'{sha256}{extension}')
+
+
+def partial_path(root, url):
+    """Where the download of the url is kept till it completes"""
+    return os.path.join(root, 'partial', hashlib.sha1(url.encode()).hexdigest())
+
+
+def extension_of(url, content_type=None):
+    extension = os.path.splitext(urlparse(url).path)[1].lower()
+    if extension:
+        return extension
+    if content_type:
+        return mimetypes.guess_extension(content_type.split(';')[0].strip()) or ''
+    return ''
+
+
+class MediaDownloader:
+    """Downloads media files into the store with a cap on the downloads in flight"""
+
+    def __init__(self, root=None, concurrency=None, timeout=None, chunk_size=None):
+        options = settings.MEDIA_STORE
+        self.root = root or settings.MEDIA_ROOT
+        self.concurrency = concurrency or options['concurrency']
+        self.timeout = timeout or options['timeout']
+        self.chunk_size = chunk_size or options['chunk_size']
+
+    def download(self, media):
+        """Store the files of the media, returns the media that failed with their error"""
+        self.reuse_stored(media)
+        # a file is fetched once however many posts link it
+        by_source = {}
+        for m in media:
+            if not (m.local_path and os.path.exists(os.path.join(self.root, m.local_path))):
+                by_source.setdefault(m.source, []).append(m)
+        if not by_source:
+            return []
+
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(self.fetch_all(list(by_source)))
+        finally:
+            loop.close()
+
+        stored, failed = [], []
+        for source, result in zip(by_source, results):
+            if isinstance(result, Exception):
+                logger.error(f'Could not download {source}: {result}')
+                failed.extend((m, result) for m in by_source[source])
+                continue
+            for m in by_source[source]:
+                m.sha256, m.local_path, m.byte_size = result
+                stored.append(m)
+        Media.objects.bulk_update(stored, STORED_FIELDS)
+        logger.info(f'Stored {len(stored)} media, {len(failed)} failed')
+        return failed
+
+    def reuse_stored(self, media):
+        """Point media at the copies downloaded for other posts, in one query"""
+        missing = [m for m in media if not m.local_path]
+        copies = Media.objects.filter(
+            source__in={m.source for m in missing}, local_path__isnull=False,
+        ).values_list('source', 'local_path', 'byte_size', 'sha256')
+        copies = {source: rest for source, *rest in copies}
+        reused = []
+        for m in missing:
+            if m.source in copies:
+                m.local_path, m.byte_size, m.sha256 = copies[m.source]
+                reused.append(m)
+        Media.objects.bulk_update(reused, STORED_FIELDS)
+
+    async def fetch_all(self, urls):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async def fetch(url):
+                async with semaphore:
+                    with timed('media_download'):
+                        return await self.fetch(session, url)
+            return await asyncio.gather(*(fetch(u) for u in urls), return_exceptions=True)
+
+    async def fetch(self, session, url):
+        """Stream the url to the store, returns the sha256, path and size"""
+        partial = partial_path(self.root, url)
+        os.makedirs(os.path.dirname(partial), exist_ok=True)
+        digest = hashlib.sha256()
+        offset = 0
+        if os.path.exists(partial):
+            with open(partial, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                    digest.update(chunk)
+                    offset += len(chunk)
+
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        async with session.get(url, headers=headers) as response:
+            if response.status == 416:
+                # the partial file is complete already
+                pass
+            elif response.status == 206:
+                logger.info(f'Resuming {url} from {offset} bytes')
+                await self.stream(response, partial, 'ab', digest)
+            elif response.status == 200:
+                # a new download, or the server ignored the range
+                digest = hashlib.sha256()
+                await self.stream(response, partial, 'wb', digest)
+            else:
+                raise StorageError(f'{url} returned {response.status}')
+            content_type = response.headers.get('Content-Type')
+
+        sha256 = digest.hexdigest()
+        path = content_path(sha256, extension_of(url, content_type))
+        target = os.path.join(self.root, path)
+        if os.path.exists(target):
+            # same content downloaded from another url
+            os.remove(partial)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(partial, target)
+        return sha256, path, os.path.getsize(target)
+
+    async def stream(self, response, partial, mode, digest):
+        with open(partial, mode) as f:
+            async for chunk in response.content.iter_chunked(self.chunk_size):
+                digest.update(chunk)
+                f.write(chunk)
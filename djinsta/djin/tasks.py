@@ -1,11 +1,21 @@
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import wrapt
 from background_task import background
+from background_task.models import Task
+from django.conf import settings
+from django.db import connection
 
+from . import scheduler
+from .fetch import HttpInstagram
 from .instagram import Instagram
-from .models import Account, AccountHistory, PostHistory
-from .insight import index_account, index_post
+from .metrics import POSTS, in_run, run_summary, timed
+from .models import Account, AccountHistory, AccountRollup, CrawlCursor, Media, Post, PostHistory
+from .insight import BulkIndexError, bulk_indexer, index_account, with_post_relations
+from .phash import hash_images
+from .storage import MediaDownloader
 
 logger = logging.getLogger(__name__)
 
@@ -26,21 +36,40 @@ def extract_account(wrapped, instance, args, kwargs):
 def my_profile(account):
     """parse my profile"""
     logger.info(f'Running my profile for {account}')
-    with Instagram(account) as insta:
-        logger.info(f'Updating account {account}')
-        insta.upsert_profile(account)
-        for post in account.posts.all():
-            logger.info(f'Updating post {post}')
-            insta.upsert_post(post)
-            PostHistory.upsert(post)
-            index_post(post)
+    try:
+        with run_summary(account):
+            if settings.FETCH['backend'] == 'http':
+                with HttpInstagram(account) as insta:
+                    logger.info(f'Updating account {account}')
+                    if not crawl_profile(insta, account):
+                        return
+                    refresh_posts_http(insta, account)
+            else:
+                with Instagram(account) as insta:
+                    logger.info(f'Updating account {account}')
+                    exists = crawl_profile(insta, account)
+                if not exists:
+                    return
+                refresh_posts(account, workers=settings.PROCESS_WORKERS)
 
-    AccountHistory.upsert(account)
+            # one statement for the posts, then fold into the weekly and monthly rollups
+            with timed('history'):
+                likes = PostHistory.snapshot(account)
+                AccountHistory.upsert(account)
+                AccountRollup.record(account, likes)
 
-    doc_created = index_account(account)
-    logger.info(f'Created account doc? {doc_created}')
+            doc_created = index_account(account)
+            logger.info(f'Created account doc? {doc_created}')
 
-    finished(account.pk)
+        # the cdn links expire, keep copies apart from the crawl
+        store_media(account.pk)
+    finally:
+        if account.pk is None:
+            # a deleted account holds no slot, start the next one
+            dispatch()
+        else:
+            # a failed run releases its claim too, or it holds a slot for good
+            finished(account.pk)
 
 
 @background
@@ -50,5 +79,155 @@ def finished(account):
     account.processing = False
     account.save()
     logger.info(f'Account {account} finished processing')
+    if account.next_run_at:
+        scheduler.reschedule(account)
+    # a slot is free for the next account
+    dispatch()
 
 
+@background
+def store_media(account_pk):
+    """download the media of the account that have no local copy yet"""
+    media = list(Media.objects.filter(post__account_id=account_pk, local_path__isnull=True))
+    logger.info(f'Storing {len(media)} media of account {account_pk}')
+    failed = MediaDownloader().download(media)
+    if failed:
+        logger.warning(f'{len(failed)} media of account {account_pk} not stored, retried on the next run')
+    # reposts are found by the hashes of the images
+    hash_images(media)
+
+
+@background
+def dispatch():
+    """start the accounts that are due, up to the cap of accounts in flight"""
+    for account_pk in scheduler.claim(settings.SCHEDULER['max_in_flight']):
+        my_profile(account_pk)
+    logger.info(f'Dispatched with {scheduler.queue_stats()}')
+
+    # wake up for the next account that becomes due
+    wait = scheduler.seconds_till_next()
+    if wait and not Task.objects.filter(task_name=DISPATCH_TASK, locked_by__isnull=True).exists():
+        dispatch(schedule=int(wait) + 1)
+
+
+DISPATCH_TASK = 'djin.tasks.dispatch'
+
+
+def crawl_profile(insta, account):
+    """Collect new posts, then continue the backfill of older posts
+
+    Returns if the account still exists, private accounts are deleted.
+    """
+    insta.upsert_profile(account)
+    if account.pk is None:
+        logger.info(f'Account {account} was deleted')
+        return False
+    if not CrawlCursor.for_account(account).backfilled:
+        logger.info(f'Backfilling account {account}')
+        insta.upsert_profile(account, check_posts=settings.BACKFILL_POSTS, backfill=True)
+    return True
+
+
+def refresh_posts(account, workers=1):
+    """Refresh all posts of account, split over a number of browser sessions"""
+    post_pks = list(account.posts.values_list('pk', flat=True))
+    workers = max(1, min(workers, len(post_pks)))
+    chunks = [post_pks[i::workers] for i in range(workers)]
+    logger.info(f'Refreshing {len(post_pks)} posts of {account} with {workers} workers')
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # the workers record their stages into the run of this account
+        results = list(executor.map(in_run(lambda chunk: refresh_chunk(account, chunk)), chunks))
+    return summarize(account, results, workers, time.monotonic() - start)
+
+
+def not_indexed(account, error):
+    """Posts stored without their documents are written again by the next refresh"""
+    logger.error(f'Posts of {account} not all indexed: {error}')
+    Post.objects.filter(pk__in=error.post_pks).update(fingerprint=None)
+
+
+def summarize(account, results, workers, elapsed):
+    """Throughput summary of a refresh"""
+    summary = {
+        'posts': sum(sum(r.values()) for r in results),
+        'updated': sum(r['updated'] for r in results),
+        'skipped': sum(r['skipped'] for r in results),
+        'deleted': sum(r['deleted'] for r in results),
+        'failed': sum(r['failed'] for r in results),
+        'workers': workers,
+        'seconds': round(elapsed, 1),
+    }
+    summary['per_second'] = round(summary['updated'] / elapsed, 2) if elapsed else 0
+    for result in ('updated', 'skipped', 'deleted', 'failed'):
+        POSTS.inc(summary[result], result=result)
+    logger.info(f'Refreshed posts of {account}: {summary}')
+    return summary
+
+
+def refresh_chunk(account, post_pks):
+    """Refresh a chunk of posts in its own browser session
+
+    Failures are contained per post, and a browser that cannot start only
+    fails its own chunk.
+    """
+    result = {'updated': 0, 'skipped': 0, 'deleted': 0, 'failed': 0}
+    try:
+        with Instagram(account) as insta, bulk_indexer() as indexer:
+            for post in with_post_relations(Post.objects.filter(pk__in=post_pks)):
+                try:
+                    logger.info(f'Updating post {post}')
+                    changed = insta.upsert_post(post)
+                    # post was removed from instagram
+                    if post.pk is None:
+                        result['deleted'] += 1
+                        continue
+                    if not changed:
+                        result['skipped'] += 1
+                        continue
+                    indexer.add_post(post)
+                except Exception:
+                    logger.exception(f'Failed updating post {post}')
+                    result['failed'] += 1
+                else:
+                    result['updated'] += 1
+    except BulkIndexError as e:
+        not_indexed(account, e)
+        # posts the chunk did not get to count as failed
+        result['failed'] = len(post_pks) - result['updated'] - result['skipped'] - result['deleted']
+    except Exception:
+        logger.exception(f'Worker for {account} failed')
+        result['failed'] = len(post_pks) - result['updated'] - result['skipped'] - result['deleted']
+    finally:
+        # every thread gets its own connection
+        connection.close()
+    return result
+
+
+def refresh_posts_http(insta, account):
+    """Refresh all posts of account without a browser, many requests at once"""
+    posts = list(with_post_relations(account.posts.all()))
+    batch = settings.FETCH['batch']
+    logger.info(f'Refreshing {len(posts)} posts of {account} over http')
+
+    result = {'updated': 0, 'skipped': 0, 'deleted': 0, 'failed': 0}
+    start = time.monotonic()
+    try:
+        with bulk_indexer() as indexer:
+            for i in range(0, len(posts), batch):
+                for post, changed, error in insta.upsert_posts(posts[i:i + batch]):
+                    if error:
+                        logger.error(f'Failed updating post {post}: {error}')
+                        result['failed'] += 1
+                    elif post.pk is None:
+                        result['deleted'] += 1
+                    elif not changed:
+                        result['skipped'] += 1
+                    else:
+                        indexer.add_post(post)
+                        result['updated'] += 1
+    except BulkIndexError as e:
+        not_indexed(account, e)
+        result['failed'] = len(posts) - result['updated'] - result['skipped'] - result['deleted']
+    return summarize(account, [result], insta.fetcher.concurrency, time.monotonic() - start)
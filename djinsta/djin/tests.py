@@ -1,3 +1,1237 @@
-from django.test import TestCase
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import urlparse
 
-# Create your tests here.
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import OperationalError, connection, transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from selenium.common.exceptions import NoSuchElementException, WebDriverException
+
+from . import scheduler, tasks
+from .browser import BrowserError, DriverPool, DriverPoolExhausted, apply_preset
+from .bench import FakeDriver, profile_page, run as run_bench, write_run
+from .cache import GENERATION_KEY, LRUCache, SearchCache
+from .fetch import FetchError, HttpInstagram
+from .instagram import HARVEST_SCRIPT, MEDIA_CHEVRON, MEDIA_SCRIPT, Instagram, PostPage, ProfilePage
+from .geo import gazetteer, geocode
+from .metrics import Registry, STAGE_SECONDS, in_run, run_summary, timed
+from .elastic import (
+    VERSION_KEY, VERSION_TTL, BulkIndexer, build_account_doc, build_post_doc, current_version, post_index)
+from .embedded import WhooshBackend
+from .insight import (
+    BulkIndexError, account_facets, backend, bulk_indexer, get_account, get_posts, index_account, index_post, with_post_relations)
+from .models import Account, AccountHistory, AccountRollup, CrawlCursor, Post, PostHistory, RateBucket, Tag, Location, Media
+from .parsers import PostPageError, parse_post, parse_profile
+from .phash import HashIndex, distance, hash_images, index, signed, unsigned
+from .storage import MediaDownloader, partial_path
+from .throttle import RateLimiter
+from .views import account_posts_view, duplicates_view, heatmap_view, metrics_view
+
+
+# index writes bump the generation in the shared cache, kept off the disk
+LOCAL_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class EmbeddedSearchTestCase(TestCase):
+    """Indexes into a whoosh index of its own instead of elasticsearch"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.search_path = tempfile.mkdtemp()
+        cls.search_settings = override_settings(
+            SEARCH_BACKEND={'class': 'djin.embedded.WhooshBackend', 'path': cls.search_path})
+        cls.search_settings.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.search_settings.disable()
+        shutil.rmtree(cls.search_path)
+
+
+class DocBuilderTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.account = Account.objects.create(username='djin')
+        tags = [Tag.objects.create(word=w) for w in ('Sea', 'sun', 'sand')]
+        for i in range(20):
+            location = Location.objects.create(code=str(i), name=f'Bondi, Sydney {i}')
+            post = Post.objects.create(account=cls.account, code=f'p{i}', location=location, count=i)
+            post.tags.set(tags)
+
+    def test_account_doc_queries_do_not_grow_with_posts(self):
+        with self.assertNumQueries(2):
+            doc = build_account_doc(self.account)
+        self.assertEqual(len(doc.posted_at), 20)
+        self.assertEqual(len(doc.tags), 60)
+        self.assertIn('bondi', doc.location)
+
+    def test_post_docs_query_once_for_posts_and_once_for_tags(self):
+        with self.assertNumQueries(2):
+            docs = [build_post_doc(p, version=1) for p in with_post_relations(self.account.posts.all())]
+        self.assertEqual(len(docs), 20)
+        self.assertEqual(sorted(docs[0].tags), ['sand', 'sea', 'sun'])
+
+    def test_docs_go_to_the_index_of_their_version_and_month(self):
+        post = self.account.posts.first()
+        doc = build_post_doc(post, version=3)
+        self.assertEqual(doc.meta.index, f'post-v3-{post.created_at:%Y.%m}')
+        self.assertEqual(build_account_doc(self.account, version=3).meta.index, 'account-v3')
+        self.assertEqual(build_account_doc(self.account).meta.index, 'account')
+
+    @override_settings(CACHES=LOCAL_CACHES)
+    @mock.patch('djin.elastic.current_version', return_value=2)
+    @mock.patch('djin.elastic.connections')
+    def test_indexer_removes_the_copies_of_posts_in_other_months(self, connections, current_version):
+        written, failed = with_post_relations(self.account.posts.order_by('pk')[:2])
+        indexer = BulkIndexer(size=10)
+
+        def send(actions):
+            for action in actions:
+                ok = action['_id'] == written.pk
+                yield ok, {'status': 201 if ok else 400}, action
+        with mock.patch.object(indexer, '_send', side_effect=send):
+            with self.assertRaises(BulkIndexError):
+                with indexer:
+                    indexer.add_post(written)
+                    indexer.add_post(failed)
+                    # a version being loaded has no copies elsewhere
+                    indexer.add_post(written, version=3)
+        query = connections.get_connection.return_value.delete_by_query.call_args.kwargs['body']['query']
+        self.assertEqual(query['bool']['should'], [{'bool': {
+            'filter': [{'ids': {'values': [written.pk]}}],
+            'must_not': [{'term': {'_index': post_index(written.created_at, 2)}}],
+        }}])
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class LayoutVersionTest(SimpleTestCase):
+
+    @mock.patch.dict('djin.elastic._version', {'number': None, 'read_at': 0})
+    @mock.patch('djin.elastic.connections')
+    def test_a_switch_reaches_the_other_processes(self, connections):
+        self.addCleanup(cache.clear)
+        get_alias = connections.get_connection.return_value.indices.get_alias
+        get_alias.return_value = {'account-v1': {}}
+        self.assertEqual(current_version(), 1)
+        # another process switched to the next version
+        cache.set(VERSION_KEY, 2, None)
+        self.assertEqual(current_version(), 1)
+        with mock.patch('djin.elastic.time.monotonic', return_value=time.monotonic() + VERSION_TTL + 1):
+            self.assertEqual(current_version(), 2)
+        get_alias.assert_called_once_with(name='account')
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class BulkIndexerTest(SimpleTestCase):
+    """Bulk responses are played back instead of sent to elasticsearch"""
+
+    def send(self, *statuses):
+        """Answer every attempt with the next statuses, one per action"""
+        attempts = iter(statuses)
+
+        def send(actions):
+            for action, status in zip(actions, next(attempts)):
+                yield status == 201, {'status': status, '_id': action['_id']}, action
+        return send
+
+    def actions(self, n):
+        return [{'_index': 'post', '_id': i, '_source': {}} for i in range(n)]
+
+    @mock.patch('djin.elastic.time.sleep')
+    def test_partially_failed_bulk_is_retried(self, sleep):
+        indexer = BulkIndexer(size=10, retries=3)
+        with mock.patch.object(indexer, '_send', side_effect=self.send((201, 503, 429), (201, 201))) as send:
+            with indexer:
+                indexer.buffer = self.actions(3)
+        self.assertEqual((indexer.indexed, indexer.failed), (3, 0))
+        self.assertEqual([a['_id'] for a in send.call_args_list[1].args[0]], [1, 2])
+        sleep.assert_called_once_with(2)
+
+    @mock.patch('djin.elastic.time.sleep')
+    def test_documents_failing_after_the_retries_raise(self, sleep):
+        indexer = BulkIndexer(size=10, retries=1)
+        with mock.patch.object(indexer, '_send', side_effect=self.send((201, 503, 400), (503,))):
+            with self.assertRaises(BulkIndexError) as raised:
+                with indexer:
+                    indexer.buffer = self.actions(3)
+        self.assertEqual((indexer.indexed, indexer.failed), (1, 2))
+        self.assertEqual([e['_id'] for e in indexer.errors], [2, 1])
+        self.assertEqual(raised.exception.post_pks, [2, 1])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class WhooshBackendTest(EmbeddedSearchTestCase):
+
+    def setUp(self):
+        self.account = Account.objects.create(username='djin', followers_count=10)
+        tags = [Tag.objects.create(word=w) for w in ('Sea', 'sun')]
+        location = Location.objects.create(code='1', name='Bondi, Sydney')
+        self.posts = [Post.objects.create(account=self.account, code=f'p{i}', location=location) for i in range(3)]
+        for post in self.posts:
+            post.tags.set(tags)
+        self.posts[0].tags.set(tags[:1])
+
+    def test_docs_are_indexed_looked_up_and_removed(self):
+        self.assertIsInstance(backend(), WhooshBackend)
+        index_account(self.account)
+        with bulk_indexer() as indexer:
+            for post in self.posts[:2]:
+                indexer.add_post(post)
+        self.assertEqual(get_account(self.account).followers_count, 10)
+        docs = get_posts(self.posts)
+        self.assertEqual(sorted(docs[0].tags), ['sea'])
+        self.assertIsNone(docs[2])
+
+        self.posts[0].delete()
+        self.assertIsNone(get_posts([self.posts[1], Post(pk=self.posts[0].pk)])[1])
+        self.account.delete()
+        self.assertIsNone(get_account(Account(pk=self.account.pk)))
+
+    def test_facets_count_accounts_per_tag_and_location(self):
+        other = Account.objects.create(username='other')
+        Post.objects.create(account=other, code='o').tags.set(Tag.objects.filter(word='sun'))
+        index_account(self.account)
+        index_account(other)
+        facets = account_facets()['facets']
+        self.assertEqual(facets['tags'], [('sun', 2, False), ('sea', 1, False)])
+        self.assertEqual(sorted(facets['locations']), [('bondi', 1, False), ('sydney', 1, False)])
+
+        # the cached facets are dropped by the next write
+        index_post(self.posts[2])
+        self.account.posts.all().delete()
+        index_account(self.account)
+        self.assertEqual(account_facets()['facets']['tags'], [('sun', 1, False)])
+
+
+def page_with_data(entry_data):
+    return f'<html><body><script>window._sharedData = {json.dumps({"entry_data": entry_data})};</script></body></html>'
+
+
+POST_NODE = {
+    'owner': {'username': 'djin'},
+    'taken_at_timestamp': 1520000000,
+    'is_video': False,
+    'edge_media_preview_like': {'count': 1200},
+    'edge_media_to_caption': {'edges': [{'node': {'text': 'Sunset #Bondi #sea'}}]},
+    'location': {'id': '123', 'name': 'Bondi Beach, Sydney'},
+    'edge_sidecar_to_children': {'edges': [
+        {'node': {'is_video': False, 'display_resources': [
+            {'src': 'https://cdn/a-640.jpg', 'config_width': 640},
+            {'src': 'https://cdn/a-1080.jpg', 'config_width': 1080},
+        ]}},
+        {'node': {'is_video': True, 'video_url': 'https://cdn/b.mp4', 'display_url': 'https://cdn/b.jpg'}},
+    ]},
+}
+
+
+class ParserTest(SimpleTestCase):
+
+    def test_post_from_page_json(self):
+        data = parse_post(page_with_data({'PostPage': [{'graphql': {'shortcode_media': POST_NODE}}]}))
+        self.assertEqual(data['popularity'], (1200, 'likes'))
+        self.assertEqual(data['tags'], ['bondi', 'sea'])
+        self.assertEqual(data['location'], ('123', 'Bondi Beach, Sydney'))
+        self.assertEqual(data['created_at'].year, 2018)
+        self.assertEqual([m['kind'] for m in data['media']], [Media.IMG, Media.VID])
+        self.assertEqual(data['media'][0], {'kind': Media.IMG, 'source': 'https://cdn/a-1080.jpg', 'size': 1080})
+
+    def test_post_from_html(self):
+        source = '''<html><body><article>
+            <header><div><div><div><a href="/djin/">djin</a></div></div></div>
+            <div><div></div><div><a href="/explore/locations/99/bondi/">Bondi, Sydney</a></div></div></header>
+            <div><section><div>1,204 likes</div></section></div>
+            <ul><li><div><a>djin</a><span>Waves #Surf</span></div></li></ul>
+            <time datetime="2018-03-02T10:00:00.000Z"></time>
+        </article></body></html>'''
+        data = parse_post(source)
+        self.assertEqual(data['popularity'], (1204, 'likes'))
+        self.assertEqual(data['description'], 'Waves #Surf')
+        self.assertEqual(data['tags'], ['surf'])
+        self.assertEqual(data['location'], ('99', 'Bondi, Sydney'))
+        self.assertIsNone(data['media'])
+
+    def test_post_without_time_raises(self):
+        source = '<html><body><article><div><section><div>3 likes</div></section></div></article></body></html>'
+        with self.assertRaises(PostPageError):
+            parse_post(source)
+        node = {k: v for k, v in POST_NODE.items() if k != 'taken_at_timestamp'}
+        with self.assertRaises(PostPageError):
+            parse_post(page_with_data({'PostPage': [{'graphql': {'shortcode_media': node}}]}))
+
+    def test_deleted_post(self):
+        data = parse_post('<html><body><h2>Sorry, this page isn\'t available.</h2></body></html>')
+        self.assertTrue(data['deleted'])
+
+    def test_profile_from_page_json(self):
+        user = {
+            'is_private': False,
+            'biography': 'surf',
+            'external_url': None,
+            'edge_followed_by': {'count': 5000},
+            'edge_follow': {'count': 10},
+            'edge_owner_to_timeline_media': {
+                'count': 2,
+                'edges': [{'node': {'shortcode': 'Bxy'}}, {'node': {'shortcode': 'Baz'}}],
+                'page_info': {'has_next_page': True, 'end_cursor': 'QVF'},
+            },
+        }
+        data = parse_profile(page_with_data({'ProfilePage': [{'graphql': {'user': user}}]}))
+        self.assertFalse(data['private'])
+        self.assertEqual(data['followers_count'], 5000)
+        self.assertEqual(data['codes'], ['Bxy', 'Baz'])
+        self.assertEqual(data['end_cursor'], 'QVF')
+
+
+class RecordedPages(BaseHTTPRequestHandler):
+    """Serves recorded pages by path, anything else is not found"""
+
+    pages = {}
+    requests = []
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        self.requests.append((path, self.headers.get('Cookie')))
+        body = self.pages.get(path)
+        self.send_response(200 if body else 404)
+        self.send_header('Content-Type', 'text/html')
+        self.end_headers()
+        self.wfile.write((body or 'not found').encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class RereportingDriver(FakeDriver):
+    """A page that forgot its harvested codes and hands them over again"""
+
+    def execute_script(self, script, *args):
+        if script == HARVEST_SCRIPT:
+            return list(self.codes)
+        return super().execute_script(script, *args)
+
+
+class CarouselDriver(FakeDriver):
+    """A post page whose carousel loads the item after the next one on every click
+
+    A stuck carousel keeps its chevron but loads no more than `limit` items.
+    """
+
+    def __init__(self, count, limit=None, stuck=False):
+        super().__init__(profile='', post=lambda code: '<html></html>', codes=[])
+        self.items = [{
+            'kind': Media.IMG, 'source': f'https://cdn/{i}.jpg',
+            'srcset': f'https://cdn/{i}-640.jpg 640w,https://cdn/{i}.jpg 1080w',
+        } for i in range(count)]
+        self.limit = limit or count
+        self.stuck = stuck
+        self.position = 0
+        self.clicks = 0
+
+    def loaded(self):
+        return min(self.position + 2, self.limit)
+
+    def execute_script(self, script, *args):
+        if script == MEDIA_SCRIPT:
+            return self.items[:self.loaded()]
+        return super().execute_script(script, *args)
+
+    def click(self):
+        self.clicks += 1
+        self.position = min(self.position + 1, len(self.items) - 1)
+
+    def find_elements_by_xpath(self, xpath):
+        if xpath == MEDIA_CHEVRON and (self.stuck or self.position < len(self.items) - 1):
+            return [object()]
+        return []
+
+    def find_element_by_xpath(self, xpath):
+        if xpath == MEDIA_CHEVRON and not self.find_elements_by_xpath(xpath):
+            raise NoSuchElementException(xpath)
+        return object()
+
+
+class ClickActions:
+    """Action chains that click the chevron of a CarouselDriver"""
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    def move_to_element(self, element):
+        return self
+
+    def click(self, element):
+        self.driver.click()
+        return self
+
+    def perform(self):
+        pass
+
+
+@mock.patch('djin.instagram.ActionChains', ClickActions)
+@mock.patch.object(PostPage, 'MEDIA_WAIT', 0.2)
+class PostPageTest(SimpleTestCase):
+
+    def test_carousel_is_read_from_the_dom(self):
+        driver = CarouselDriver(5)
+        media = PostPage(driver, 'Bxy').media
+        self.assertEqual([m['source'] for m in media], [f'https://cdn/{i}.jpg' for i in range(5)])
+        self.assertEqual(media[0], {'kind': Media.IMG, 'source': 'https://cdn/0.jpg', 'size': 1080})
+        self.assertEqual(driver.clicks, 4)
+
+    def test_carousel_stops_when_a_click_loads_nothing(self):
+        driver = CarouselDriver(5, limit=3, stuck=True)
+        media = PostPage(driver, 'Bxy').media
+        self.assertEqual(len(media), 3)
+        self.assertEqual(driver.clicks, 2)
+
+
+class PoolDriver:
+    """Browser that records what is done to it"""
+
+    def __init__(self):
+        self.quit_count = 0
+        self.cookies = []
+        self.loaded = []
+        self.broken = False
+        self.refuse_cookies = False
+
+    @property
+    def current_url(self):
+        if self.quit_count or self.broken:
+            raise WebDriverException('browser is gone')
+        return self.loaded[-1] if self.loaded else 'about:blank'
+
+    def get(self, url):
+        self.loaded.append(url)
+
+    def delete_all_cookies(self):
+        self.cookies = []
+
+    def add_cookie(self, cookie):
+        if self.refuse_cookies:
+            raise WebDriverException('cookie refused')
+        self.cookies.append(cookie)
+
+    def quit(self):
+        self.quit_count += 1
+
+
+class DriverPoolTest(SimpleTestCase):
+
+    def setUp(self):
+        self.started = []
+        self.alice = Account(username='alice', cookies=json.dumps([{'name': 'sessionid', 'value': 'a'}]))
+        self.bob = Account(username='bob', cookies=json.dumps([{'name': 'sessionid', 'value': 'b'}]))
+
+    def factory(self):
+        driver = PoolDriver()
+        self.started.append(driver)
+        return driver
+
+    def pool(self, **options):
+        return DriverPool(self.factory, 'https://home', **{'size': 2, 'timeout': 0.1, **options})
+
+    def test_released_browser_is_reused_with_its_session(self):
+        pool = self.pool()
+        driver = pool.acquire(self.alice)
+        pool.release(driver)
+        self.assertIs(pool.acquire(self.alice), driver)
+        # the cookies are loaded once for the same session
+        self.assertEqual(driver.loaded, ['https://home'])
+        pool.release(driver)
+
+        self.assertIs(pool.acquire(self.bob), driver)
+        self.assertEqual(driver.cookies, [{'name': 'sessionid', 'value': 'b'}])
+        self.assertEqual(len(self.started), 1)
+
+    def test_browsers_are_recycled_after_max_uses(self):
+        pool = self.pool(max_uses=2)
+        for _ in range(2):
+            first = pool.acquire(self.alice)
+            pool.release(first)
+        self.assertEqual(first.quit_count, 1)
+        self.assertIsNot(pool.acquire(self.alice), first)
+
+    def test_idle_and_broken_browsers_are_not_handed_out(self):
+        pool = self.pool(max_idle=0)
+        idle = pool.acquire(self.alice)
+        pool.release(idle)
+        self.assertEqual(pool.evict_idle(), 1)
+        self.assertEqual(idle.quit_count, 1)
+
+        pool = self.pool()
+        broken = pool.acquire(self.alice)
+        pool.release(broken)
+        broken.broken = True
+        fresh = pool.acquire(self.alice)
+        self.assertIsNot(fresh, broken)
+        self.assertEqual(broken.quit_count, 1)
+
+    def test_failed_session_switch_frees_the_slot(self):
+        pool = self.pool(size=1)
+        driver = pool.acquire(self.alice)
+        pool.release(driver)
+        driver.refuse_cookies = True
+        with self.assertRaises(WebDriverException):
+            pool.acquire(self.bob)
+        self.assertEqual(driver.quit_count, 1)
+        # the slot of the discarded browser is free again
+        self.assertIsNot(pool.acquire(self.bob), driver)
+
+    def test_full_pool_times_out_and_foreign_browsers_are_refused(self):
+        pool = self.pool(size=1)
+        driver = pool.acquire(self.alice)
+        with self.assertRaises(DriverPoolExhausted):
+            pool.acquire(self.bob)
+        with self.assertRaises(BrowserError):
+            pool.release(PoolDriver())
+        pool.release(driver)
+        pool.close()
+        self.assertEqual(driver.quit_count, 1)
+
+    def test_browsers_out_when_closing_are_quit_on_release(self):
+        pool = self.pool()
+        busy = pool.acquire(self.alice)
+        pool.close()
+        self.assertEqual(busy.quit_count, 0)
+        pool.release(busy)
+        self.assertEqual(busy.quit_count, 1)
+
+
+class ApplyPresetTest(SimpleTestCase):
+
+    def test_blocked_types_given_override_the_settings(self):
+        driver = mock.Mock(spec=['execute_cdp_cmd'])
+        apply_preset(driver, 'none', [])
+        apply_preset(driver, 'none', [])
+        driver.execute_cdp_cmd.assert_called_with('Network.setBlockedURLs', {'urls': []})
+        self.assertEqual(driver.execute_cdp_cmd.call_count, 2)
+        apply_preset(driver, 'post')
+        self.assertIn('*.jpg*', driver.execute_cdp_cmd.call_args.args[1]['urls'])
+        self.assertNotIn('none', settings.BROWSER_PRESETS)
+
+
+class ProfilePageTest(SimpleTestCase):
+
+    def test_codes_handed_over_again_do_not_keep_the_harvest_going(self):
+        driver = RereportingDriver(profile_page('djin', 3), None, ['Ba', 'Bb', 'Bc'])
+        with mock.patch.object(ProfilePage, 'HARVEST_WAIT', 0.3):
+            codes = list(ProfilePage(driver, 'djin').posts)
+        self.assertEqual(codes, ['Ba', 'Bb', 'Bc'])
+
+
+@override_settings(RATE_LIMIT=None)
+class HttpInstagramTest(EmbeddedSearchTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        user = {
+            'id': '42',
+            'is_private': False,
+            'biography': 'surf',
+            'edge_followed_by': {'count': 5000},
+            'edge_follow': {'count': 10},
+            'edge_owner_to_timeline_media': {
+                'count': 2,
+                'edges': [{'node': {'shortcode': 'Bxy'}}, {'node': {'shortcode': 'Baz'}}],
+                'page_info': {'has_next_page': False, 'end_cursor': None},
+            },
+        }
+        RecordedPages.pages = {
+            '/djin/': page_with_data({'ProfilePage': [{'graphql': {'user': user}}]}),
+            '/p/Bxy/': page_with_data({'PostPage': [{'graphql': {'shortcode_media': POST_NODE}}]}),
+            '/p/Bok/': page_with_data({'PostPage': [{'graphql': {'shortcode_media': POST_NODE}}]}),
+        }
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), RecordedPages)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def test_profile_and_posts_are_stored_like_the_browser_does(self):
+        account = Account.objects.create(
+            username='djin', cookies=json.dumps([{'name': 'sessionid', 'value': 's3cret'}]))
+        with HttpInstagram(account, concurrency=2, base_url=self.base_url) as insta:
+            insta.upsert_profile(account)
+            self.assertEqual(account.followers_count, 5000)
+            self.assertEqual(sorted(account.posts.values_list('code', flat=True)), ['Baz', 'Bxy'])
+
+            results = list(insta.upsert_posts(list(account.posts.all())))
+            self.assertEqual([e for p, c, e in results if e], [])
+
+            # nothing changed on the second refresh
+            results = list(insta.upsert_posts(list(account.posts.all())))
+            self.assertEqual([c for p, c, e in results], [False])
+
+        # Baz is not found, so it was deleted
+        post = account.posts.get()
+        self.assertEqual(post.code, 'Bxy')
+        self.assertEqual(post.count, 1200)
+        self.assertEqual(sorted(post.tags.values_list('word', flat=True)), ['bondi', 'sea'])
+        self.assertEqual(post.media.count(), 2)
+        self.assertIn(('/djin/', 'sessionid=s3cret'), RecordedPages.requests)
+
+    def test_a_failing_post_only_skips_itself(self):
+        account = Account.objects.create(username='djin')
+        for code in ('Bxy', 'Bok', 'Baz'):
+            Post.objects.create(account=account, code=code)
+        save_post = Instagram.save_post
+
+        def fail_bxy(post, *args):
+            if post.code == 'Bxy':
+                raise ValueError('broken post')
+            return save_post(post, *args)
+
+        with HttpInstagram(account, base_url=self.base_url) as insta, \
+                mock.patch.object(Instagram, 'save_post', staticmethod(fail_bxy)):
+            results = {p.code: (c, e) for p, c, e in insta.upsert_posts(list(account.posts.all()))}
+
+        self.assertIsInstance(results['Bxy'][1], ValueError)
+        self.assertEqual(results['Bok'], (True, None))
+        self.assertEqual(results['Baz'], (True, None))
+        self.assertEqual(sorted(account.posts.values_list('code', 'count')), [('Bok', 1200), ('Bxy', None)])
+        # the tags of the failed post were saved apart and stay usable
+        self.assertEqual(Tag.objects.filter(word__in=['bondi', 'sea']).count(), 2)
+
+
+@override_settings(RATE_LIMIT=None)
+class BackfillTest(TestCase):
+    """A profile of 50 codes followed by timeline pages c1 to c5 of 50 codes"""
+
+    def setUp(self):
+        self.account = Account.objects.create(username='djin')
+        self.pages = {
+            f'c{p}': ([f'P{p}x{i:02d}' for i in range(50)], f'c{p + 1}' if p < 5 else None) for p in range(1, 6)}
+        self.profile = {
+            'private': False, 'id': '42', 'posts_count': 300, 'followers_count': 10, 'following_count': 1,
+            'bio': '', 'website': None, 'codes': [f'P0x{i:02d}' for i in range(50)], 'end_cursor': 'c1',
+        }
+
+    def backfill(self, fail_at=None):
+        insta = HttpInstagram(self.account)
+
+        async def profile(username):
+            return self.profile
+
+        async def timeline(user_id, after):
+            if after == fail_at:
+                raise FetchError(f'Timeline after {after} failed')
+            return self.pages[after]
+
+        insta.fetcher.profile, insta.fetcher.timeline = profile, timeline
+        try:
+            insta.upsert_profile(self.account, check_posts=1000, backfill=True)
+        finally:
+            insta.fetcher.db_executor.shutdown()
+            insta.loop.close()
+
+    def test_timeline_cursor_is_saved_with_the_codes_it_covers(self):
+        with self.assertRaises(FetchError):
+            self.backfill(fail_at='c3')
+        cursor = CrawlCursor.for_account(self.account)
+        # the codes of page c2 were not stored yet, so it is fetched again
+        self.assertEqual(self.account.posts.count(), 100)
+        self.assertEqual((cursor.oldest_code, cursor.end_cursor), ('P1x49', 'c1'))
+        self.assertFalse(cursor.backfilled)
+
+    def test_backfill_resumes_without_skipping_codes(self):
+        with self.assertRaises(FetchError):
+            self.backfill(fail_at='c3')
+        self.backfill()
+        cursor = CrawlCursor.for_account(self.account)
+        expected = set(self.profile['codes']).union(*(codes for codes, after in self.pages.values()))
+        self.assertEqual(set(self.account.posts.values_list('code', flat=True)), expected)
+        self.assertEqual((cursor.oldest_code, cursor.backfilled), ('P5x49', True))
+
+
+@override_settings(ACCOUNT_PAGE_SIZE=2)
+class PostsPageTest(EmbeddedSearchTestCase):
+
+    def setUp(self):
+        self.account = Account.objects.create(username='djin')
+        posts = [Post.objects.create(account=self.account, code=f'p{i}') for i in range(5)]
+        # three posts share a time, the pk breaks the tie
+        at = timezone.now()
+        Post.objects.filter(pk__in=[p.pk for p in posts[1:4]]).update(created_at=at)
+        Post.objects.filter(pk=posts[0].pk).update(created_at=at - timedelta(hours=1))
+        Post.objects.filter(pk=posts[4].pk).update(created_at=at + timedelta(hours=1))
+        self.expected = [posts[i].pk for i in (4, 3, 2, 1, 0)]
+
+    def page(self, cursor=None):
+        request = RequestFactory().get('/posts', {'cursor': cursor} if cursor else {})
+        return account_posts_view(request, self.account.pk)
+
+    def test_pages_cover_every_post_once_across_ties(self):
+        pks, cursor, pages = [], None, 0
+        while True:
+            data = json.loads(self.page(cursor).content)
+            pks.extend(p['pk'] for p in data['posts'])
+            pages += 1
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(pks, self.expected)
+        self.assertEqual(pages, 3)
+
+    def test_malformed_cursor_is_a_bad_request(self):
+        for cursor in ('nonsense', '2018-03-05T10:00:00|x', '|12', '2018-13-45T10:00:00|3'):
+            self.assertEqual(self.page(cursor).status_code, 400)
+
+
+class TagTest(TestCase):
+
+    def setUp(self):
+        Tag.pks.clear()
+        self.addCleanup(Tag.pks.clear)
+
+    def test_existing_and_new_tags_resolve_in_bulk(self):
+        sea = Tag.objects.create(word='sea')
+        with self.captureOnCommitCallbacks(execute=True):
+            pks = Tag.resolve(['sea', 'sun', 'sun'])
+        sun = Tag.objects.get(word='sun')
+        self.assertEqual(sorted(pks), sorted([sea.pk, sun.pk]))
+        self.assertEqual(Tag.pks, {'sea': sea.pk, 'sun': sun.pk})
+        with self.assertNumQueries(0):
+            Tag.resolve(['sun'])
+
+    def test_tags_of_a_rolled_back_transaction_are_not_cached(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                Tag.resolve(['gone'])
+                transaction.set_rollback(True)
+        self.assertEqual(Tag.pks, {})
+        self.assertFalse(Tag.objects.filter(word='gone').exists())
+
+
+class HistoryTest(TestCase):
+
+    def test_snapshot_writes_every_post_once_per_day(self):
+        account = Account.objects.create(username='djin')
+        for i in range(30):
+            Post.objects.create(account=account, code=f'p{i}', count=10, kind='likes')
+        Post.objects.create(account=account, code='video', count=5000, kind='views')
+        with self.assertNumQueries(2):
+            likes = PostHistory.snapshot(account)
+        # the views of the video are recorded but not counted as likes
+        self.assertEqual(likes, 300)
+        self.assertEqual(PostHistory.objects.count(), 31)
+        account.posts.update(count=20)
+        self.assertEqual(PostHistory.snapshot(account), 600)
+        self.assertEqual(list(PostHistory.objects.values_list('count', flat=True).distinct()), [20])
+
+    def test_growth_from_rollups(self):
+        accounts = [Account.objects.create(username=n) for n in ('a', 'b')]
+        for account, step in zip(accounts, (10, 100)):
+            for day in (5, 6, 12, 13):
+                account.followers_count = day * step
+                AccountRollup.record(account, likes=day, date=date(2018, 3, day))
+        growth = AccountRollup.growth(accounts, AccountRollup.WEEK)
+        self.assertEqual(growth[accounts[0].pk], [(date(2018, 3, 5), 10, 1), (date(2018, 3, 12), 70, 7)])
+        self.assertEqual(growth[accounts[1].pk][1], (date(2018, 3, 12), 700, 7))
+
+
+@override_settings(SCHEDULER={'max_in_flight': 2, 'min_interval': 3600, 'max_interval': 86400, 'activity_days': 7})
+class SchedulerTest(TestCase):
+
+    def test_claims_longest_waiting_accounts_up_to_the_cap(self):
+        now = timezone.now()
+        for i in range(4):
+            Account.objects.create(username=f'a{i}', next_run_at=now - timedelta(minutes=i))
+        Account.objects.create(username='later', next_run_at=now + timedelta(hours=1))
+        Account.objects.create(username='busy', processing=True, next_run_at=now - timedelta(days=1))
+
+        claimed = Account.objects.filter(pk__in=scheduler.claim(2))
+        self.assertEqual([a.username for a in claimed], ['a3'])
+        self.assertEqual(scheduler.queue_stats()['depth'], 3)
+        self.assertEqual(scheduler.claim(2), [])
+
+    def test_failed_run_releases_its_claim(self):
+        account = Account.objects.create(username='djin', next_run_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(scheduler.claim(1), [account.pk])
+        release = tasks.finished.now
+        with mock.patch('djin.tasks.Instagram'), \
+                mock.patch('djin.tasks.crawl_profile', side_effect=ValueError('crawl broke')), \
+                mock.patch('djin.tasks.finished', side_effect=release) as finished:
+            with self.assertRaises(ValueError):
+                tasks.my_profile.now(account.pk)
+        finished.assert_called_once_with(account.pk)
+        self.assertFalse(Account.objects.get(pk=account.pk).processing)
+        self.assertEqual(scheduler.queue_stats()['in_flight'], 0)
+
+    def test_active_accounts_are_refreshed_more_often(self):
+        quiet, active = Account.objects.create(username='quiet'), Account.objects.create(username='active')
+        today = timezone.localdate()
+        for account, posts in ((quiet, 0), (active, 10)):
+            AccountHistory.objects.create(
+                account=account, date=today - timedelta(days=2),
+                posts_count=100, followers_count=1000, following_count=1)
+            AccountHistory.objects.create(
+                account=account, date=today, posts_count=100 + posts, followers_count=1000, following_count=1)
+        self.assertEqual(scheduler.refresh_interval(quiet), 86400)
+        self.assertEqual(scheduler.refresh_interval(active), 14400)
+
+
+class ClaimTest(TransactionTestCase):
+
+    def test_dispatchers_at_once_stay_within_the_cap(self):
+        due = timezone.now() - timedelta(minutes=1)
+        Account.objects.bulk_create([Account(username=f'a{i}', next_run_at=due) for i in range(8)])
+        barrier = threading.Barrier(4)
+        due_accounts = scheduler.due_accounts
+
+        def slow_due_accounts():
+            # widens the window between counting and claiming
+            time.sleep(0.05)
+            return due_accounts()
+
+        def dispatch():
+            barrier.wait()
+            try:
+                while True:
+                    try:
+                        return scheduler.claim(3)
+                    except OperationalError:
+                        # the in-memory test database fails on a held lock
+                        # where a database file waits for it
+                        time.sleep(0.01)
+            finally:
+                connection.close()
+        with mock.patch('djin.scheduler.due_accounts', side_effect=slow_due_accounts), \
+                ThreadPoolExecutor(max_workers=4) as executor:
+            claimed = [pk for pks in executor.map(lambda _: dispatch(), range(4)) for pk in pks]
+        self.assertEqual(len(claimed), 3)
+        self.assertEqual(len(set(claimed)), 3)
+        self.assertEqual(Account.objects.filter(processing=True).count(), 3)
+
+
+class DeletedAccountTest(EmbeddedSearchTestCase):
+
+    def test_deleted_account_stops_its_run(self):
+        account = Account.objects.create(username='djin', next_run_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(scheduler.claim(1), [account.pk])
+
+        def crawl_profile(insta, account):
+            account.delete()
+            return False
+        with mock.patch('djin.tasks.Instagram'), \
+                mock.patch('djin.tasks.crawl_profile', side_effect=crawl_profile), \
+                mock.patch('djin.tasks.refresh_posts') as refresh_posts, \
+                mock.patch('djin.tasks.store_media') as store_media, \
+                mock.patch('djin.tasks.finished') as finished, \
+                mock.patch('djin.tasks.dispatch') as dispatch:
+            tasks.my_profile.now(account.pk)
+        refresh_posts.assert_not_called()
+        store_media.assert_not_called()
+        finished.assert_not_called()
+        dispatch.assert_called_once_with()
+        self.assertEqual(scheduler.queue_stats()['in_flight'], 0)
+
+
+class RefreshChunkTest(TestCase):
+
+    @mock.patch('djin.tasks.connection')
+    @mock.patch('djin.tasks.bulk_indexer')
+    @mock.patch('djin.tasks.Instagram')
+    def test_a_failing_post_does_not_abort_the_chunk(self, instagram, bulk_indexer, connection):
+        account = Account.objects.create(username='djin')
+        posts = [Post.objects.create(account=account, code=c) for c in ('Ba', 'Bb', 'Bc', 'Bd')]
+
+        def upsert_post(post):
+            if post.code == 'Bb':
+                raise PostPageError('Post page has no time it was posted')
+            return post.code != 'Bd'
+        insta = instagram.return_value.__enter__.return_value
+        insta.upsert_post.side_effect = upsert_post
+        indexer = bulk_indexer.return_value.__enter__.return_value
+
+        result = tasks.refresh_chunk(account, [p.pk for p in posts])
+        self.assertEqual(result, {'updated': 2, 'skipped': 1, 'deleted': 0, 'failed': 1})
+        self.assertEqual(insta.upsert_post.call_count, 4)
+        self.assertEqual(sorted(c.args[0].code for c in indexer.add_post.call_args_list), ['Ba', 'Bc'])
+        connection.close.assert_called_once_with()
+
+    @mock.patch('djin.tasks.connection')
+    @mock.patch('djin.tasks.bulk_indexer')
+    @mock.patch('djin.tasks.Instagram')
+    def test_posts_not_indexed_are_refreshed_again(self, instagram, bulk_indexer, connection):
+        account = Account.objects.create(username='djin')
+        posts = [Post.objects.create(account=account, code=c, fingerprint='f') for c in ('Ba', 'Bb', 'Bc')]
+        instagram.return_value.__enter__.return_value.upsert_post.return_value = True
+        bulk_indexer.return_value.__exit__.side_effect = BulkIndexError('1 failed', [posts[1].pk])
+
+        result = tasks.refresh_chunk(account, [p.pk for p in posts])
+        self.assertEqual(result, {'updated': 3, 'skipped': 0, 'deleted': 0, 'failed': 0})
+        self.assertEqual(
+            dict(Post.objects.values_list('code', 'fingerprint')), {'Ba': 'f', 'Bb': None, 'Bc': 'f'})
+
+
+@override_settings(RATE_LIMIT={
+    'global_rate': 10.0, 'account_rate': 10.0, 'burst': 2, 'min_factor': 0.05, 'recover': 0.5, 'backoff': 1})
+class RateLimiterTest(TestCase):
+
+    def test_backs_off_when_throttled_and_recovers_when_clean(self):
+        limiter = RateLimiter(Account.objects.create(username='djin'))
+        self.assertEqual(limiter._take(), 0)
+        self.assertEqual(limiter._take(), 0)
+        # burst used up, the next token is a tenth of a second away
+        self.assertAlmostEqual(limiter._take(), 0.1, places=1)
+
+        limiter.throttled()
+        self.assertGreater(limiter._take(), 1)
+        self.assertEqual(set(RateBucket.objects.values_list('factor', flat=True)), {0.5})
+
+        limiter.clean()
+        self.assertEqual(set(RateBucket.objects.values_list('factor', flat=True)), {1})
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SearchCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_lru_evicts_least_recently_used(self):
+        lru = LRUCache(maxsize=2, timeout=60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual((lru.get('a'), lru.get('b'), lru.get('c')), (1, None, 3))
+
+    def test_results_are_cached_till_invalidated(self):
+        cache = SearchCache(maxsize=8, timeout=60)
+        computed = []
+
+        def compute():
+            computed.append(1)
+            return {'facets': len(computed)}
+
+        self.assertEqual(cache.get_or_set('facets', {'q': 'sea'}, compute), {'facets': 1})
+        self.assertEqual(cache.get_or_set('facets', {'q': 'sea'}, compute), {'facets': 1})
+        cache.local.clear()
+        self.assertEqual(cache.get_or_set('facets', {'q': 'sea'}, compute), {'facets': 1})
+        cache.invalidate()
+        self.assertEqual(cache.get_or_set('facets', {'q': 'sea'}, compute), {'facets': 2})
+
+        stats = cache.stats()
+        self.assertEqual((stats['local_hits'], stats['shared_hits'], stats['misses']), (1, 1, 2))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_lost_generation_does_not_serve_old_results(self):
+        cache = SearchCache(maxsize=8, timeout=60)
+        cache.get_or_set('facets', {'q': 'sea'}, lambda: {'facets': 'old'})
+        cache.invalidate()
+        cache.get_or_set('facets', {'q': 'sea'}, lambda: {'facets': 'old'})
+        cache.shared.delete(GENERATION_KEY)
+        cache.invalidate()
+        cache.local.clear()
+        self.assertEqual(cache.get_or_set('facets', {'q': 'sea'}, lambda: {'facets': 'new'}), {'facets': 'new'})
+
+        cache.shared.delete(GENERATION_KEY)
+        cache._generation = None
+        self.assertEqual(cache.get_or_set('facets', {'q': 'sea'}, lambda: {'facets': 'newer'}), {'facets': 'newer'})
+
+
+def geonames_row(name, lat, lng, population, alternates=''):
+    return '\t'.join(['1', name, name, alternates, str(lat), str(lng), 'P', 'PPL', 'AU'] + [''] * 5 + [str(population)])
+
+
+class GeoTest(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.txt')
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join([
+                geonames_row('Sydney', -33.87, 151.21, 4600000),
+                geonames_row('Sydney', 46.14, -60.18, 30000),
+                geonames_row('Cape Town', -33.93, 18.42, 3400000, alternates='Kaapstad'),
+            ]))
+        gazetteer.cache_clear()
+        self.addCleanup(os.remove, self.path)
+        self.addCleanup(gazetteer.cache_clear)
+
+    def test_locations_resolve_to_the_most_populous_place_of_a_part(self):
+        with self.settings(GAZETTEER=self.path):
+            bondi = geocode(Location.objects.create(code='1', name='Bondi Beach, Sydney'))
+            kaapstad = geocode(Location.objects.create(code='2', name='Kaapstad'))
+            nowhere = geocode(Location.objects.create(code='3', name='Atlantis'))
+        self.assertEqual(bondi.point(), {'lat': -33.87, 'lon': 151.21})
+        self.assertEqual(kaapstad.point(), {'lat': -33.93, 'lon': 18.42})
+        self.assertIsNone(nowhere.point())
+        self.assertTrue(Location.objects.get(code='3').geocoded)
+
+    def test_post_doc_has_the_point_of_its_location(self):
+        with self.settings(GAZETTEER=self.path):
+            location = geocode(Location.objects.create(code='1', name='Sydney'))
+        post = Post.objects.create(account=Account.objects.create(username='djin'), code='p', location=location)
+        self.assertEqual(build_post_doc(post, version=1).geo, {'lat': -33.87, 'lon': 151.21})
+
+    @mock.patch('djin.views.post_heatmap', return_value={'bounds': None, 'cells': []})
+    def test_heatmap_rejects_bad_parameters(self, post_heatmap):
+        for query in ('precision=x', 'precision=0', 'precision=13', 'bounds=1,2,3',
+                      'bounds=a,b,c,d', 'bounds=-10,0,10,20', 'bounds=95,0,10,20'):
+            response = heatmap_view(RequestFactory().get(f'/heatmap?{query}'))
+            self.assertEqual(response.status_code, 400, query)
+        response = heatmap_view(RequestFactory().get('/heatmap?precision=3&bounds=10,170,-10,-170'))
+        self.assertEqual(response.status_code, 200)
+        post_heatmap.assert_called_once_with(3, [10, 170, -10, -170], None)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class BenchTest(TestCase):
+
+    def test_pipeline_runs_offline_and_leaves_nothing_behind(self):
+        result = run_bench(30)
+        self.assertEqual(result['stages']['post']['count'], 30)
+        self.assertEqual(result['stages']['load']['count'], 31)
+        self.assertEqual(set(result['stages']['store']), {'count', 'mean', 'p50', 'p90', 'p99', 'max'})
+        self.assertGreater(result['queries_per_post'], 0)
+        self.assertFalse(Account.objects.exists())
+
+    def test_writes_are_committed_in_batches_and_cleaned_up(self):
+        result = write_run(25, batch=10)
+        self.assertEqual(result['stages']['save']['count'], 25)
+        self.assertEqual(result['stages']['transaction']['count'], 3)
+        self.assertEqual(result['locked'], 0)
+        self.assertFalse(Post.objects.exists())
+
+
+class DatabaseTest(TestCase):
+
+    def test_sqlite_connections_get_the_pragmas(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], -64000)
+
+
+class MetricsTest(SimpleTestCase):
+
+    def test_stages_of_worker_threads_are_summarized_in_the_run(self):
+        before = STAGE_SECONDS.count(stage='test_stage')
+
+        @timed('test_stage')
+        def work(n):
+            return n * 2
+
+        with run_summary('djin') as summary:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                self.assertEqual(list(executor.map(in_run(work), range(4))), [0, 2, 4, 6])
+        # outside of the run only the histogram counts
+        work(5)
+        self.assertEqual(summary.as_dict()['test_stage']['count'], 4)
+        self.assertEqual(STAGE_SECONDS.count(stage='test_stage'), before + 5)
+
+    def test_histograms_render_in_the_prometheus_format(self):
+        registry = Registry()
+        histogram = registry.histogram('test_seconds', 'Test', ('stage',), buckets=(0.1, 1))
+        registry.counter('test_pages', 'Test').inc(3)
+        histogram.observe(0.5, stage='load')
+        histogram.observe(2, stage='load')
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP test_seconds Test',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{stage="load",le="0.1"} 0',
+            'test_seconds_bucket{stage="load",le="1"} 1',
+            'test_seconds_bucket{stage="load",le="+Inf"} 2',
+            'test_seconds_sum{stage="load"} 2.5',
+            'test_seconds_count{stage="load"} 2',
+            '# HELP test_pages Test',
+            '# TYPE test_pages counter',
+            'test_pages_total 3',
+        ])
+
+    def test_metrics_view_serves_the_registry(self):
+        with timed('test_view'):
+            pass
+        response = metrics_view(RequestFactory().get('/metrics'))
+        self.assertIn(b'djin_stage_seconds_count{stage="test_view"} 1', response.content)
+
+
+class MediaFiles(BaseHTTPRequestHandler):
+    """Serves files by path with byte ranges"""
+
+    files = {}
+    requests = []
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        self.requests.append((path, self.headers.get('Range')))
+        body = self.files.get(path)
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        start = int(self.headers['Range'][6:-1]) if self.headers.get('Range') else 0
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class MediaDownloaderTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        MediaFiles.files = {'/a.jpg': b'sunset' * 1000, '/copy.jpg': b'sunset' * 1000, '/b.jpg': b'sea' * 500}
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), MediaFiles)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        MediaFiles.requests = []
+        account = Account.objects.create(username='djin')
+        self.posts = [Post.objects.create(account=account, code=c) for c in ('p1', 'p2')]
+
+    def media(self, post, path):
+        return Media.objects.create(post=post, kind=Media.IMG, source=self.base_url + path)
+
+    def test_files_are_stored_once_by_content_and_not_fetched_again(self):
+        media = [
+            self.media(self.posts[0], '/a.jpg'),
+            self.media(self.posts[1], '/a.jpg'),
+            self.media(self.posts[1], '/copy.jpg'),
+            self.media(self.posts[1], '/b.jpg'),
+        ]
+        self.assertEqual(MediaDownloader(self.root, concurrency=2).download(media), [])
+        a, a_again, copy, b = [Media.objects.get(pk=m.pk) for m in media]
+        self.assertEqual(a.sha256, hashlib.sha256(b'sunset' * 1000).hexdigest())
+        self.assertEqual(a.byte_size, 6000)
+        self.assertEqual({a.local_path, a_again.local_path, copy.local_path}, {a.local_path})
+        self.assertNotEqual(a.local_path, b.local_path)
+        self.assertTrue(a.url.startswith('/media/'))
+        # one request per url, the same url of another post is fetched once
+        self.assertEqual(len(MediaFiles.requests), 3)
+
+        new = self.media(self.posts[0], '/b.jpg')
+        self.assertEqual(MediaDownloader(self.root).download([a, new]), [])
+        self.assertEqual(len(MediaFiles.requests), 3)
+        self.assertEqual(Media.objects.get(pk=new.pk).local_path, b.local_path)
+
+    def test_broken_off_download_resumes_from_its_bytes(self):
+        media = self.media(self.posts[0], '/a.jpg')
+        partial = partial_path(self.root, media.source)
+        os.makedirs(os.path.dirname(partial))
+        with open(partial, 'wb') as f:
+            f.write((b'sunset' * 1000)[:2500])
+
+        self.assertEqual(MediaDownloader(self.root).download([media]), [])
+        self.assertEqual(MediaFiles.requests, [('/a.jpg', 'bytes=2500-')])
+        media.refresh_from_db()
+        self.assertEqual(media.sha256, hashlib.sha256(b'sunset' * 1000).hexdigest())
+        with open(os.path.join(self.root, media.local_path), 'rb') as f:
+            self.assertEqual(f.read(), b'sunset' * 1000)
+        self.assertFalse(os.path.exists(partial))
+
+    def test_missing_files_are_reported_and_left_for_later(self):
+        media = self.media(self.posts[0], '/gone.jpg')
+        failed = MediaDownloader(self.root).download([media])
+        self.assertEqual([m for m, error in failed], [media])
+        media.refresh_from_db()
+        self.assertIsNone(media.local_path)
+
+
+
+class HashIndexTest(SimpleTestCase):
+
+    def test_hashes_within_the_radius_are_found_and_clustered(self):
+        hashes = HashIndex(radius=8, chunks=4)
+        base = 0xF0F0_1234_ABCD_8001
+        # six bits flipped over three chunks, two at most in each
+        near = base ^ 0x0001_0003_0000_0070
+        chained = near ^ 0x0700_0000_0000_0000
+        far = ~base & (1 << 64) - 1
+        for key, h in enumerate([base, near, chained, far, base]):
+            hashes.add(key, h)
+
+        self.assertEqual(distance(base, near), 6)
+        self.assertEqual(hashes.search(base), [(0, 0), (4, 0), (1, 6)])
+        self.assertEqual(hashes.search(base, radius=5), [(0, 0), (4, 0)])
+        # chained is too far from base, but joins it through near
+        self.assertEqual([sorted(c) for c in hashes.clusters()], [[0, 1, 2, 4]])
+        self.assertEqual(len(hashes), 5)
+
+    def test_hashes_fit_a_signed_bigint(self):
+        h = 0xFFFF_0000_0000_0001
+        self.assertLess(signed(h), 0)
+        self.assertEqual(unsigned(signed(h)), h)
+
+
+class DuplicatesTest(TestCase):
+
+    def setUp(self):
+        self.media = []
+        for username, h in (('a', 0b1011), ('b', 0b1111), ('c', 0x7FFF_FFFF_0000_0000)):
+            post = Post.objects.create(account=Account.objects.create(username=username), code=username)
+            self.media.append(Media.objects.create(
+                post=post, kind=Media.IMG, source=f'https://cdn/{username}.jpg',
+                local_path=f'{username}.jpg', sha256=username, phash=h))
+        index_settings = self.settings(PHASH={'radius': 8, 'chunks': 4})
+        index_settings.enable()
+        self.addCleanup(index_settings.disable)
+
+    def test_stored_copies_of_hashed_files_are_added_to_the_loaded_index(self):
+        self.assertEqual([sorted(c) for c in index().clusters()], [[self.media[0].pk, self.media[1].pk]])
+        # the same file as c, its hash is reused without opening the file
+        repost = Media.objects.create(
+            post=Post.objects.create(account=Account.objects.create(username='d'), code='d'),
+            kind=Media.IMG, source='https://cdn/d.jpg', local_path='c.jpg', sha256='c')
+        self.assertEqual(hash_images([repost], root='/nonexistent'), [repost])
+        self.assertEqual(Media.objects.get(pk=repost.pk).phash, 0x7FFF_FFFF_0000_0000)
+        self.assertEqual(len(index().clusters()), 2)
+
+    def test_images_hashed_by_other_processes_are_caught_up(self):
+        repost = Media.objects.create(
+            post=Post.objects.create(account=Account.objects.create(username='d'), code='d'),
+            kind=Media.IMG, source='https://cdn/d.jpg', local_path='d.jpg', sha256='d')
+        self.assertEqual(len(index()), 3)
+        # hashed by the task process after this one loaded the index
+        Media.objects.filter(pk=repost.pk).update(phash=0b1010, hashed_at=timezone.now())
+        self.assertEqual([sorted(c) for c in index().clusters()], [[self.media[0].pk, self.media[1].pk, repost.pk]])
+        self.assertEqual(len(index()), 4)
+
+    def test_clusters_list_the_posts_and_accounts(self):
+        response = json.loads(duplicates_view(RequestFactory().get('/duplicates')).content)
+        self.assertEqual(response['clusters'][0]['accounts'], ['a', 'b'])
+        response = json.loads(duplicates_view(RequestFactory().get(f'/duplicates?media={self.media[0].pk}')).content)
+        self.assertEqual(response['duplicates'], [{'pk': self.media[1].pk, 'post': 'b', 'account': 'b', 'distance': 1}])
+
+    def test_bad_parameters_are_rejected(self):
+        for query in ('media=x', 'radius=-1', 'radius=65', 'limit=0', 'limit=ten', 'min_size=1'):
+            response = duplicates_view(RequestFactory().get(f'/duplicates?{query}'))
+            self.assertEqual(response.status_code, 400, query)
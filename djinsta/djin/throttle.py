@@ -0,0 +1,96 @@
+"""
+Pacing of page loads over all workers
+
+Every page load takes a token from the global bucket and from the bucket of
+the account. When instagram throttles, both buckets halve their rate and
+block for a while; every clean response ramps the rate back up.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import RateBucket
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_KEY = 'global'
+
+
+class ThrottledError(Exception):
+    """Instagram asked to slow down"""
+
+
+class RateLimiter:
+
+    @classmethod
+    def for_account(cls, account):
+        """Limiter of the account, or None when rate limiting is off"""
+        return cls(account) if settings.RATE_LIMIT else None
+
+    def __init__(self, account):
+        self.options = settings.RATE_LIMIT
+        self.keys = {
+            GLOBAL_KEY: self.options['global_rate'],
+            f'account:{account.pk}': self.options['account_rate'],
+        }
+
+    def wait(self):
+        """Block until both buckets have a token and take them"""
+        while True:
+            delay = self._take()
+            if not delay:
+                return
+            logger.debug(f'Waiting {delay:.1f}s for a page load token')
+            time.sleep(delay)
+
+    def throttled(self):
+        """Back off after instagram throttled a page load"""
+        now = time.time()
+        with transaction.atomic():
+            for bucket in self._buckets():
+                bucket.factor = max(self.options['min_factor'], bucket.factor / 2)
+                # the slower the rate has become, the longer the pause
+                bucket.blocked_until = now + self.options['backoff'] / bucket.factor
+                bucket.tokens = 0
+                bucket.save()
+                logger.warning(f'Throttled, backing off {bucket}')
+
+    def clean(self):
+        """Ramp the rate back up after a clean page load"""
+        with transaction.atomic():
+            for bucket in self._buckets():
+                if bucket.factor < 1:
+                    bucket.factor = min(1, bucket.factor + self.options['recover'])
+                    bucket.save(update_fields=['factor'])
+
+    def _buckets(self):
+        for key in self.keys:
+            bucket, created = RateBucket.objects.select_for_update().get_or_create(key=key)
+            yield bucket
+
+    def _take(self):
+        """Seconds to wait for a token in every bucket, taking them when none"""
+        now = time.time()
+        burst = self.options['burst']
+        with transaction.atomic():
+            buckets = list(self._buckets())
+            delay = 0
+            for bucket in buckets:
+                rate = self.keys[bucket.key] * bucket.factor
+                if bucket.refilled_at:
+                    bucket.tokens = min(burst, bucket.tokens + (now - bucket.refilled_at) * rate)
+                else:
+                    bucket.tokens = burst
+                bucket.refilled_at = now
+                if bucket.blocked_until > now:
+                    delay = max(delay, bucket.blocked_until - now)
+                elif bucket.tokens < 1:
+                    delay = max(delay, (1 - bucket.tokens) / rate)
+            if not delay:
+                for bucket in buckets:
+                    bucket.tokens -= 1
+            for bucket in buckets:
+                bucket.save()
+        return delay
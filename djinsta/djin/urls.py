@@ -5,6 +5,12 @@ from . import views
 urlpatterns = [
     path('', views.index, name='index'),
     path('account/<int:account_pk>', views.account_view, name='account'),
+    path('account/<int:account_pk>/posts', views.account_posts_view, name='account_posts'),
     path('login/<int:account_pk>', views.login_view, name='login'),
     path('process/<int:account_pk>', views.process_view, name='process'),
+    path('scheduler', views.scheduler_view, name='scheduler'),
+    path('cache', views.cache_view, name='cache'),
+    path('heatmap', views.heatmap_view, name='heatmap'),
+    path('metrics', views.metrics_view, name='metrics'),
+    path('duplicates', views.duplicates_view, name='duplicates'),
 ]
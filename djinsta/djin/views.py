@@ -1,11 +1,19 @@
 import logging
 
+from django.conf import settings
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.shortcuts import render, redirect
+from django.utils.dateparse import parse_datetime
 
-from .tasks import my_profile
-from .models import Account
+from . import scheduler
+from .tasks import dispatch
+from .models import Account, Media
 from .instagram import Instagram
-from .insight import get_account, get_post, AccountSearch
+from .cache import search_cache
+from .metrics import registry
+from .phash import clusters, duplicates
+from .insight import get_account, get_posts, account_facets, account_heatmap, post_heatmap
 
 logger = logging.getLogger(__name__)
 
@@ -20,15 +28,74 @@ def index(request):
 def account_view(request, account_pk):
     account = Account.objects.get(pk=account_pk)
     logger.info(f'Viewing account {account}')
+    try:
+        posts, next_cursor = posts_page(account, request.GET.get('cursor'))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
     context = {
         'account': account,
-        'account_doc': get_account(account, ignore=404),
-        'account_agg': AccountSearch().execute(),
-        'posts': [(p, get_post(p, ignore=404)) for p in account.posts.all()],
+        'account_doc': get_account(account),
+        'account_agg': account_facets(),
+        'posts': posts,
+        'next_cursor': next_cursor,
     }
     return render(request, 'djin/account.html', context)
 
 
+def account_posts_view(request, account_pk):
+    """next page of posts of the account as json"""
+    account = Account.objects.get(pk=account_pk)
+    try:
+        posts, next_cursor = posts_page(account, request.GET.get('cursor'))
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({
+        'posts': [{
+            'pk': post.pk,
+            'description': post.description,
+            'count': post.count,
+            'kind': post.kind,
+            'location': post.location.name if post.location else None,
+            'tags': list(doc.tags) if doc and doc.tags else [],
+            'media': [{
+                'kind': m.kind,
+                'source': m.source,
+                'url': m.url,
+                'poster': m.poster,
+                'extension': m.extension,
+            } for m in post.media.all()],
+        } for post, doc in posts],
+        'next_cursor': next_cursor,
+    })
+
+
+def posts_page(account, cursor=None):
+    """A page of posts newest first with their docs, and the cursor after it
+
+    The cursor is the time and pk of the last post, so every page is one
+    indexed range query, however deep it is.
+    """
+    posts = account.posts.select_related('location').prefetch_related('media').order_by('-created_at', '-pk')
+    if cursor:
+        created_at, pk = parse_cursor(cursor)
+        posts = posts.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+    posts = list(posts[:settings.ACCOUNT_PAGE_SIZE + 1])
+    next_cursor = None
+    if len(posts) > settings.ACCOUNT_PAGE_SIZE:
+        posts = posts[:-1]
+        next_cursor = f'{posts[-1].created_at.isoformat()}|{posts[-1].pk}'
+    return list(zip(posts, get_posts(posts))), next_cursor
+
+
+def parse_cursor(cursor):
+    """Time and pk of the cursor, raises ValueError when it is not one"""
+    created_at, sep, pk = cursor.rpartition('|')
+    created_at = parse_datetime(created_at)
+    if not sep or created_at is None:
+        raise ValueError(f'Invalid cursor {cursor!r}')
+    return created_at, int(pk)
+
+
 def login_view(request, account_pk):
     """log in to instagram"""
     account = Account.objects.get(pk=account_pk)
@@ -38,9 +105,102 @@ def login_view(request, account_pk):
 
 
 def process_view(request, account_pk):
+    """schedule the account now or stop scheduling it"""
     account = Account.objects.get(pk=account_pk)
-    account.processing = not account.processing
-    account.save()
-    if account.processing:
-        my_profile(account_pk)
+    if account.next_run_at:
+        scheduler.unschedule(account)
+    else:
+        scheduler.schedule(account)
+        dispatch()
     return redirect('account', account_pk)
+
+
+def scheduler_view(request):
+    """queue depth and lag of the scheduler"""
+    return JsonResponse(scheduler.queue_stats())
+
+
+def cache_view(request):
+    """hit rates of the search cache"""
+    return JsonResponse(search_cache.stats())
+
+
+def metrics_view(request):
+    """timings and counters of this process for prometheus"""
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def heatmap_view(request):
+    """posts or accounts per geohash cell, within bounds of top,left,bottom,right"""
+    try:
+        precision = int_param(request, 'precision', 5, low=1, high=12)
+        bounds = parse_bounds(request.GET.get('bounds'))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    if request.GET.get('of') == 'accounts':
+        return JsonResponse(account_heatmap(precision, bounds))
+    account_pk = request.GET.get('account')
+    account = Account.objects.get(pk=account_pk) if account_pk else None
+    return JsonResponse(post_heatmap(precision, bounds, account))
+
+
+def int_param(request, name, default, low, high=None):
+    """Integer parameter of the request, raises ValueError when it is not one in range"""
+    value = request.GET.get(name)
+    if not value:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        number = None
+    if number is None or number < low or (high is not None and number > high):
+        raise ValueError(f'Invalid {name} {value!r}')
+    return number
+
+
+def parse_bounds(bounds):
+    """Top, left, bottom and right of the bounds, raises ValueError when they are not"""
+    if not bounds:
+        return None
+    try:
+        top, left, bottom, right = [float(b) for b in bounds.split(',')]
+    except ValueError:
+        raise ValueError(f'Invalid bounds {bounds!r}')
+    if not (-90 <= bottom <= top <= 90 and -180 <= left <= 180 and -180 <= right <= 180):
+        raise ValueError(f'Invalid bounds {bounds!r}')
+    return [top, left, bottom, right]
+
+
+def duplicates_view(request):
+    """near duplicates of the image of a media, or the largest clusters of them"""
+    try:
+        media_pk = int_param(request, 'media', None, low=1)
+        radius = int_param(request, 'radius', None, low=0, high=64)
+        limit = int_param(request, 'limit', 50, low=1)
+        min_size = int_param(request, 'min_size', 2, low=2)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    if media_pk:
+        media = Media.objects.get(pk=media_pk)
+        near = duplicates(media, radius)
+        found = media_info([pk for pk, d in near])
+        return JsonResponse({'duplicates': [
+            dict(found[pk], distance=d) for pk, d in near if pk in found]})
+
+    groups = clusters(min_size)[:limit]
+    found = media_info([pk for keys in groups for pk in keys])
+    result = []
+    for keys in groups:
+        media = [found[pk] for pk in keys if pk in found]
+        result.append({
+            'size': len(media),
+            'accounts': sorted({m['account'] for m in media}),
+            'media': media,
+        })
+    return JsonResponse({'clusters': result})
+
+
+def media_info(pks):
+    """post and account of the media in one query, deleted media are left out"""
+    media = Media.objects.filter(pk__in=pks).values_list('pk', 'post__code', 'post__account__username')
+    return {pk: {'pk': pk, 'post': code, 'account': username} for pk, code, username in media}
@@ -81,10 +81,23 @@ DATABASES = {
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
         'OPTIONS': {
             'timeout': 30,
+            # writers take the lock when their transaction begins and wait for
+            # it, instead of failing when a read turns into a write
+            'transaction_mode': 'IMMEDIATE',
         }
     }
 }
 
+# pragmas of every sqlite connection, see djin.db. Normal sync is safe in WAL
+# mode, a crash loses at most the last commits; cache_size is negative KiB
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -64000,
+    'temp_store': 'memory',
+    'mmap_size': 256 * 1024 * 1024,
+}
+
 
 CACHES = {
     'default': {
@@ -94,6 +107,13 @@ CACHES = {
     }
 }
 
+# search results are kept in memory in front of the default cache
+SEARCH_CACHE = {
+    'maxsize': 256,
+    'timeout': 3600,
+    'backend': 'default',
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
@@ -133,10 +153,120 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# local copies of the post media
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+MEDIA_URL = '/media/'
+
+# downloads of the post media, timeout is seconds per file
+MEDIA_STORE = {
+    'concurrency': 8,
+    'timeout': 300,
+    'chunk_size': 64 * 1024,
+}
+
+# near duplicate images differ in at most radius of the 64 bits of their hash.
+# The hash is looked up in chunks with radius // chunks bits flipped per chunk,
+# lookups are fastest with chunks of about log2 of the number of images bits
+PHASH = {
+    'radius': 6,
+    'chunks': 4,
+}
+
 BROWSER_CHROME = os.path.join(BASE_DIR, 'browsers', 'chromedriver')
 
+# how chrome is started
+BROWSER_PROFILE = {
+    'headless': True,
+    'window_size': '1280,1024',
+    'disable_extensions': True,
+    'disable_gpu': True,
+}
+
+# resource types blocked per page type: image, media and font. Only urls and
+# text are read, except on the login page which might show a challenge
+BROWSER_PRESETS = {
+    'profile': {'block': ['image', 'media', 'font']},
+    'post': {'block': ['image', 'media', 'font']},
+    'login': {'block': []},
+}
+
+# warm browsers shared by tasks and views, ages are in seconds
+BROWSER_POOL = {
+    'size': 4,
+    'max_age': 3600,
+    'max_uses': 50,
+    'max_idle': 300,
+    'timeout': 600,
+}
+
 WHOOSH_INDEX = os.path.join(BASE_DIR, 'whoosh')
 
+# elasticsearch, or whoosh for a single node without a search server:
+# {'class': 'djin.embedded.WhooshBackend', 'path': WHOOSH_INDEX}
+SEARCH_BACKEND = {
+    'class': 'djin.elastic.ElasticBackend',
+    'hosts': ['localhost'],
+    'timeout': 5,
+}
+
+# geonames dump the locations are geocoded with
+GAZETTEER = os.path.join(BASE_DIR, 'gazetteer', 'cities15000.txt')
+
+# bulk indexing flushes by document count or by seconds waited
+ES_BULK = {
+    'size': 500,
+    'interval': 5,
+    'retries': 3,
+}
+ES_REFRESH_INTERVAL = '1s'
+# every month of posts gets an index with these settings
+ES_INDEX = {
+    'shards': 1,
+    'replicas': 0,
+}
+
+# number of browser sessions refreshing the posts of an account
+PROCESS_WORKERS = 4
+
+# accounts crawled at once, refresh intervals are in seconds
+SCHEDULER = {
+    'max_in_flight': 2,
+    'min_interval': 3600,
+    'max_interval': 3600 * 24 * 7,
+    'activity_days': 7,
+}
+
+# page loads per second over all workers and per account, the rate halves
+# when throttled and recovers by a step with every clean page
+RATE_LIMIT = {
+    'global_rate': 1.0,
+    'account_rate': 0.5,
+    'burst': 5,
+    'min_factor': 0.05,
+    'recover': 0.05,
+    'backoff': 60,
+}
+
+# posts per page on the account page
+ACCOUNT_PAGE_SIZE = 50
+
+# post codes a profile page remembers while scrolling
+HARVEST_PAGE_CAP = 1000
+
+# older posts collected per run until the first post of an account is reached
+BACKFILL_POSTS = 1000
+
+# the browser backend scrapes with chrome, the http backend fetches the pages
+# directly with the cookies of the last login
+FETCH = {
+    'backend': 'browser',
+    'concurrency': 100,
+    'batch': 500,
+    'timeout': 30,
+    'user_agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/65.0 Safari/537.36',
+    'timeline_query_hash': '42323d64886122307be10013ad2dcc44',
+}
+
 
 LOGGING = {
     'version': 1,
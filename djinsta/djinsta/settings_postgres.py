@@ -0,0 +1,33 @@
+"""
+Settings of a PostgreSQL deployment
+
+Run with DJANGO_SETTINGS_MODULE=djinsta.settings_postgres, or --settings on
+manage.py. The connection is read from the PG* environment variables, see
+https://www.postgresql.org/docs/current/libpq-envars.html
+"""
+import os
+
+from .settings import *  # noqa: F401,F403
+from .settings import PROCESS_WORKERS
+
+# every process keeps a pool of connections, one per browser worker of a
+# refresh and a few more for the task runner, the views and the media store
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('PGDATABASE', 'djinsta'),
+        'USER': os.environ.get('PGUSER', 'djinsta'),
+        'PASSWORD': os.environ.get('PGPASSWORD', ''),
+        'HOST': os.environ.get('PGHOST', 'localhost'),
+        'PORT': os.environ.get('PGPORT', '5432'),
+        # the pool keeps the connections, django closes them back into it
+        'CONN_MAX_AGE': 0,
+        'OPTIONS': {
+            'pool': {
+                'min_size': 2,
+                'max_size': PROCESS_WORKERS + 4,
+                'timeout': 30,
+            },
+        },
+    }
+}